@@ -0,0 +1,330 @@
+"""
+Backend tìm láng giềng gần đúng (ANN) cho EmbeddingIndex.query_similar.
+
+- `faiss-hnsw` / `faiss-ivf`: dùng FAISS (HNSW hoặc IVF-Flat, inner product trên vector đã
+  chuẩn hoá) nếu đã cài; `faiss` là tên cũ của `faiss-hnsw`.
+- `numpy`: IVF thuần NumPy (k-means cầu làm bộ lượng tử thô, chỉ quét `nprobe` cụm gần nhất).
+Cả hai đều lưu được ra đĩa cạnh cache embedding và chỉ được dùng lại khi dấu vân tay
+(thứ tự khoá nội dung của các hàng embedding) còn khớp.
+
+Chạy trực tiếp file này để đo recall@k so với tìm kiếm chính xác và độ trễ mỗi truy vấn
+theo nprobe trên catalog tổng hợp, ví dụ:
+    python ai/ann_index.py --books 1000000 --backend numpy --nprobe 1,4,8,16,32
+    python ai/ann_index.py --books 1000000 --backend faiss-ivf --nprobe 1,4,8,16,32
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+ANN_BACKENDS = ("exact", "auto", "faiss", "faiss-hnsw", "faiss-ivf", "numpy")
+# Loại index FAISS của từng tên backend
+_FAISS_KINDS = {"faiss": "hnsw", "faiss-hnsw": "hnsw", "faiss-ivf": "ivf"}
+
+
+def _load_faiss() -> Any:
+    try:
+        return importlib.import_module("faiss")
+    except ImportError:
+        return None
+
+
+class NumpyIVFIndex:
+    """IVF đơn giản: mỗi vector thuộc một cụm; truy vấn chỉ quét các cụm gần nhất."""
+
+    name = "numpy"
+
+    def __init__(self, embeddings: np.ndarray, nprobe: int = 8):
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+        self.list_members: Optional[np.ndarray] = None
+
+    def set_nprobe(self, nprobe: int) -> None:
+        self.nprobe = nprobe
+
+    def train(self, n_lists: int = 0, iterations: int = 10, sample_size: int = 100_000, seed: int = 13) -> None:
+        """Huấn luyện k-means cầu trên một mẫu rồi gán toàn bộ vector vào cụm."""
+        total = len(self.embeddings)
+        n_lists = n_lists or max(1, int(np.sqrt(total)))
+        n_lists = min(n_lists, total)
+        rng = np.random.default_rng(seed)
+
+        sample_idx = rng.choice(total, size=min(sample_size, total), replace=False)
+        sample = np.asarray(self.embeddings[np.sort(sample_idx)], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            filled = norms[:, 0] > 0
+            centroids[filled] = sums[filled] / norms[filled]
+
+        assignments = np.empty(total, dtype=np.int64)
+        for start in range(0, total, 65_536):
+            block = np.asarray(self.embeddings[start : start + 65_536], dtype=np.float32)
+            assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        self.centroids = centroids
+        self.list_members = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def search(self, queries: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Trả về (sims, indices) kích thước (Q × top_n), sắp giảm dần theo độ tương đồng.
+        Hàng thiếu ứng viên được đệm bằng chỉ số -1 và sim -inf.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32, copy=False)
+        n_lists = len(self.centroids)
+        nprobe = min(max(1, self.nprobe), n_lists)
+        centroid_sims = queries @ self.centroids.T
+        if nprobe < n_lists:
+            probes = np.argpartition(centroid_sims, -nprobe, axis=1)[:, -nprobe:]
+        else:
+            probes = np.tile(np.arange(n_lists), (len(queries), 1))
+
+        out_idx = np.full((len(queries), top_n), -1, dtype=np.int64)
+        out_sims = np.full((len(queries), top_n), -np.inf, dtype=np.float32)
+        for row, query in enumerate(queries):
+            members = np.concatenate(
+                [self.list_members[self.list_offsets[p] : self.list_offsets[p + 1]] for p in probes[row]]
+            )
+            if not len(members):
+                continue
+            sims = np.asarray(self.embeddings[members], dtype=np.float32) @ query
+            take = min(top_n, len(members))
+            if take < len(members):
+                best = np.argpartition(sims, -take)[-take:]
+            else:
+                best = np.arange(len(members))
+            best = best[np.argsort(sims[best])[::-1]]
+            out_idx[row, :take] = members[best]
+            out_sims[row, :take] = sims[best]
+        return out_sims, out_idx
+
+    def save(self, path: Path) -> None:
+        np.savez(
+            path.with_suffix(".npz"),
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_members=self.list_members,
+        )
+
+    def load(self, path: Path) -> bool:
+        target = path.with_suffix(".npz")
+        if not target.exists():
+            return False
+        with np.load(target) as data:
+            self.centroids = data["centroids"]
+            self.list_offsets = data["list_offsets"]
+            self.list_members = data["list_members"]
+        return len(self.list_members) == len(self.embeddings)
+
+
+class FaissANNIndex:
+    """Bọc FAISS: HNSW (mặc định) hoặc IVF-Flat, metric inner product."""
+
+    def __init__(self, embeddings: np.ndarray, nprobe: int = 8, kind: str = "hnsw"):
+        if kind not in ("hnsw", "ivf"):
+            raise ValueError(f"Unsupported FAISS index kind: {kind}")
+        self.faiss = _load_faiss()
+        if self.faiss is None:
+            raise ImportError("faiss is not installed.")
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        self.kind = kind
+        self.name = f"faiss-{kind}"
+        self.index: Any = None
+
+    def train(self, n_lists: int = 0, hnsw_m: int = 32) -> None:
+        faiss = self.faiss
+        data = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        dim = data.shape[1]
+        if self.kind == "ivf":
+            n_lists = n_lists or max(1, int(np.sqrt(len(data))))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, n_lists, faiss.METRIC_INNER_PRODUCT)
+            index.train(data)
+        else:
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.add(data)
+        self.index = index
+        self._apply_search_params()
+
+    def set_nprobe(self, nprobe: int) -> None:
+        self.nprobe = nprobe
+        self._apply_search_params()
+
+    def _apply_search_params(self) -> None:
+        if self.kind == "ivf":
+            self.index.nprobe = self.nprobe
+        else:
+            self.index.hnsw.efSearch = max(64, self.nprobe * 16)
+
+    def search(self, queries: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        sims, indices = self.index.search(queries, top_n)
+        sims = np.where(indices >= 0, sims, -np.inf).astype(np.float32)
+        return sims, indices.astype(np.int64)
+
+    def save(self, path: Path) -> None:
+        self.faiss.write_index(self.index, str(path.with_suffix(".faiss")))
+
+    def load(self, path: Path) -> bool:
+        target = path.with_suffix(".faiss")
+        if not target.exists():
+            return False
+        self.index = self.faiss.read_index(str(target))
+        self._apply_search_params()
+        return self.index.ntotal == len(self.embeddings)
+
+
+def build_ann_index(
+    embeddings: np.ndarray,
+    backend: str = "auto",
+    *,
+    nprobe: int = 8,
+    persist_dir: Optional[Path] = None,
+    fingerprint: Optional[str] = None,
+) -> Optional[Any]:
+    """
+    Dựng (hoặc nạp lại từ đĩa) ANN index cho ma trận embedding.
+    backend: "exact" (không dùng ANN), "auto" (faiss-hnsw nếu có, không thì numpy),
+    "faiss-hnsw" (hoặc "faiss"), "faiss-ivf", "numpy".
+    Chỉ nạp lại index đã lưu khi `fingerprint` trùng với lần build trước; mỗi loại index lưu
+    ra file riêng (ann_numpy, ann_faiss_hnsw, ann_faiss_ivf).
+    """
+    if backend == "exact" or embeddings is None or not len(embeddings):
+        return None
+    if backend == "auto":
+        backend = "faiss-hnsw" if _load_faiss() is not None else "numpy"
+
+    ann: Any
+    if backend in _FAISS_KINDS:
+        ann = FaissANNIndex(embeddings, nprobe=nprobe, kind=_FAISS_KINDS[backend])
+        file_stem = f"ann_faiss_{ann.kind}"
+    elif backend == "numpy":
+        ann = NumpyIVFIndex(embeddings, nprobe=nprobe)
+        file_stem = "ann_numpy"
+    else:
+        raise ValueError(f"Unsupported ANN backend: {backend}")
+
+    base_path = persist_dir / file_stem if persist_dir is not None and fingerprint else None
+    meta_path = base_path.with_suffix(".json") if base_path is not None else None
+    if meta_path is not None and meta_path.exists():
+        saved = json.loads(meta_path.read_text(encoding="utf-8"))
+        if saved.get("fingerprint") == fingerprint and ann.load(base_path):
+            return ann
+
+    ann.train()
+    if base_path is not None:
+        base_path.parent.mkdir(parents=True, exist_ok=True)
+        ann.save(base_path)
+        meta_path.write_text(json.dumps({"fingerprint": fingerprint, "rows": len(embeddings)}), encoding="utf-8")
+    return ann
+
+
+def synthetic_embeddings(n_rows: int, dim: int, n_topics: int = 200, seed: int = 13) -> np.ndarray:
+    """Vector đã chuẩn hoá quanh `n_topics` tâm (sách cùng chủ đề gần nhau như embedding thật)."""
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    out = np.empty((n_rows, dim), dtype=np.float32)
+    for start in range(0, n_rows, 65_536):
+        size = min(65_536, n_rows - start)
+        block = topics[rng.integers(0, n_topics, size=size)]
+        block += rng.standard_normal((size, dim)).astype(np.float32) * 0.8
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        out[start : start + size] = block
+    return out
+
+
+def _exact_top_n(embeddings: np.ndarray, query: np.ndarray, top_n: int) -> np.ndarray:
+    sims = embeddings @ query
+    best = np.argpartition(sims, -top_n)[-top_n:]
+    return best[np.argsort(sims[best])[::-1]]
+
+
+def _latency_stats(latencies: np.ndarray) -> Dict[str, float]:
+    return {
+        "p50Ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99Ms": round(float(np.percentile(latencies, 99)), 3),
+        "meanMs": round(float(latencies.mean()), 3),
+    }
+
+
+def run_benchmark(
+    n_books: int, dim: int, backend: str, nprobes: List[int], n_queries: int, top_n: int
+) -> Dict[str, Any]:
+    """Recall@top_n so với tìm kiếm chính xác và độ trễ từng truy vấn cho mỗi giá trị nprobe."""
+    embeddings = synthetic_embeddings(n_books, dim)
+    # Truy vấn giống vector profile: trung bình vài sách ngẫu nhiên, đã chuẩn hoá
+    rng = np.random.default_rng(29)
+    picks = rng.integers(0, n_books, size=(n_queries, 3))
+    queries = embeddings[picks].mean(axis=1)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = np.empty((n_queries, top_n), dtype=np.int64)
+    latencies = np.empty(n_queries, dtype=np.float64)
+    for row, query in enumerate(queries):
+        started = time.perf_counter()
+        exact[row] = _exact_top_n(embeddings, query, top_n)
+        latencies[row] = (time.perf_counter() - started) * 1000.0
+
+    started = time.perf_counter()
+    ann = build_ann_index(embeddings, backend, nprobe=nprobes[0])
+    build_seconds = time.perf_counter() - started
+
+    runs: List[Dict[str, Any]] = []
+    for nprobe in nprobes:
+        ann.set_nprobe(nprobe)
+        found = np.empty((n_queries, top_n), dtype=np.int64)
+        ann_latencies = np.empty(n_queries, dtype=np.float64)
+        for row, query in enumerate(queries):
+            started = time.perf_counter()
+            found[row] = ann.search(query, top_n)[1][0]
+            ann_latencies[row] = (time.perf_counter() - started) * 1000.0
+        hits = sum(len(np.intersect1d(found[row], exact[row])) for row in range(n_queries))
+        runs.append({"nprobe": nprobe, "recall": round(hits / (n_queries * top_n), 4), **_latency_stats(ann_latencies)})
+
+    return {
+        "books": n_books,
+        "dim": dim,
+        "backend": ann.name,
+        "queries": n_queries,
+        "topN": top_n,
+        "buildSeconds": round(build_seconds, 3),
+        "exact": _latency_stats(latencies),
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall/độ trễ của ANN index trên catalog tổng hợp.")
+    parser.add_argument("--books", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--backend", choices=[name for name in ANN_BACKENDS if name != "exact"], default="auto")
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32", help="Danh sách nprobe, phân tách bằng dấu phẩy.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-n", type=int, default=50)
+    args = parser.parse_args()
+    nprobes = [int(value) for value in args.nprobe.split(",") if value.strip()]
+    report = run_benchmark(args.books, args.dim, args.backend, nprobes, args.queries, args.top_n)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+__all__ = ["ANN_BACKENDS", "NumpyIVFIndex", "FaissANNIndex", "build_ann_index"]
+
+
+if __name__ == "__main__":
+    main()
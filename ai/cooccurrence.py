@@ -0,0 +1,397 @@
+"""
+Mô hình đồng xuất hiện sách–sách (item-item) tính trước từ ma trận profile × sách.
+
+- Ma trận tương tác nhị phân X (profile × sách, 1 = profile có điểm > 0 với sách).
+- Số lần đồng xuất hiện C = Xᵀ·X (đường chéo = số profile của mỗi sách).
+- Láng giềng: cosine C_ij / sqrt(C_ii · C_jj), chỉ giữ top_n mỗi hàng, lưu dạng CSR.
+Khi có sự kiện mới chỉ các profile thay đổi được tính lại: C += Xmớiᵀ·Xmới − Xcũᵀ·Xcũ
+trên đúng các hàng đó, rồi cắt lại top_n (rẻ hơn nhiều so với nhân lại toàn bộ).
+Bố cục thư mục:
+    <model_dir>/item_ids.npy        product_id theo thứ tự cột
+    <model_dir>/profile_keys.npy    khoá profile theo thứ tự hàng của X
+    <model_dir>/interactions.npz    X (CSR)
+    <model_dir>/counts.npz          C (CSR)
+    <model_dir>/neighbors.npz       láng giềng top_n (CSR, float32)
+    <model_dir>/meta.json           top_n, thời điểm build, kích thước
+
+Chạy trực tiếp file này để benchmark thời gian build/cập nhật trên dữ liệu tổng hợp.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from profile_store import ProfileStore, _row_kth_largest
+
+
+DEFAULT_MODEL_DIR = "ai/models/cooccurrence"
+DEFAULT_TOP_N = 50
+
+_FILES = ("item_ids.npy", "profile_keys.npy", "interactions.npz", "counts.npz", "neighbors.npz")
+
+
+def interaction_matrix(
+    raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+) -> Tuple[List[str], np.ndarray, sparse.csr_matrix]:
+    """(khoá profile, product_id theo cột, X nhị phân) từ raw_scores dạng dict hoặc ProfileStore."""
+    if isinstance(raw_scores, ProfileStore):
+        matrix = raw_scores.matrix()
+        matrix.data = (matrix.data > 0).astype(np.float64)
+        matrix.eliminate_zeros()
+        return list(raw_scores.profile_keys), np.asarray(raw_scores.book_ids, dtype=np.int64), matrix
+
+    keys = list(raw_scores.keys())
+    columns: Dict[int, int] = {}
+    rows: List[int] = []
+    cols: List[int] = []
+    for row, key in enumerate(keys):
+        for book_id_str, score in raw_scores[key].items():
+            if not score > 0:
+                continue
+            try:
+                pid = int(book_id_str)
+            except (TypeError, ValueError):
+                continue
+            rows.append(row)
+            cols.append(columns.setdefault(pid, len(columns)))
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(len(keys), len(columns))
+    )
+    # Cùng product_id từ hai chuỗi khác nhau ("7", "07") bị cộng dồn -> đưa về nhị phân
+    matrix.data[:] = 1.0
+    return keys, np.fromiter(columns, dtype=np.int64, count=len(columns)), matrix
+
+
+def _resize(matrix: sparse.csr_matrix, shape: Tuple[int, int]) -> sparse.csr_matrix:
+    matrix = matrix.tocsr(copy=True)
+    matrix.resize(shape)
+    return matrix
+
+
+def top_n_cosine(
+    counts: sparse.csr_matrix,
+    top_n: int,
+    item_ids: np.ndarray,
+    rows_subset: Optional[np.ndarray] = None,
+) -> sparse.csr_matrix:
+    """
+    Cosine từ ma trận đồng xuất hiện, bỏ đường chéo, giữ top_n mỗi hàng.
+    Hoà điểm thì product_id nhỏ hơn đứng trước, nên kết quả không phụ thuộc thứ tự cột.
+    `rows_subset`: chỉ tính các hàng này (các hàng khác để trống).
+    """
+    n_items = counts.shape[0]
+    diagonal = np.asarray(counts.diagonal(), dtype=np.float64)
+    if rows_subset is not None:
+        selector = sparse.csr_matrix(
+            (np.ones(len(rows_subset)), (rows_subset, rows_subset)), shape=(n_items, n_items)
+        )
+        counts = selector @ counts
+    coo = counts.tocoo()
+    keep = (coo.row != coo.col) & (coo.data > 0)
+    rows, cols, values = coo.row[keep], coo.col[keep], coo.data[keep]
+    denominators = np.sqrt(diagonal[rows] * diagonal[cols])
+    scores = np.divide(values, denominators, out=np.zeros(len(values)), where=denominators > 0)
+
+    # Chỉ giữ entry >= giá trị lớn thứ top_n của hàng rồi mới sắp xếp phần còn lại
+    thresholds = _row_kth_largest(scores, rows, n_items, top_n)
+    keep = scores >= thresholds[rows]
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    order = np.lexsort((np.asarray(item_ids, dtype=np.int64)[cols], -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    starts = np.searchsorted(rows, np.arange(n_items))
+    rank = np.arange(len(rows)) - starts[rows]
+    keep = rank < top_n
+    return sparse.csr_matrix(
+        (scores[keep].astype(np.float32), (rows[keep], cols[keep])), shape=(n_items, n_items)
+    )
+
+
+class CooccurrenceModel:
+    """Xem docstring của module. `neighbors` là phần dùng khi rerank/phục vụ."""
+
+    def __init__(
+        self,
+        item_ids: np.ndarray,
+        profile_keys: List[str],
+        interactions: sparse.csr_matrix,
+        counts: sparse.csr_matrix,
+        top_n: int = DEFAULT_TOP_N,
+        neighbors: Optional[sparse.csr_matrix] = None,
+    ):
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        self.profile_keys = list(profile_keys)
+        self.interactions = interactions.tocsr()
+        self.counts = counts.tocsr()
+        self.top_n = top_n
+        self._col_of = {int(pid): col for col, pid in enumerate(self.item_ids)}
+        self.neighbors = neighbors if neighbors is not None else top_n_cosine(self.counts, top_n, self.item_ids)
+
+    @classmethod
+    def empty(cls, top_n: int = DEFAULT_TOP_N) -> "CooccurrenceModel":
+        return cls(
+            np.zeros(0, dtype=np.int64),
+            [],
+            sparse.csr_matrix((0, 0), dtype=np.float64),
+            sparse.csr_matrix((0, 0), dtype=np.float64),
+            top_n,
+        )
+
+    @classmethod
+    def build(
+        cls,
+        raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+        top_n: int = DEFAULT_TOP_N,
+    ) -> "CooccurrenceModel":
+        """Build từ đầu: C = Xᵀ·X trên toàn bộ profile."""
+        keys, item_ids, matrix = interaction_matrix(raw_scores)
+        nonempty = np.flatnonzero(np.diff(matrix.indptr) > 0)
+        matrix = matrix[nonempty]
+        counts = (matrix.T @ matrix).tocsr()
+        return cls(item_ids, [keys[row] for row in nonempty], matrix, counts, top_n)
+
+    def _columns_for(self, item_ids: np.ndarray) -> np.ndarray:
+        """Cột của từng product_id; sách mới được thêm vào cuối danh sách cột."""
+        columns = np.empty(len(item_ids), dtype=np.int64)
+        added: List[int] = []
+        for position, pid in enumerate(item_ids.tolist()):
+            col = self._col_of.get(pid)
+            if col is None:
+                col = self._col_of[pid] = len(self.item_ids) + len(added)
+                added.append(pid)
+            columns[position] = col
+        if added:
+            self.item_ids = np.concatenate([self.item_ids, np.asarray(added, dtype=np.int64)])
+        return columns
+
+    def update(
+        self,
+        raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+        *,
+        complete: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Cập nhật theo các profile trong `raw_scores` (profile rỗng = xoá khỏi mô hình).
+        complete=True: `raw_scores` là toàn bộ profile hiện có, profile vắng mặt bị xoá.
+        Chỉ các hàng thực sự đổi tập sách mới đóng góp vào phép nhân.
+        """
+        keys, item_ids, matrix = interaction_matrix(raw_scores)
+        columns = self._columns_for(item_ids)
+        n_items = len(self.item_ids)
+        incoming = sparse.csr_matrix(
+            (matrix.data, columns[matrix.indices], matrix.indptr), shape=(len(keys), n_items)
+        )
+        incoming.sort_indices()
+        current = _resize(self.interactions, (self.interactions.shape[0], n_items))
+        counts = _resize(self.counts, (n_items, n_items))
+
+        row_of = {key: row for row, key in enumerate(self.profile_keys)}
+        old_rows = np.array([row_of.get(key, -1) for key in keys], dtype=np.int64)
+        known = np.flatnonzero(old_rows >= 0)
+        changed_known = np.zeros(0, dtype=np.int64)
+        if len(known):
+            difference = incoming[known] - current[old_rows[known]]
+            difference.eliminate_zeros()
+            changed_known = known[np.diff(difference.indptr) > 0]
+        changed_in = np.sort(np.concatenate([changed_known, np.flatnonzero(old_rows < 0)]))
+
+        stale = np.zeros(current.shape[0], dtype=bool)
+        stale[old_rows[changed_known]] = True
+        if complete:
+            present = np.zeros(current.shape[0], dtype=bool)
+            present[old_rows[known]] = True
+            stale |= ~present
+        stale_rows = np.flatnonzero(stale)
+
+        old_part = current[stale_rows]
+        new_part = incoming[changed_in]
+        delta = ((new_part.T @ new_part) - (old_part.T @ old_part)).tocsr()
+        delta.eliminate_zeros()
+        counts = (counts + delta).tocsr()
+        counts.eliminate_zeros()
+
+        new_nonempty = changed_in[np.diff(new_part.indptr) > 0]
+        kept = np.flatnonzero(~stale)
+        self.interactions = sparse.vstack([current[kept], incoming[new_nonempty]], format="csr")
+        self.profile_keys = [self.profile_keys[row] for row in kept] + [keys[row] for row in new_nonempty]
+        self.counts = counts
+        # Hàng cần cắt lại: sách bị chạm (hàng C đổi) và mọi sách đồng xuất hiện với chúng
+        # (mẫu số cosine đổi theo đường chéo); các hàng còn lại giữ nguyên láng giềng cũ
+        touched = np.unique(delta.indices)
+        affected = np.union1d(touched, counts[touched].indices) if len(touched) else touched
+        neighbors = _resize(self.neighbors, (n_items, n_items))
+        if len(affected) * 2 >= n_items:
+            self.neighbors = top_n_cosine(counts, self.top_n, self.item_ids)
+        elif len(affected):
+            kept_rows = np.ones(n_items)
+            kept_rows[affected] = 0.0
+            self.neighbors = (
+                sparse.diags(kept_rows, format="csr") @ neighbors
+                + top_n_cosine(counts, self.top_n, self.item_ids, affected)
+            ).tocsr()
+        else:
+            self.neighbors = neighbors
+        return {
+            "profilesChanged": int(len(changed_in)),
+            "profilesRemoved": int(len(stale_rows) - len(changed_known)),
+            "itemsRescored": int(len(affected)),
+        }
+
+    def similar(self, product_id: int, top_n: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Láng giềng (product_id, cosine) của một sách, giảm dần."""
+        col = self._col_of.get(int(product_id))
+        if col is None:
+            return []
+        start, end = self.neighbors.indptr[col], self.neighbors.indptr[col + 1]
+        pairs = [
+            (int(self.item_ids[other]), float(score))
+            for other, score in zip(self.neighbors.indices[start:end], self.neighbors.data[start:end])
+        ]
+        pairs.sort(key=lambda item: (-item[1], item[0]))
+        return pairs[:top_n] if top_n else pairs
+
+    def aligned(self, book_ids: Sequence[int]) -> sparse.csr_matrix:
+        """Ma trận láng giềng đánh lại chỉ số theo `book_ids` (ví dụ index.book_ids)."""
+        position_of = {int(pid): position for position, pid in enumerate(book_ids)}
+        target = np.array([position_of.get(int(pid), -1) for pid in self.item_ids], dtype=np.int64)
+        coo = self.neighbors.tocoo()
+        if len(target):
+            rows, cols = target[coo.row], target[coo.col]
+        else:
+            rows = cols = np.zeros(0, dtype=np.int64)
+        keep = (rows >= 0) & (cols >= 0)
+        size = len(book_ids)
+        return sparse.csr_matrix((coo.data[keep], (rows[keep], cols[keep])), shape=(size, size))
+
+    def save(self, path: str | os.PathLike) -> None:
+        root = Path(path)
+        root.mkdir(parents=True, exist_ok=True)
+        arrays = {
+            "item_ids.npy": self.item_ids,
+            "profile_keys.npy": np.asarray(self.profile_keys, dtype=str),
+        }
+        for name, array in arrays.items():
+            tmp = root / f"{name[:-4]}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, root / name)
+        for name, matrix in (
+            ("interactions.npz", self.interactions),
+            ("counts.npz", self.counts),
+            ("neighbors.npz", self.neighbors),
+        ):
+            tmp = root / f"{name[:-4]}.tmp.npz"
+            sparse.save_npz(tmp, matrix)
+            os.replace(tmp, root / name)
+        meta = {
+            "topN": self.top_n,
+            "items": len(self.item_ids),
+            "profiles": len(self.profile_keys),
+            "savedAt": datetime.now(timezone.utc).isoformat(),
+        }
+        (root / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: str | os.PathLike, top_n: Optional[int] = None) -> Optional["CooccurrenceModel"]:
+        """Nạp mô hình đã lưu; top_n khác lần lưu thì chỉ cắt lại láng giềng từ C."""
+        root = Path(path)
+        if not all((root / name).exists() for name in _FILES):
+            return None
+        try:
+            meta = json.loads((root / "meta.json").read_text(encoding="utf-8"))
+            item_ids = np.load(root / "item_ids.npy")
+            profile_keys = np.load(root / "profile_keys.npy").tolist()
+            interactions = sparse.load_npz(root / "interactions.npz").tocsr()
+            counts = sparse.load_npz(root / "counts.npz").tocsr()
+            neighbors = sparse.load_npz(root / "neighbors.npz").tocsr()
+        except (OSError, ValueError, KeyError) as exc:
+            print(f"[Cooccurrence] Bỏ qua mô hình hỏng tại {root}: {exc}")
+            return None
+        saved_top_n = int(meta.get("topN", DEFAULT_TOP_N))
+        top_n = top_n or saved_top_n
+        return cls(
+            item_ids,
+            profile_keys,
+            interactions,
+            counts,
+            top_n,
+            neighbors if top_n == saved_top_n else None,
+        )
+
+
+def synthetic_profiles(
+    n_profiles: int, n_items: int, items_per_profile: int, seed: int = 13
+) -> Dict[str, Dict[str, float]]:
+    """Profile tổng hợp: sách chọn theo phân phối Zipf (vài sách rất phổ biến, đuôi dài)."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, n_items + 1) ** 0.8
+    weights /= weights.sum()
+    sizes = rng.integers(1, 2 * items_per_profile, size=n_profiles)
+    books = (rng.choice(n_items, size=int(sizes.sum()), p=weights) + 1).tolist()
+    profiles: Dict[str, Dict[str, float]] = {}
+    start = 0
+    for row, size in enumerate(sizes.tolist()):
+        profiles[f"user:{row}"] = {str(book): 1.0 for book in books[start : start + size]}
+        start += size
+    return profiles
+
+
+def run_benchmark(
+    n_profiles: int, n_items: int, items_per_profile: int, changed_fraction: float, top_n: int
+) -> Dict[str, Any]:
+    """Thời gian build đầy đủ so với cập nhật tăng dần khi một phần profile có sự kiện mới."""
+    profiles = synthetic_profiles(n_profiles, n_items, items_per_profile)
+    started = time.perf_counter()
+    model = CooccurrenceModel.build(profiles, top_n)
+    build_seconds = time.perf_counter() - started
+
+    changed = synthetic_profiles(int(n_profiles * changed_fraction), n_items, items_per_profile, seed=29)
+    started = time.perf_counter()
+    stats = model.update(changed)
+    update_seconds = time.perf_counter() - started
+
+    # Đối chiếu với build lại từ đầu trên cùng dữ liệu (phải trùng khớp)
+    rebuilt = CooccurrenceModel.build({**profiles, **changed}, top_n)
+    drift = abs(rebuilt.aligned(model.item_ids) - model.neighbors).max() if model.neighbors.nnz else 0.0
+    return {
+        "profiles": n_profiles,
+        "items": n_items,
+        "interactions": int(model.interactions.nnz),
+        "counts": int(model.counts.nnz),
+        "buildSeconds": round(build_seconds, 3),
+        "updateSeconds": round(update_seconds, 3),
+        "profilesChanged": stats["profilesChanged"],
+        "maxDriftVsRebuild": float(drift),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mô hình đồng xuất hiện trên dữ liệu tổng hợp.")
+    parser.add_argument("--profiles", type=int, default=200_000)
+    parser.add_argument("--items", type=int, default=50_000)
+    parser.add_argument("--items-per-profile", type=int, default=8)
+    parser.add_argument("--changed-fraction", type=float, default=0.01)
+    parser.add_argument("--top-n", type=int, default=DEFAULT_TOP_N)
+    args = parser.parse_args()
+    report = run_benchmark(args.profiles, args.items, args.items_per_profile, args.changed_fraction, args.top_n)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+__all__ = [
+    "CooccurrenceModel",
+    "interaction_matrix",
+    "top_n_cosine",
+    "DEFAULT_MODEL_DIR",
+    "DEFAULT_TOP_N",
+]
+
+
+if __name__ == "__main__":
+    main()
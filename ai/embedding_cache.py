@@ -0,0 +1,121 @@
+"""
+Cache embedding sách trên đĩa, định danh theo nội dung.
+
+Mỗi vector được gắn với khoá sha1(model_name + văn bản render từ metadata sách), nên
+chỉ những sách mới hoặc đã đổi metadata mới phải encode lại qua SentenceTransformer.
+Bố cục thư mục cache (mỗi model một thư mục con):
+    <cache_dir>/<model>/embeddings.npy   ma trận float32 (N × d), đọc bằng memory-map
+    <cache_dir>/<model>/keys.npy         khoá nội dung (S40) theo đúng thứ tự hàng
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = "ai/models/embedding_cache"
+
+
+def content_key(model_name: str, text: str) -> bytes:
+    """Khoá nội dung của một văn bản dưới một model cụ thể."""
+    digest = hashlib.sha1(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+    return digest.encode("ascii")
+
+
+class EmbeddingCache:
+    """Cache embedding dạng `.npy` memory-map kèm file khoá đi kèm."""
+
+    def __init__(self, cache_dir: str | os.PathLike, model_name: str):
+        self.model_name = model_name
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "__", model_name)
+        self.path = Path(cache_dir) / slug
+        self.hits = 0
+        self.misses = 0
+        self._keys: Optional[np.ndarray] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._positions: Dict[bytes, int] = {}
+        self._load()
+
+    @property
+    def _vectors_file(self) -> Path:
+        return self.path / "embeddings.npy"
+
+    @property
+    def _keys_file(self) -> Path:
+        return self.path / "keys.npy"
+
+    def _load(self) -> None:
+        if not (self._vectors_file.exists() and self._keys_file.exists()):
+            return
+        try:
+            keys = np.load(self._keys_file)
+            vectors = np.load(self._vectors_file, mmap_mode="r")
+        except (OSError, ValueError) as exc:
+            print(f"[EmbeddingCache] Bỏ qua cache hỏng tại {self.path}: {exc}")
+            return
+        if len(keys) != len(vectors):
+            print(f"[EmbeddingCache] Số khoá và số vector không khớp tại {self.path}, bỏ qua cache.")
+            return
+        self._keys = keys
+        self._vectors = vectors
+        self._positions = {bytes(key): idx for idx, key in enumerate(keys)}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def lookup(self, keys: Sequence[bytes]) -> Tuple[List[int], List[int]]:
+        """
+        Tách danh sách khoá thành (vị trí trong cache hoặc -1, danh sách chỉ số bị miss).
+        Đồng thời cập nhật bộ đếm hit/miss.
+        """
+        positions = [self._positions.get(key, -1) for key in keys]
+        missing = [idx for idx, pos in enumerate(positions) if pos < 0]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return positions, missing
+
+    @property
+    def matrix(self) -> Optional[np.ndarray]:
+        """Toàn bộ ma trận vector đã cache (memory-map chỉ đọc)."""
+        return self._vectors
+
+    def vectors(self, positions: Sequence[int]) -> np.ndarray:
+        """Đọc các vector đã cache theo vị trí hàng."""
+        return np.asarray(self._vectors[np.asarray(positions, dtype=np.int64)], dtype=np.float32)
+
+    def save(self, keys: Sequence[bytes], vectors: np.ndarray) -> None:
+        """
+        Ghi lại cache chỉ gồm các khoá đang dùng (các bản cũ của sách đã đổi metadata
+        tự bị loại). Ghi ra file tạm rồi os.replace để không làm hỏng cache đang đọc.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        key_array = np.asarray(list(keys), dtype="S40")
+        vector_array = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        tmp_vectors = self._vectors_file.with_suffix(".tmp.npy")
+        tmp_keys = self._keys_file.with_suffix(".tmp.npy")
+        np.save(tmp_vectors, vector_array)
+        np.save(tmp_keys, key_array)
+        # Đóng memory-map cũ trước khi thay file (cần thiết trên Windows)
+        self._vectors = None
+        os.replace(tmp_vectors, self._vectors_file)
+        os.replace(tmp_keys, self._keys_file)
+        self._load()
+
+    def is_current(self, keys: Sequence[bytes]) -> bool:
+        """True nếu cache chứa đúng và chỉ đúng tập khoá này (không cần ghi lại)."""
+        return self._keys is not None and len(self._keys) == len(keys) and all(
+            key in self._positions for key in keys
+        )
+
+    def stats(self) -> Dict[str, object]:
+        return {"path": str(self.path), "hits": self.hits, "misses": self.misses}
+
+
+__all__ = ["EmbeddingCache", "content_key", "DEFAULT_CACHE_DIR"]
@@ -8,16 +8,31 @@ trước đây chỉ dùng heuristic/LLM fallback.
 
 from __future__ import annotations
 
+import hashlib
+import importlib
+import os
 from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Set
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Set
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from scipy import sparse
+
+from ann_index import build_ann_index
+from embedding_cache import EmbeddingCache, content_key
+from profile_store import ProfileStore
 
 
 DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L12-v2"
 
+# Bộ nhớ tạm cho mỗi khối rerank_profile_block (MB) và số byte mỗi ô profile × sách:
+# ma trận similarity float32 (4); top-N được chọn từng hàng nên không cần thêm mảng chỉ số,
+# điểm đồng xuất hiện giữ dạng thưa và chỉ được tra cho các ứng viên
+DEFAULT_RERANK_MEMORY_MB = 256
+_RERANK_BYTES_PER_CELL = 4
+
 
 def _render_book_text(meta: Dict) -> str:
     """
@@ -48,12 +63,32 @@ def _render_book_text(meta: Dict) -> str:
 class EmbeddingIndex:
     model_name: str = DEFAULT_MODEL_NAME
     batch_size: int = 64
+    cache: Optional[EmbeddingCache] = None
+    ann_backend: str = "exact"
+    ann_nprobe: int = 8
 
     def __post_init__(self):
-        self.model = SentenceTransformer(self.model_name)
+        self._model: Any = None
         self.book_ids: List[int] = []
         self.embeddings: Optional[np.ndarray] = None
         self._id_to_idx: Dict[int, int] = {}
+        self._content_keys: Optional[List[bytes]] = None
+        self.ann: Any = None
+
+    @property
+    def model(self) -> Any:
+        """
+        SentenceTransformer chỉ được import (kéo theo torch) và khởi tạo khi thật sự
+        có văn bản cần encode, ví dụ cache không có sẵn embedding.
+        """
+        if self._model is None:
+            sentence_transformers = importlib.import_module("sentence_transformers")
+            self._model = sentence_transformers.SentenceTransformer(self.model_name)
+        return self._model
+
+    @property
+    def model_loaded(self) -> bool:
+        return self._model is not None
 
     def build(self, book_meta: Dict[int, Dict]) -> None:
         """Sinh vector embedding cho toàn bộ sách dựa trên metadata truyền vào."""
@@ -79,7 +114,29 @@ class EmbeddingIndex:
             self._id_to_idx = {}
             return
 
-        embeddings = self.model.encode(
+        if self.cache is None:
+            embeddings = self._encode(texts)
+        else:
+            embeddings = self._encode_with_cache(texts)
+
+        self.book_ids = book_ids
+        self.embeddings = embeddings
+        self._id_to_idx = {pid: idx for idx, pid in enumerate(book_ids)}
+
+        # ANN index được lưu cạnh cache và dùng lại khi thứ tự khoá nội dung không đổi
+        fingerprint = None
+        if self._content_keys is not None:
+            fingerprint = hashlib.sha1(b"\n".join(self._content_keys)).hexdigest()
+        self.ann = build_ann_index(
+            embeddings,
+            self.ann_backend,
+            nprobe=self.ann_nprobe,
+            persist_dir=self.cache.path if self.cache is not None else None,
+            fingerprint=fingerprint,
+        )
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(
             texts,
             batch_size=self.batch_size,
             convert_to_numpy=True,
@@ -87,9 +144,28 @@ class EmbeddingIndex:
             show_progress_bar=len(texts) >= self.batch_size,
         )
 
-        self.book_ids = book_ids
-        self.embeddings = embeddings
-        self._id_to_idx = {pid: idx for idx, pid in enumerate(book_ids)}
+    def _encode_with_cache(self, texts: List[str]) -> np.ndarray:
+        """Chỉ encode các sách chưa có trong cache (theo khoá nội dung), phần còn lại đọc từ đĩa."""
+        keys = [content_key(self.model_name, text) for text in texts]
+        self._content_keys = keys
+        positions, missing = self.cache.lookup(keys)
+
+        if not missing and len(self.cache) == len(keys) and positions == list(range(len(keys))):
+            # Cache khớp đúng thứ tự hiện tại -> dùng thẳng memory-map, không cần sao chép
+            return self.cache.matrix
+
+        encoded = self._encode([texts[idx] for idx in missing]) if missing else None
+        dim = encoded.shape[1] if encoded is not None else self.cache.matrix.shape[1]
+        embeddings = np.empty((len(texts), dim), dtype=np.float32)
+        cached = [idx for idx, pos in enumerate(positions) if pos >= 0]
+        if cached:
+            embeddings[cached] = self.cache.vectors([positions[idx] for idx in cached])
+        if encoded is not None:
+            embeddings[missing] = encoded
+
+        if not self.cache.is_current(keys):
+            self.cache.save(keys, embeddings)
+        return embeddings
 
     def get_vector(self, product_id: int) -> Optional[np.ndarray]:
         """Lấy embedding của một sách theo product_id (nếu đã được build)."""
@@ -108,61 +184,122 @@ class EmbeddingIndex:
         if not score_map or self.embeddings is None:
             return None
 
-        aggregate = np.zeros(self.embeddings.shape[1], dtype=np.float32)
-        weight_sum = 0.0
-
+        cols: List[int] = []
+        weights: List[float] = []
         for book_id_str, score in score_map.items():
             try:
                 pid = int(book_id_str)
             except (TypeError, ValueError):
                 continue
-            vec = self.get_vector(pid)
-            if vec is None:
+            col = self._id_to_idx.get(pid)
+            if col is None:
                 continue
             weight = float(score)
             if not np.isfinite(weight) or weight <= 0:
                 continue
-            aggregate += weight * vec
-            weight_sum += weight
-
-        if weight_sum <= 0 or not np.any(aggregate):
-            return None
-
-        norm = np.linalg.norm(aggregate)
-        if norm == 0:
-            return None
-        return aggregate / norm
+            cols.append(col)
+            weights.append(weight)
+        return _weighted_user_vector(self.embeddings, cols, weights)
+
+    def indices_for(self, product_ids: Iterable[int]) -> np.ndarray:
+        """Chỉ số hàng embedding (mảng int64) của các product_id có trong index."""
+        lookup = self._id_to_idx
+        return np.fromiter(
+            (lookup[pid] for pid in product_ids if pid in lookup),
+            dtype=np.int64,
+        )
 
     def query_similar(
         self,
         vector: np.ndarray,
         top_n: int,
         exclude_ids: Optional[Set[int]] = None,
+        exclude_indices: Optional[np.ndarray] = None,
     ) -> List[Tuple[int, float]]:
         """
         Tìm danh sách sách tương tự nhất theo cosine similarity.
-        Có thể loại bỏ trước các ID đã xuất hiện để tránh trùng.
+        Các sách bị loại (exclude_ids hoặc sẵn mảng chỉ số exclude_indices) được che trong
+        vector similarity trước khi chọn top-N, nên luôn nhận đủ top_n ứng viên mới
+        (trừ khi catalog không còn đủ sách). Kết quả xếp theo (-similarity, chỉ số sách)
+        với similarity tính lại bằng _exact_similarity, xem _top_neighbors.
         """
         if self.embeddings is None or vector is None:
             return []
-        exclude_ids = exclude_ids or set()
-
-        sims = self.embeddings @ vector
-        if top_n >= len(sims):
-            candidate_indices = np.argsort(sims)[::-1]
+        if exclude_indices is None:
+            exclude_indices = self.indices_for(int(pid) for pid in (exclude_ids or ()))
+
+        if self.ann is not None:
+            # ANN không che trước được -> lấy dư đúng bằng số sách bị loại rồi lọc
+            ann_sims, ann_indices = self.ann.search(vector, top_n + len(exclude_indices))
+            candidate_indices, candidate_sims = _rank_ann_neighbors(
+                ann_indices[0], exclude_indices, top_n, self.embeddings, vector
+            )
         else:
-            candidate_indices = np.argpartition(sims, -top_n)[-top_n:]
-            candidate_indices = candidate_indices[np.argsort(sims[candidate_indices])[::-1]]
+            sims = self.embeddings @ vector
+            sims[exclude_indices] = -np.inf
+            candidate_indices, candidate_sims = _top_neighbors(sims, top_n, self.embeddings, vector)
 
-        results: List[Tuple[int, float]] = []
-        for idx in candidate_indices:
-            pid = self.book_ids[idx]
-            if pid in exclude_ids:
-                continue
-            results.append((pid, float(sims[idx])))
-            if len(results) >= top_n:
-                break
-        return results
+        return [
+            (self.book_ids[idx], sim)
+            for idx, sim in zip(candidate_indices.tolist(), candidate_sims.tolist())
+        ]
+
+
+def _weighted_user_vector(embeddings: np.ndarray, cols: Sequence[int], weights: Sequence[float]) -> Optional[np.ndarray]:
+    """
+    Trung bình có trọng số các hàng `cols` (cộng float64 theo đúng thứ tự truyền vào), chuẩn hoá
+    rồi đưa về float32. Vòng lặp từng profile và rerank_profile_block cùng dùng hàm này nên
+    nhận đúng cùng một vector người dùng.
+    """
+    if not len(cols):
+        return None
+    rows = np.asarray(embeddings[np.asarray(cols, dtype=np.int64)], dtype=np.float64)
+    aggregate = (np.asarray(weights, dtype=np.float64)[:, None] * rows).sum(axis=0)
+    norm = np.linalg.norm(aggregate)
+    if not np.isfinite(norm) or norm == 0:
+        return None
+    return (aggregate / norm).astype(np.float32)
+
+
+def _exact_similarity(embeddings: np.ndarray, cols: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity float64 giữa `vector` và các hàng `cols`. Mỗi giá trị chỉ phụ thuộc vào
+    hàng của nó (không như GEMM/GEMV float32, kết quả đổi theo cách chia khối), nên cùng một
+    cặp (người dùng, sách) luôn cho cùng một số ở mọi đường tính.
+    """
+    rows = np.asarray(embeddings[cols], dtype=np.float64)
+    return (rows * np.asarray(vector, dtype=np.float64)).sum(axis=1)
+
+
+def _top_neighbors(
+    approx: np.ndarray, limit: int, embeddings: np.ndarray, vector: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-`limit` (chỉ số, similarity) theo (-similarity, chỉ số) từ vector similarity xấp xỉ
+    `approx` (float32, sách bị loại = -inf). Sai số float32 làm các sách hoà điểm (embedding
+    trùng) đổi chỗ giữa GEMM và GEMV, nên mọi sách trong khoảng sai số dưới giá trị thứ `limit`
+    được tính lại bằng _exact_similarity rồi mới sắp xếp và cắt.
+    """
+    limit = min(limit, int(np.count_nonzero(approx > -np.inf)))
+    if limit <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    # Tích vô hướng float32 của hai vector đơn vị sai không quá dim * eps / 2
+    margin = 2 * embeddings.shape[1] * float(np.finfo(np.float32).eps)
+    kth = np.partition(approx, -limit)[-limit]
+    pool = np.flatnonzero(approx >= kth - margin)
+    exact = _exact_similarity(embeddings, pool, vector)
+    order = np.lexsort((pool, -exact))[:limit]
+    return pool[order], exact[order]
+
+
+def _rank_ann_neighbors(
+    neighbors: np.ndarray, exclude: np.ndarray, limit: int, embeddings: np.ndarray, vector: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Kết quả ANN ngoài `exclude`, tính lại similarity và xếp theo (-similarity, chỉ số) như _top_neighbors."""
+    neighbors = neighbors[(neighbors >= 0) & ~np.isin(neighbors, exclude)]
+    exact = _exact_similarity(embeddings, neighbors, vector)
+    order = np.lexsort((neighbors, -exact))[:limit]
+    return neighbors[order], exact[order]
 
 
 def normalize_popularity(raw_popularity: Dict[int, float]) -> Dict[int, float]:
@@ -178,39 +315,92 @@ def normalize_popularity(raw_popularity: Dict[int, float]) -> Dict[int, float]:
     return {int(k): float(v) / max_value for k, v in raw_popularity.items()}
 
 
+def cooccurrence_scores(weight_matrix: sparse.csr_matrix, cooccurrence: sparse.csr_matrix) -> sparse.csr_matrix:
+    """
+    Điểm đồng xuất hiện (profile × sách) trong [0,1]: điểm hành vi chuẩn hoá theo max của
+    hàng nhân ma trận láng giềng item-item (căn theo index.book_ids), rồi chia max của hàng.
+    """
+    row_max = np.asarray(weight_matrix.max(axis=1).todense()).ravel() if weight_matrix.nnz else np.zeros(weight_matrix.shape[0])
+    inverse = np.divide(1.0, row_max, out=np.zeros(len(row_max)), where=row_max > 0)
+    scores = (sparse.diags(inverse, format="csr") @ weight_matrix @ cooccurrence).tocsr()
+    scores.eliminate_zeros()
+    if scores.nnz:
+        score_max = np.asarray(scores.max(axis=1).todense()).ravel()
+        scale = np.divide(1.0, score_max, out=np.zeros(len(score_max)), where=score_max > 0)
+        scores = (sparse.diags(scale, format="csr") @ scores).tocsr()
+    return scores
+
+
+def _cooccurrence_neighbors(cols: np.ndarray, values: np.ndarray, exclude: np.ndarray, limit: int) -> np.ndarray:
+    """Các cột có điểm đồng xuất hiện cao nhất ngoài `exclude` (hoà: cột nhỏ trước)."""
+    keep = ~np.isin(cols, exclude)
+    cols, values = cols[keep], values[keep]
+    return cols[np.lexsort((cols, -values))][:limit]
+
+
 def rerank_profiles_with_embeddings(
     profiles: Dict[str, Dict[str, float]],
     *,
     book_meta: Dict[int, Dict],
-    book_popularity: Dict[int, float],
+    book_popularity: Dict[int, float] | np.ndarray,
     top_k: int,
     weights: Optional[Dict[str, float]] = None,
     model_name: str = DEFAULT_MODEL_NAME,
     neighbor_multi: float = 1.5,
+    block_size: int = 0,
+    index: Optional[EmbeddingIndex] = None,
+    cooccurrence: Optional[sparse.csr_matrix] = None,
 ) -> Dict[str, OrderedDict]:
     """
     Áp dụng rerank: mở rộng tập ứng viên bằng sách tương tự rồi tính điểm tổng hợp
     giữa hành vi, embedding và độ phổ biến.
+    Với `cooccurrence` (ma trận láng giềng item-item căn theo index.book_ids, xem
+    CooccurrenceModel.aligned), các sách hay đi cùng sách của profile được thêm làm ứng viên
+    và điểm đồng xuất hiện được cộng với trọng số weights["cooccurrence"].
+    Với block_size > 0, các profile được xử lý theo khối dạng ma trận
+    (xem rerank_profile_block) thay vì từng profile một.
+    Có thể truyền sẵn `index` đã build (ví dụ có cache) để không phải encode lại catalog.
+    `book_popularity` là dict tổng điểm thô {product_id: tổng} (sẽ được chuẩn hoá min-max),
+    hoặc mảng đã chuẩn hoá căn theo `index.book_ids` (xem compute_popularity_array).
     """
     if not profiles:
         return {}
 
-    index = EmbeddingIndex(model_name=model_name)
-    index.build(book_meta)
+    if index is None:
+        index = EmbeddingIndex(model_name=model_name)
+        index.build(book_meta)
 
     if index.embeddings is None or not index.book_ids:
         # No embeddings available -> return original profiles unchanged
         return {key: OrderedDict(score_map) for key, score_map in profiles.items()}
 
     weights = weights or {"behavior": 0.6, "embedding": 0.3, "popularity": 0.1}
+    pop_by_col, pop_extra = _popularity_by_column(book_popularity, index)
+    neighbor_limit = max(top_k, int(top_k * neighbor_multi))
+    result: Dict[str, OrderedDict] = {}
+
+    if block_size > 0:
+        keys = list(profiles.keys())
+        for offset in range(0, len(keys), block_size):
+            block = {key: profiles[key] for key in keys[offset : offset + block_size]}
+            result.update(
+                rerank_profile_block(
+                    block,
+                    index=index,
+                    popularity=pop_by_col,
+                    popularity_extra=pop_extra,
+                    top_k=top_k,
+                    neighbor_limit=neighbor_limit,
+                    weights=weights,
+                    cooccurrence=cooccurrence,
+                )
+            )
+        return result
+
     w_behavior = float(weights.get("behavior", 0.0))
     w_embedding = float(weights.get("embedding", 0.0))
     w_popularity = float(weights.get("popularity", 0.0))
-
-    pop_normalized = normalize_popularity(book_popularity)
-    result: Dict[str, OrderedDict] = {}
-
-    neighbor_limit = max(top_k, int(top_k * neighbor_multi))
+    w_cooccurrence = float(weights.get("cooccurrence", 0.0))
 
     for profile_key, score_map in profiles.items():
         candidate_scores: Dict[str, float] = dict(score_map)
@@ -219,20 +409,47 @@ def rerank_profiles_with_embeddings(
         except Exception:
             user_vec = None
 
-        exclude_ids: Set[int] = set()
+        exclude_pids: List[int] = []
         for pid_str in candidate_scores.keys():
             try:
-                exclude_ids.add(int(pid_str))
+                exclude_pids.append(int(pid_str))
             except (TypeError, ValueError):
                 continue
 
         if user_vec is not None:
-            similar_items = index.query_similar(user_vec, neighbor_limit, exclude_ids=exclude_ids)
+            similar_items = index.query_similar(
+                user_vec,
+                neighbor_limit,
+                exclude_indices=index.indices_for(exclude_pids),
+            )
             for pid, sim in similar_items:
                 candidate_scores.setdefault(str(pid), 0.0)
         else:
             similar_items = []
 
+        co_by_col: Dict[int, float] = {}
+        if cooccurrence is not None:
+            own_cols: List[int] = []
+            own_weights: List[float] = []
+            for pid_str, score in score_map.items():
+                try:
+                    col = index._id_to_idx.get(int(pid_str))
+                except (TypeError, ValueError):
+                    continue
+                weight = float(score)
+                if col is not None and np.isfinite(weight) and weight > 0:
+                    own_cols.append(col)
+                    own_weights.append(weight)
+            weight_row = sparse.csr_matrix(
+                (np.asarray(own_weights, dtype=np.float32), ([0] * len(own_cols), own_cols)),
+                shape=(1, len(index.book_ids)),
+            )
+            co_row = cooccurrence_scores(weight_row, cooccurrence)
+            present = index.indices_for(int(pid_str) for pid_str in candidate_scores)
+            for col in _cooccurrence_neighbors(co_row.indices, co_row.data, present, neighbor_limit):
+                candidate_scores.setdefault(str(index.book_ids[col]), 0.0)
+            co_by_col = dict(zip(co_row.indices.tolist(), co_row.data.tolist()))
+
         if not candidate_scores:
             result[profile_key] = OrderedDict()
             continue
@@ -240,31 +457,42 @@ def rerank_profiles_with_embeddings(
         behavior_values = [float(v) for v in candidate_scores.values() if np.isfinite(v)]
         max_behavior = max(behavior_values) if behavior_values else 0.0
 
-        ranked_items: List[Tuple[str, float]] = []
-
+        candidates: List[Tuple[str, int, float]] = []
         for pid_str, base_score in candidate_scores.items():
             try:
-                pid = int(pid_str)
+                candidates.append((pid_str, int(pid_str), base_score))
             except (TypeError, ValueError):
                 continue
 
+        similarity_by_col: Dict[int, float] = {}
+        if user_vec is not None:
+            known = index.indices_for(pid for _pid_str, pid, _score in candidates)
+            similarity_by_col = dict(
+                zip(known.tolist(), _exact_similarity(index.embeddings, known, user_vec).tolist())
+            )
+
+        ranked_items: List[Tuple[str, float]] = []
+
+        for pid_str, pid, base_score in candidates:
             norm_behavior = (
                 float(base_score) / max_behavior if max_behavior > 0 else 0.0
             )
 
-            embed_vec = index.get_vector(pid)
-            if user_vec is not None and embed_vec is not None:
-                similarity = float(np.clip(np.dot(user_vec, embed_vec), -1.0, 1.0))
+            col = index._id_to_idx.get(pid)
+            if col is not None and col in similarity_by_col:
+                similarity = min(max(similarity_by_col[col], -1.0), 1.0)
                 norm_embed = (similarity + 1.0) / 2.0
             else:
                 norm_embed = 0.0
 
-            norm_pop = pop_normalized.get(pid, 0.0)
+            norm_pop = float(pop_by_col[col]) if col is not None else pop_extra.get(pid, 0.0)
+            norm_co = co_by_col.get(col, 0.0) if col is not None else 0.0
 
             final_score = (
                 w_behavior * norm_behavior
                 + w_embedding * norm_embed
                 + w_popularity * norm_pop
+                + w_cooccurrence * norm_co
             )
 
             ranked_items.append((pid_str, final_score))
@@ -281,11 +509,218 @@ def rerank_profiles_with_embeddings(
     return result
 
 
-def aggregate_book_popularity(raw_scores: Dict[str, Dict[str, float]]) -> Dict[int, float]:
+def rerank_block_size(n_books: int, memory_mb: float = DEFAULT_RERANK_MEMORY_MB) -> int:
+    """
+    Số profile mỗi khối sao cho ma trận tạm profile × sách của rerank_profile_block nằm trong
+    `memory_mb`. Khối lớn hơn gộp được nhiều profile vào một GEMM (nhanh hơn) nhưng tốn bộ nhớ
+    tỉ lệ thuận; catalog 1 triệu sách với 256 MB cho khối ~67 profile.
+    """
+    return max(1, int(memory_mb * 1024 * 1024) // (max(1, n_books) * _RERANK_BYTES_PER_CELL))
+
+
+def rerank_profile_block(
+    profiles: Dict[str, Dict[str, float]],
+    *,
+    index: EmbeddingIndex,
+    popularity: np.ndarray,
+    top_k: int,
+    neighbor_limit: int,
+    weights: Dict[str, float],
+    popularity_extra: Optional[Dict[int, float]] = None,
+    cooccurrence: Optional[sparse.csr_matrix] = None,
+) -> Dict[str, OrderedDict]:
+    """
+    Rerank một khối profile bằng phép toán ma trận, cho kết quả như vòng lặp từng profile:
+      - Vector người dùng của từng hàng như EmbeddingIndex.user_vector.
+      - Độ tương đồng với toàn bộ sách = một phép GEMM, top-N theo từng hàng bằng _top_neighbors
+        (hoà điểm xếp theo chỉ số sách, giống query_similar).
+      - Điểm hành vi/embedding/phổ biến được ghép thành mảng (profile × ứng viên); similarity
+        của ứng viên tính bằng _exact_similarity như vòng lặp.
+    Bộ nhớ tạm tỉ lệ với len(profiles) × số sách nên nên giới hạn kích thước khối.
+    `popularity` là độ phổ biến đã chuẩn hoá căn theo `index.book_ids`; `popularity_extra`
+    giữ giá trị cho các sách không có trong index (nếu có). `cooccurrence` như ở
+    rerank_profiles_with_embeddings: điểm đồng xuất hiện của cả khối là một phép nhân thưa.
+    """
+    embeddings = index.embeddings
+    keys = list(profiles.keys())
+    n_rows = len(keys)
+    n_books = len(index.book_ids)
+
+    # 1) Danh sách ứng viên gốc của từng profile (theo thứ tự chèn) và ma trận trọng số thưa
+    base_pids: List[List[int]] = []
+    base_scores: List[List[float]] = []
+    weight_rows: List[int] = []
+    weight_cols: List[int] = []
+    weight_values: List[float] = []
+    exclude_rows: List[int] = []
+    exclude_cols: List[int] = []
+    for row, key in enumerate(keys):
+        pids: List[int] = []
+        scores: List[float] = []
+        for pid_str, score in profiles[key].items():
+            try:
+                pid = int(pid_str)
+            except (TypeError, ValueError):
+                continue
+            pids.append(pid)
+            scores.append(float(score))
+            col = index._id_to_idx.get(pid)
+            if col is not None:
+                exclude_rows.append(row)
+                exclude_cols.append(col)
+            weight = float(score)
+            if col is not None and np.isfinite(weight) and weight > 0:
+                weight_rows.append(row)
+                weight_cols.append(col)
+                weight_values.append(weight)
+        base_pids.append(pids)
+        base_scores.append(scores)
+
+    weight_matrix = sparse.csr_matrix(
+        (np.asarray(weight_values, dtype=np.float32), (weight_rows, weight_cols)),
+        shape=(n_rows, n_books),
+    )
+    user_matrix = np.zeros((n_rows, embeddings.shape[1]), dtype=np.float32)
+    has_vector = np.zeros(n_rows, dtype=bool)
+    row_bounds = np.searchsorted(weight_rows, np.arange(n_rows + 1))
+    for row in range(n_rows):
+        start, end = row_bounds[row], row_bounds[row + 1]
+        vector = _weighted_user_vector(embeddings, weight_cols[start:end], weight_values[start:end])
+        if vector is not None:
+            user_matrix[row] = vector
+            has_vector[row] = True
+
+    # 2) Một phép GEMM cho cả khối, che các sách đã có rồi chọn top-N mỗi hàng
+    #    (hoặc hỏi ANN index, lấy dư bằng số sách bị loại nhiều nhất trong khối rồi cắt
+    #    mỗi hàng về đúng số kết quả mà query_similar sẽ hỏi)
+    excluded_per_row = np.bincount(exclude_rows, minlength=n_rows)
+    neighbor_lists: List[np.ndarray] = [np.empty(0, dtype=np.int64)] * n_rows
+    if index.ann is not None:
+        _, neighbor_idx = index.ann.search(user_matrix, neighbor_limit + int(excluded_per_row.max(initial=0)))
+        exclude_bounds = np.searchsorted(exclude_rows, np.arange(n_rows + 1))
+        for row in np.flatnonzero(has_vector).tolist():
+            excluded = np.asarray(exclude_cols[exclude_bounds[row] : exclude_bounds[row + 1]], dtype=np.int64)
+            neighbor_lists[row], _ = _rank_ann_neighbors(
+                neighbor_idx[row][: neighbor_limit + len(excluded)],
+                excluded,
+                neighbor_limit,
+                embeddings,
+                user_matrix[row],
+            )
+    else:
+        sims = user_matrix @ embeddings.T
+        sims[exclude_rows, exclude_cols] = -np.inf
+        for row in np.flatnonzero(has_vector).tolist():
+            neighbor_lists[row], _ = _top_neighbors(sims[row], neighbor_limit, embeddings, user_matrix[row])
+        del sims
+
+    co_scores = cooccurrence_scores(weight_matrix, cooccurrence) if cooccurrence is not None else None
+    if co_scores is not None:
+        co_scores.sort_indices()
+
+    # 3) Ghép ứng viên: sách gốc + sách tương tự (bỏ trùng), dạng mảng đệm (profile × width)
+    width = max((len(pids) for pids in base_pids), default=0) + min(neighbor_limit, n_books)
+    if co_scores is not None:
+        width += min(neighbor_limit, n_books)
+    cand_cols = np.full((n_rows, width), -1, dtype=np.int64)
+    cand_pids = np.zeros((n_rows, width), dtype=np.int64)
+    cand_base = np.zeros((n_rows, width), dtype=np.float64)
+    cand_pop = np.zeros((n_rows, width), dtype=np.float64)
+    cand_valid = np.zeros((n_rows, width), dtype=bool)
+    cand_co = np.zeros((n_rows, width), dtype=np.float64) if co_scores is not None else None
+    book_ids = np.asarray(index.book_ids, dtype=np.int64)
+    pop_by_col = np.asarray(popularity, dtype=np.float64)
+    popularity_extra = popularity_extra or {}
+
+    for row in range(n_rows):
+        pids = base_pids[row]
+        count = len(pids)
+        if count:
+            cand_pids[row, :count] = pids
+            cand_base[row, :count] = base_scores[row]
+            cols = [index._id_to_idx.get(pid, -1) for pid in pids]
+            cand_cols[row, :count] = cols
+            cand_pop[row, :count] = [
+                pop_by_col[col] if col >= 0 else popularity_extra.get(pid, 0.0)
+                for pid, col in zip(pids, cols)
+            ]
+            cand_valid[row, :count] = True
+        if has_vector[row]:
+            fresh = neighbor_lists[row]
+            cand_cols[row, count : count + len(fresh)] = fresh
+            cand_pids[row, count : count + len(fresh)] = book_ids[fresh]
+            cand_pop[row, count : count + len(fresh)] = pop_by_col[fresh]
+            cand_valid[row, count : count + len(fresh)] = True
+            count += len(fresh)
+        if co_scores is not None:
+            start, end = co_scores.indptr[row], co_scores.indptr[row + 1]
+            present = cand_cols[row, :count]
+            fresh = _cooccurrence_neighbors(
+                co_scores.indices[start:end], co_scores.data[start:end], present[present >= 0], neighbor_limit
+            )
+            cand_cols[row, count : count + len(fresh)] = fresh
+            cand_pids[row, count : count + len(fresh)] = book_ids[fresh]
+            cand_pop[row, count : count + len(fresh)] = pop_by_col[fresh]
+            cand_valid[row, count : count + len(fresh)] = True
+            count += len(fresh)
+            # Điểm đồng xuất hiện chỉ lấy cho các ứng viên, tra trong hàng thưa (cột đã sắp xếp)
+            co_cols, co_values = co_scores.indices[start:end], co_scores.data[start:end]
+            if len(co_cols):
+                cols = cand_cols[row, :count]
+                pos = np.minimum(np.searchsorted(co_cols, cols), len(co_cols) - 1)
+                hit = (cols >= 0) & (co_cols[pos] == cols)
+                cand_co[row, :count][hit] = co_values[pos[hit]]
+
+    # 4) Tổng hợp điểm dạng vector
+    finite_base = np.where(cand_valid & np.isfinite(cand_base), cand_base, -np.inf)
+    max_behavior = finite_base.max(axis=1, initial=-np.inf)
+    max_behavior = np.where(np.isfinite(max_behavior), max_behavior, 0.0)
+    safe_max = np.where(max_behavior > 0, max_behavior, 1.0)
+    norm_behavior = np.where(max_behavior[:, None] > 0, cand_base / safe_max[:, None], 0.0)
+
+    in_index = cand_cols >= 0
+    similarity = np.zeros((n_rows, width), dtype=np.float64)
+    for row in np.flatnonzero(has_vector).tolist():
+        slots = np.flatnonzero(in_index[row])
+        similarity[row, slots] = _exact_similarity(embeddings, cand_cols[row, slots], user_matrix[row])
+    norm_embed = np.where(
+        in_index & has_vector[:, None],
+        (np.clip(similarity, -1.0, 1.0) + 1.0) / 2.0,
+        0.0,
+    )
+
+    final = (
+        float(weights.get("behavior", 0.0)) * norm_behavior
+        + float(weights.get("embedding", 0.0)) * norm_embed
+        + float(weights.get("popularity", 0.0)) * cand_pop
+    )
+    if cand_co is not None:
+        final = final + float(weights.get("cooccurrence", 0.0)) * cand_co
+    final = np.where(cand_valid, final, -np.inf)
+    order = np.argsort(-final, axis=1, kind="stable")[:, :top_k]
+
+    result: Dict[str, OrderedDict] = {}
+    for row, key in enumerate(keys):
+        ordered = OrderedDict()
+        for slot in order[row]:
+            if not cand_valid[row, slot]:
+                break
+            ordered[str(int(cand_pids[row, slot]))] = float(cand_base[row, slot])
+        result[key] = ordered
+    return result
+
+
+def aggregate_book_popularity(
+    raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+) -> Dict[int, float]:
     """
     Tính độ phổ biến toàn cục cho từng sách bằng cách cộng toàn bộ điểm hành vi
-    trên mọi profile.
+    trên mọi profile. Với ProfileStore, tổng theo cột được tính bằng np.bincount.
     """
+    if isinstance(raw_scores, ProfileStore):
+        totals = raw_scores.book_totals()
+        return {int(pid): float(total) for pid, total in zip(raw_scores.book_ids, totals)}
+
     popularity: Dict[int, float] = {}
     for score_map in raw_scores.values():
         for book_id_str, score in score_map.items():
@@ -297,11 +732,209 @@ def aggregate_book_popularity(raw_scores: Dict[str, Dict[str, float]]) -> Dict[i
     return popularity
 
 
+POPULARITY_SCALES = ("linear", "log")
+
+
+def _popularity_by_column(
+    book_popularity: Dict[int, float] | np.ndarray,
+    index: EmbeddingIndex,
+) -> Tuple[np.ndarray, Dict[int, float]]:
+    """
+    Đưa độ phổ biến về (mảng đã chuẩn hoá theo cột của index, dict cho sách ngoài index).
+    Mảng từ compute_popularity_array được dùng nguyên; dict thô được chuẩn hoá như cũ.
+    """
+    if isinstance(book_popularity, np.ndarray):
+        if len(book_popularity) != len(index.book_ids):
+            raise ValueError("Mảng độ phổ biến phải căn theo index.book_ids.")
+        return np.asarray(book_popularity, dtype=np.float64), {}
+    pop_normalized = normalize_popularity(book_popularity)
+    pop_by_col = np.array([pop_normalized.get(pid, 0.0) for pid in index.book_ids], dtype=np.float64)
+    return pop_by_col, pop_normalized
+
+
+def _decay_weights(last_event_seconds: np.ndarray, half_life_days: float, now: datetime) -> np.ndarray:
+    """Hệ số 0.5^(tuổi/half_life) theo lần tương tác cuối; profile chưa có thời gian giữ hệ số 1."""
+    now_seconds = now.replace(tzinfo=now.tzinfo or timezone.utc).timestamp()
+    age_days = np.maximum(now_seconds - last_event_seconds, 0.0) / 86_400.0
+    return np.where(np.isnan(age_days), 1.0, np.exp2(-age_days / half_life_days))
+
+
+def compute_popularity_array(
+    raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+    book_ids: Sequence[int],
+    *,
+    metadata: Optional[Dict[str, Dict]] = None,
+    scale: str = "linear",
+    half_life_days: float = 0.0,
+    now: Optional[datetime] = None,
+) -> np.ndarray:
+    """
+    Độ phổ biến đã chuẩn hoá [0,1] dạng mảng căn theo `book_ids` (thường là index.book_ids),
+    để phần rerank lấy trực tiếp theo chỉ số cột thay vì tra dict.
+
+    - Tổng theo sách được cộng bằng np.bincount trên chỉ số sách đã intern; với dict, mỗi
+      chuỗi product_id chỉ bị int() một lần.
+    - half_life_days > 0: điểm của mỗi profile nhân hệ số suy giảm theo lastEventAt
+      (cần `metadata` với dict; ProfileStore tự có sẵn).
+    - scale="log": dùng log1p(tổng) để giảm ảnh hưởng của vài sách quá nổi.
+    Chuẩn hoá min-max theo giá trị lớn nhất trên mọi sách (cả sách ngoài `book_ids`), giống
+    normalize_popularity; sách trong `book_ids` không có tương tác nhận 0.
+    """
+    total_ids, totals = popularity_totals(
+        raw_scores, metadata=metadata, half_life_days=half_life_days, now=now
+    )
+    return popularity_from_totals(total_ids, totals, book_ids, scale=scale)
+
+
+def popularity_totals(
+    raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+    *,
+    metadata: Optional[Dict[str, Dict]] = None,
+    half_life_days: float = 0.0,
+    now: Optional[datetime] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bước 1 của compute_popularity_array: (product_id, tổng điểm chưa chuẩn hoá) của mọi sách.
+    Tổng của nhiều phần dữ liệu (ví dụ các shard) có thể cộng lại trước khi chuẩn hoá.
+    """
+    now = now or datetime.now(timezone.utc)
+
+    if isinstance(raw_scores, ProfileStore):
+        row_weights = None
+        if half_life_days > 0:
+            row_weights = _decay_weights(raw_scores.last_event_seconds(), half_life_days, now)
+        totals = raw_scores.book_totals(row_weights)
+        total_ids = raw_scores.book_ids
+    else:
+        # Intern chuỗi product_id -> chỉ số sách, rồi gom (chỉ số, điểm, hàng) thành mảng phẳng
+        interned: Dict[str, int] = {}
+        parsed_ids: List[int] = []
+        entry_books: List[int] = []
+        entry_values: List[float] = []
+        entry_rows: List[int] = []
+        profile_keys = list(raw_scores.keys())
+        for row, key in enumerate(profile_keys):
+            for book_id_str, score in raw_scores[key].items():
+                book_idx = interned.get(book_id_str)
+                if book_idx is None:
+                    try:
+                        pid = int(book_id_str)
+                    except (TypeError, ValueError):
+                        interned[book_id_str] = -1
+                        continue
+                    book_idx = interned[book_id_str] = len(parsed_ids)
+                    parsed_ids.append(pid)
+                elif book_idx < 0:
+                    continue
+                entry_books.append(book_idx)
+                entry_values.append(float(score))
+                entry_rows.append(row)
+
+        books = np.asarray(entry_books, dtype=np.int64)
+        values = np.asarray(entry_values, dtype=np.float64)
+        if half_life_days > 0 and metadata is not None:
+            last_seen = np.array(
+                [
+                    _seconds_or_nan((metadata.get(key) or {}).get("lastEventAt"))
+                    for key in profile_keys
+                ],
+                dtype=np.float64,
+            )
+            values = values * _decay_weights(last_seen, half_life_days, now)[
+                np.asarray(entry_rows, dtype=np.int64)
+            ]
+        # Các chuỗi khác nhau có thể cùng một product_id ("7" và "07")
+        total_ids, inverse = np.unique(np.asarray(parsed_ids, dtype=np.int64), return_inverse=True)
+        totals = np.bincount(
+            inverse.reshape(-1)[books], weights=values, minlength=len(total_ids)
+        ).astype(np.float64)
+    return np.asarray(total_ids, dtype=np.int64), np.asarray(totals, dtype=np.float64)
+
+
+def popularity_from_totals(
+    total_ids: np.ndarray,
+    totals: np.ndarray,
+    book_ids: Sequence[int],
+    *,
+    scale: str = "linear",
+) -> np.ndarray:
+    """Bước 2 của compute_popularity_array: đổi thang, chuẩn hoá min-max và căn theo `book_ids`."""
+    if scale not in POPULARITY_SCALES:
+        raise ValueError(f"Unsupported popularity scale: {scale}")
+    if scale == "log":
+        totals = np.log1p(np.maximum(totals, 0.0))
+
+    aligned = np.zeros(len(book_ids), dtype=np.float64)
+    finite = totals[np.isfinite(totals)]
+    max_value = max(float(finite.max()), 0.0) if len(finite) else 0.0
+    if max_value <= 0:
+        return aligned
+
+    target = np.asarray(book_ids, dtype=np.int64)
+    order = np.argsort(total_ids, kind="stable")
+    sorted_ids = np.asarray(total_ids, dtype=np.int64)[order]
+    positions = np.minimum(np.searchsorted(sorted_ids, target), len(sorted_ids) - 1)
+    found = sorted_ids[positions] == target
+    aligned[found] = totals[order[positions[found]]] / max_value
+    return aligned
+
+
+def save_popularity_totals(
+    path: str | os.PathLike,
+    total_ids: np.ndarray,
+    totals: np.ndarray,
+    *,
+    generated_at: datetime,
+) -> None:
+    """Ghi (product_id, tổng điểm) của một lượt huấn luyện ra `.npz` để tiến trình phục vụ nạp lại."""
+    target = Path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_suffix(".tmp.npz")
+    np.savez(
+        tmp,
+        ids=np.asarray(total_ids, dtype=np.int64),
+        totals=np.asarray(totals, dtype=np.float64),
+        generatedAt=np.array(generated_at.isoformat()),
+    )
+    os.replace(tmp, target)
+
+
+def load_popularity_totals(path: str | os.PathLike) -> Optional[Tuple[np.ndarray, np.ndarray, datetime]]:
+    """Đọc file của save_popularity_totals; None nếu chưa có hoặc file hỏng."""
+    target = Path(path)
+    if not target.exists():
+        return None
+    try:
+        with np.load(target) as data:
+            return data["ids"], data["totals"], datetime.fromisoformat(str(data["generatedAt"]))
+    except (OSError, KeyError, ValueError) as exc:
+        print(f"[Popularity] Bỏ qua file độ phổ biến hỏng tại {target}: {exc}")
+        return None
+
+
+def _seconds_or_nan(value: Optional[datetime]) -> float:
+    if value is None:
+        return float("nan")
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
 __all__ = [
     "EmbeddingIndex",
     "rerank_profiles_with_embeddings",
+    "rerank_profile_block",
+    "rerank_block_size",
+    "cooccurrence_scores",
     "aggregate_book_popularity",
     "normalize_popularity",
+    "compute_popularity_array",
+    "popularity_totals",
+    "popularity_from_totals",
+    "save_popularity_totals",
+    "load_popularity_totals",
+    "POPULARITY_SCALES",
     "DEFAULT_MODEL_NAME",
+    "DEFAULT_RERANK_MEMORY_MB",
 ]
 
@@ -0,0 +1,288 @@
+"""
+Snapshot offline của log sự kiện recommendation_feedbacks.
+
+Xuất các trường đã projection (giống iter_events) ra file NPZ nén dạng cột, chia theo ngày
+của occurredAt, để train_recommendations.py có thể chạy lại từ đĩa (thử EVENT_WEIGHTS,
+trọng số rerank, benchmark...) mà không chạm tới MongoDB:
+    <dir>/manifest.json                    thời điểm xuất, cửa sổ ngày, danh sách partition
+    <dir>/day=YYYY-MM-DD/part-00000.npz    các cột của một phần sự kiện trong ngày
+    <dir>/day=undated/part-00000.npz       sự kiện không có occurredAt
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+MANIFEST_FILE = "manifest.json"
+DEFAULT_PART_SIZE = 200_000
+UNDATED = "undated"
+
+_NO_TIMESTAMP = np.iinfo(np.int64).min
+_NO_BOOK = np.iinfo(np.int64).min
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Kiểu gốc của userId/sessionId (cột <tên>Kind) để đọc lại đúng giá trị: 0 và "0" cho
+# profile khác nhau (sessionId 0 bị normalize_key bỏ qua)
+_KIND_NONE, _KIND_STR, _KIND_INT, _KIND_FLOAT, _KIND_BOOL = range(5)
+
+
+def _to_micros(value: Any) -> int:
+    if not isinstance(value, datetime):
+        return _NO_TIMESTAMP
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - _EPOCH
+    return (delta.days * 86_400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _from_micros(value: int) -> Optional[datetime]:
+    """Trả về datetime naive UTC (cùng dạng pymongo) hoặc None."""
+    if value == _NO_TIMESTAMP:
+        return None
+    return (_EPOCH + timedelta(microseconds=int(value))).replace(tzinfo=None)
+
+
+def _encode_id(value: Any) -> Tuple[str, int]:
+    """(chuỗi, kiểu gốc) của userId/sessionId; kiểu lạ (ObjectId...) lưu dạng chuỗi như str()."""
+    if value is None:
+        return "", _KIND_NONE
+    if isinstance(value, bool):
+        return str(value), _KIND_BOOL
+    if isinstance(value, int):
+        return str(value), _KIND_INT
+    if isinstance(value, float):
+        return repr(value), _KIND_FLOAT
+    return str(value), _KIND_STR
+
+
+def _decode_id(text: str, kind: int) -> Any:
+    if kind == _KIND_NONE:
+        return None
+    if kind == _KIND_INT:
+        return int(text)
+    if kind == _KIND_FLOAT:
+        return float(text)
+    if kind == _KIND_BOOL:
+        return text == "True"
+    return text
+
+
+def _as_score(value: Any, field: str) -> Tuple[float, bool]:
+    """
+    (điểm, có giá trị) của finalScore/value. NaN vẫn được giữ là "có giá trị" như parse_event;
+    giá trị không chuyển được sang số làm parse_event lỗi nên cũng báo lỗi ngay khi xuất.
+    """
+    if value is None:
+        return float("nan"), False
+    try:
+        return float(value), True
+    except (TypeError, ValueError):
+        raise ValueError(f"{field}={value!r} không phải số, không thể xuất snapshot.") from None
+
+
+def _as_book_id(value: Any) -> int:
+    """bookId dạng số nguyên như parse_event (int(bookId)); _NO_BOOK nếu thiếu/không hợp lệ."""
+    if value is None:
+        return _NO_BOOK
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return _NO_BOOK
+
+
+class _PartitionBuffer:
+    """Cột tạm của một ngày, ghi ra file khi đủ part_size sự kiện."""
+
+    def __init__(self) -> None:
+        self.columns: Dict[str, List[Any]] = defaultdict(list)
+        self.parts = 0
+
+    def __len__(self) -> int:
+        return len(self.columns["bookId"])
+
+    def append(self, event: Dict) -> None:
+        for field in ("userId", "sessionId"):
+            text, kind = _encode_id(event.get(field))
+            self.columns[field].append(text)
+            self.columns[field + "Kind"].append(kind)
+        self.columns["bookId"].append(_as_book_id(event.get("bookId")))
+        self.columns["eventType"].append(event.get("eventType") or "")
+        for field in ("finalScore", "value"):
+            score, present = _as_score(event.get(field), field)
+            self.columns[field].append(score)
+            self.columns[field + "Set"].append(present)
+        self.columns["occurredAt"].append(_to_micros(event.get("occurredAt")))
+
+    def flush(self, directory: Path) -> Optional[Dict[str, Any]]:
+        if not len(self):
+            return None
+        directory.mkdir(parents=True, exist_ok=True)
+        target = directory / f"part-{self.parts:05d}.npz"
+        tmp = directory / f"part-{self.parts:05d}.tmp.npz"
+        np.savez_compressed(
+            tmp,
+            userId=np.asarray(self.columns["userId"], dtype=str),
+            userIdKind=np.asarray(self.columns["userIdKind"], dtype=np.int8),
+            sessionId=np.asarray(self.columns["sessionId"], dtype=str),
+            sessionIdKind=np.asarray(self.columns["sessionIdKind"], dtype=np.int8),
+            bookId=np.asarray(self.columns["bookId"], dtype=np.int64),
+            eventType=np.asarray(self.columns["eventType"], dtype=str),
+            finalScore=np.asarray(self.columns["finalScore"], dtype=np.float64),
+            finalScoreSet=np.asarray(self.columns["finalScoreSet"], dtype=bool),
+            value=np.asarray(self.columns["value"], dtype=np.float64),
+            valueSet=np.asarray(self.columns["valueSet"], dtype=bool),
+            occurredAt=np.asarray(self.columns["occurredAt"], dtype=np.int64),
+        )
+        os.replace(tmp, target)
+        entry = {"path": str(target.relative_to(directory.parent)), "events": len(self)}
+        self.columns = defaultdict(list)
+        self.parts += 1
+        return entry
+
+
+def export_snapshot(
+    events: Iterable[Dict],
+    path: str | os.PathLike,
+    *,
+    history_days: int,
+    exported_at: Optional[datetime] = None,
+    part_size: int = DEFAULT_PART_SIZE,
+) -> Dict[str, Any]:
+    """
+    Ghi các sự kiện (đã projection như iter_events) thành snapshot chia theo ngày.
+    Trả về manifest đã ghi.
+    """
+    root = Path(path)
+    root.mkdir(parents=True, exist_ok=True)
+    exported_at = exported_at or datetime.now(timezone.utc)
+    buffers: Dict[str, _PartitionBuffer] = defaultdict(_PartitionBuffer)
+    partitions: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+    total = 0
+    for event in events:
+        occurred_at = event.get("occurredAt")
+        day = occurred_at.strftime("%Y-%m-%d") if isinstance(occurred_at, datetime) else UNDATED
+        buffer = buffers[day]
+        buffer.append(event)
+        total += 1
+        if len(buffer) >= part_size:
+            partitions[day].append(buffer.flush(root / f"day={day}"))
+
+    for day, buffer in buffers.items():
+        entry = buffer.flush(root / f"day={day}")
+        if entry is not None:
+            partitions[day].append(entry)
+
+    manifest = {
+        "exportedAt": exported_at.isoformat(),
+        "historyDays": history_days,
+        "events": total,
+        "partitions": {day: partitions[day] for day in sorted(partitions)},
+    }
+    with open(root / MANIFEST_FILE, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def read_manifest(path: str | os.PathLike) -> Dict[str, Any]:
+    manifest_path = Path(path) / MANIFEST_FILE
+    if not manifest_path.exists():
+        raise FileNotFoundError(f"Không tìm thấy snapshot sự kiện tại {manifest_path}")
+    with open(manifest_path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def snapshot_reference_time(manifest: Dict[str, Any]) -> datetime:
+    """Mốc 'hiện tại' của snapshot (thời điểm xuất), dùng để tính cửa sổ history_days khi chạy lại."""
+    exported_at = datetime.fromisoformat(manifest["exportedAt"])
+    if exported_at.tzinfo is None:
+        exported_at = exported_at.replace(tzinfo=timezone.utc)
+    return exported_at
+
+
+def iter_snapshot_batches(
+    path: str | os.PathLike,
+    history_days: int,
+    *,
+    now: Optional[datetime] = None,
+) -> Iterable[List[Dict]]:
+    """
+    Đọc lại snapshot thành các lô sự kiện cùng dạng document của iter_event_batches.
+    Cửa sổ history_days được tính lùi từ `now` (mặc định là thời điểm xuất snapshot) nên
+    các lần chạy lại cho cùng kết quả; các ngày nằm ngoài cửa sổ không cần mở file.
+    """
+    root = Path(path)
+    manifest = read_manifest(root)
+    now = now or snapshot_reference_time(manifest)
+    since = now - timedelta(days=history_days) if history_days > 0 else None
+    since_micros = _to_micros(since) if since is not None else None
+    since_day = since.strftime("%Y-%m-%d") if since is not None else None
+
+    for day, parts in manifest["partitions"].items():
+        if since_day is not None and (day == UNDATED or day < since_day):
+            continue
+        for part in parts:
+            with np.load(root / part["path"]) as data:
+                columns = {name: data[name] for name in data.files}
+            if since_micros is not None:
+                keep = columns["occurredAt"] >= since_micros
+                columns = {name: values[keep] for name, values in columns.items()}
+            yield _rows_from_columns(columns)
+
+
+def _rows_from_columns(columns: Dict[str, np.ndarray]) -> List[Dict]:
+    rows: List[Dict] = []
+    for (
+        user_id,
+        user_kind,
+        session_id,
+        session_kind,
+        book_id,
+        event_type,
+        final_score,
+        final_score_set,
+        value,
+        value_set,
+        occurred_at,
+    ) in zip(
+        columns["userId"].tolist(),
+        columns["userIdKind"].tolist(),
+        columns["sessionId"].tolist(),
+        columns["sessionIdKind"].tolist(),
+        columns["bookId"].tolist(),
+        columns["eventType"].tolist(),
+        columns["finalScore"].tolist(),
+        columns["finalScoreSet"].tolist(),
+        columns["value"].tolist(),
+        columns["valueSet"].tolist(),
+        columns["occurredAt"].tolist(),
+    ):
+        rows.append(
+            {
+                "userId": _decode_id(user_id, user_kind),
+                "sessionId": _decode_id(session_id, session_kind),
+                "bookId": None if book_id == _NO_BOOK else book_id,
+                "eventType": event_type or None,
+                "finalScore": final_score if final_score_set else None,
+                "value": value if value_set else None,
+                "occurredAt": _from_micros(occurred_at),
+            }
+        )
+    return rows
+
+
+__all__ = [
+    "export_snapshot",
+    "iter_snapshot_batches",
+    "read_manifest",
+    "snapshot_reference_time",
+    "DEFAULT_PART_SIZE",
+]
@@ -0,0 +1,83 @@
+"""
+Cache phản hồi LLM trên đĩa cho bước rerank.
+
+Khoá = sha1(model + danh sách ứng viên đã chuẩn hoá), nên hai profile có cùng tập ứng viên
+(cùng ID, điểm cơ bản, cờ trùng danh mục/tác giả/NXB) chỉ phải hỏi LLM một lần.
+Dữ liệu nằm trong một file SQLite (WAL) để nhiều luồng/tiến trình dùng chung an toàn:
+    <cache_dir>/llm_rerank.sqlite3
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+
+DEFAULT_CACHE_DIR = "ai/models/llm_cache"
+
+
+def candidate_key(model: str, candidates: Sequence[Dict]) -> str:
+    """Khoá của một tập ứng viên: không phụ thuộc profile, chỉ phụ thuộc nội dung đưa vào prompt."""
+    rows = [
+        [
+            int(item["product_id"]),
+            round(float(item.get("base_score", 0.0)), 4),
+            bool(item.get("same_category")),
+            bool(item.get("same_author")),
+            bool(item.get("same_publisher")),
+            item.get("title") or "",
+        ]
+        for item in candidates
+    ]
+    payload = json.dumps([model, rows], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Map khoá ứng viên -> thứ hạng (list product_id) đã được LLM trả về."""
+
+    def __init__(self, cache_dir: str | Path):
+        self.path = Path(cache_dir) / "llm_rerank.sqlite3"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rankings ("
+            " key TEXT PRIMARY KEY, ranking TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[List[int]]:
+        with self._lock:
+            row = self._conn.execute("SELECT ranking FROM rankings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return [int(pid) for pid in json.loads(row[0])]
+
+    def put(self, key: str, ranking: Sequence[int]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rankings (key, ranking, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps([int(pid) for pid in ranking]), time.time()),
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, object]:
+        return {"path": str(self.path), "hits": self.hits, "misses": self.misses}
+
+
+__all__ = ["LLMResponseCache", "candidate_key", "DEFAULT_CACHE_DIR"]
@@ -9,21 +9,37 @@ import argparse
 import json
 import math
 import time
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Sequence, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
 from bertopic import BERTopic
 
 from ai_agent import generate_manager_recommendations
+from review_embeddings import DEFAULT_CACHE_DIR as DEFAULT_REVIEW_EMBEDDING_CACHE_DIR, ReviewEmbeddingStore
+from sentiment_cache import DEFAULT_CACHE_DIR as DEFAULT_SENTIMENT_CACHE_DIR, SentimentCache, model_fingerprint, text_key
+from sentiment_onnx import (
+    ONNX_FINGERPRINT_SUFFIX,
+    SENTIMENT_BACKENDS,
+    compare_sentiment_backends,
+    export_quantized_onnx,
+    load_onnx_sentiment_pipeline,
+)
 from structured_analysis import train_forecasting_model, train_segmentation_model
 from unstructured_analysis import (
-    analyze_sentiment_batch,
+    DEFAULT_SENTIMENT_BATCH_SIZE,
+    DEFAULT_SENTIMENT_FALLBACK_MODEL,
+    benchmark_sentiment_throughput,
     get_topics_for_book,
+    iter_sentiment_batches,
+    load_incorporated_reviews,
     load_sentiment_model,
+    save_incorporated_reviews,
     train_topic_model,
+    update_topic_model,
 )
 
 
@@ -105,11 +121,13 @@ def _summarize_sales(
     }
 
 
-def _summarize_sentiment(sentiment_df: pd.DataFrame) -> Dict[str, float]:
-    if sentiment_df.empty:
+def _summarize_sentiment(label_counts: Counter) -> Dict[str, float]:
+    """Label ratios from counts accumulated over the streamed prediction chunks."""
+    total = sum(label_counts.values())
+    if total == 0:
         return {"positive_ratio": 0.0, "negative_ratio": 0.0, "neutral_ratio": 0.0}
 
-    normalized = sentiment_df["label"].value_counts(normalize=True)
+    normalized = pd.Series({label: count / total for label, count in label_counts.items()}, dtype=float)
     mapping = {
         "positive_ratio": float(normalized.get("POSITIVE", 0.0) or normalized.get("Positive", 0.0)),
         "negative_ratio": float(normalized.get("NEGATIVE", 0.0) or normalized.get("Negative", 0.0)),
@@ -117,7 +135,6 @@ def _summarize_sentiment(sentiment_df: pd.DataFrame) -> Dict[str, float]:
     }
 
     # Hugging Face default labels (e.g., LABEL_0) fallback
-    total = sentiment_df.shape[0]
     if mapping["positive_ratio"] == 0 and "LABEL_1" in normalized.index:
         mapping["positive_ratio"] = float(normalized["LABEL_1"])
     if mapping["negative_ratio"] == 0 and "LABEL_0" in normalized.index:
@@ -130,6 +147,23 @@ def _summarize_sentiment(sentiment_df: pd.DataFrame) -> Dict[str, float]:
     return mapping
 
 
+def _review_id_key(review_id) -> str:
+    """review_id as a string; integral floats (ids in a column with NaNs) lose the ".0"."""
+    if isinstance(review_id, float) and review_id.is_integer():
+        return str(int(review_id))
+    return str(review_id)
+
+
+def _review_keys(reviews_df: pd.DataFrame, review_texts: Sequence[str]) -> List[str]:
+    """Stable review identity for the topic model state: review_id, else a hash of the text."""
+    if "review_id" in reviews_df.columns:
+        return [
+            _review_id_key(review_id) if pd.notna(review_id) else text_key(text)
+            for review_id, text in zip(reviews_df["review_id"].tolist(), review_texts)
+        ]
+    return [text_key(text) for text in review_texts]
+
+
 def _describe_topics(topic_model: BERTopic, topic_scores: Sequence[int], top_terms: int = 3) -> List[str]:
     labels: List[str] = []
     for topic_id, _score in topic_scores:
@@ -200,22 +234,22 @@ def _sanitize_for_json(value):
 def build_recommendations(
     sales_df: pd.DataFrame,
     forecast_payload: Dict[str, object],
-    sentiment_df: pd.DataFrame,
+    sentiment_summary: Dict[str, float],
     topic_model: BERTopic,
     positive_reviews: Sequence[str],
     negative_reviews: Sequence[str],
     segmentation_df: pd.DataFrame,
     target_col: str,
     date_col: str,
+    embedding_store: Optional[ReviewEmbeddingStore] = None,
 ) -> List[str]:
     sales_summary = _summarize_sales(sales_df, forecast_payload, target_col, date_col)
-    sentiment_summary = _summarize_sentiment(sentiment_df)
 
     positive_topics = _describe_topics(
-        topic_model, get_topics_for_book(topic_model, positive_reviews)
+        topic_model, get_topics_for_book(topic_model, positive_reviews, embedding_store=embedding_store)
     )
     negative_topics = _describe_topics(
-        topic_model, get_topics_for_book(topic_model, negative_reviews)
+        topic_model, get_topics_for_book(topic_model, negative_reviews, embedding_store=embedding_store)
     )
 
     topic_insights = {
@@ -264,15 +298,54 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--reviews-path", help="CSV with columns [review_text, label].")
     parser.add_argument("--review-text-col", default="review_text")
     parser.add_argument("--sentiment-model-dir", default="ai/models/sentiment_finetuned_model")
+    parser.add_argument(
+        "--sentiment-backend",
+        choices=SENTIMENT_BACKENDS,
+        default="torch",
+        help="`onnx` runs a cached int8 ONNX export on ONNX Runtime (falls back to torch if unavailable).",
+    )
+    parser.add_argument(
+        "--sentiment-cache-dir",
+        default=DEFAULT_SENTIMENT_CACHE_DIR,
+        help="Directory of the persistent sentiment prediction cache (empty = disabled).",
+    )
     parser.add_argument("--topic-model-dir", default="ai/models/topic_model")
     parser.add_argument("--refresh-topic-model", action="store_true", help="Retrain BERTopic instead of loading from disk.")
     parser.add_argument("--topic-min-size", type=int, default=10)
+    parser.add_argument(
+        "--incremental-topic-model",
+        action="store_true",
+        help="Fold reviews not yet in the saved topic model into it (trained on the new reviews only).",
+    )
+    parser.add_argument(
+        "--topic-min-new-reviews",
+        type=int,
+        default=100,
+        help="Defer the incremental topic update until at least this many new reviews are available.",
+    )
+    parser.add_argument(
+        "--review-embedding-cache-dir",
+        default=DEFAULT_REVIEW_EMBEDDING_CACHE_DIR,
+        help="On-disk cache of review embeddings shared by the topic stages (empty = in-memory only).",
+    )
     parser.add_argument(
         "--sentiment-sample",
         type=int,
         default=200,
         help="Number of sentiment predictions to include in the output (0 = all).",
     )
+    parser.add_argument(
+        "--sentiment-batch-size",
+        type=int,
+        default=DEFAULT_SENTIMENT_BATCH_SIZE,
+        help="Reviews per sentiment model call; texts are bucketed by length to limit padding.",
+    )
+    parser.add_argument(
+        "--sentiment-benchmark",
+        help="Comma-separated batch sizes (e.g. 1,8,32,64): report sentiment reviews/sec on the "
+        "review texts and exit. With --sentiment-backend onnx, torch and ONNX are compared "
+        "(speed and accuracy parity).",
+    )
     parser.add_argument(
         "--segment-preview",
         type=int,
@@ -317,6 +390,41 @@ def main():
     if args.review_text_col not in reviews_df.columns:
         raise KeyError(f"Reviews data must contain column `{args.review_text_col}`.")
 
+    review_texts = reviews_df[args.review_text_col].astype(str).tolist()
+    onnx_pipeline = None
+    if args.sentiment_backend == "onnx":
+        onnx_dir = export_quantized_onnx(args.sentiment_model_dir, DEFAULT_SENTIMENT_FALLBACK_MODEL)
+        if onnx_dir is not None:
+            try:
+                onnx_pipeline = load_onnx_sentiment_pipeline(onnx_dir)
+            except Exception as exc:  # noqa: BLE001 - fall back to torch on any runtime error
+                print(f"[Sentiment] Could not load ONNX model ({exc}); using the PyTorch backend.")
+    # The cache fingerprint and the report follow the pipeline actually loaded; the
+    # torch model is still only loaded if some review is not in the cache
+    sentiment_backend = "onnx" if onnx_pipeline is not None else "torch"
+
+    if args.sentiment_benchmark:
+        batch_sizes = [int(size) for size in args.sentiment_benchmark.split(",") if size.strip()]
+        pipelines = {"torch": load_sentiment_model(args.sentiment_model_dir)}
+        if onnx_pipeline is not None:
+            pipelines["onnx"] = onnx_pipeline
+        report = {
+            "sentiment_benchmark": {
+                name: benchmark_sentiment_throughput(review_texts, pipe, batch_sizes)
+                for name, pipe in pipelines.items()
+            }
+        }
+        if "onnx" in pipelines:
+            report["backend_parity"] = compare_sentiment_backends(
+                review_texts,
+                pipelines["torch"],
+                pipelines["onnx"],
+                gold_labels=reviews_df["label"].tolist() if "label" in reviews_df.columns else None,
+                batch_size=args.sentiment_batch_size,
+            )
+        print(json.dumps(report, ensure_ascii=False))
+        return
+
     forecast_payload = train_forecasting_model(
         sales_df,
         target_col=args.sales_target_col,
@@ -327,49 +435,112 @@ def main():
     if not orders_df.empty:
         segmentation_df = train_segmentation_model(orders_df)
 
-    sentiment_pipe = load_sentiment_model(args.sentiment_model_dir)
-    review_texts = reviews_df[args.review_text_col].astype(str).tolist()
-    sentiment_results = analyze_sentiment_batch(
+    sentiment_cache = None
+    if args.sentiment_cache_dir:
+        sentiment_cache = SentimentCache(
+            args.sentiment_cache_dir,
+            model_fingerprint(args.sentiment_model_dir, DEFAULT_SENTIMENT_FALLBACK_MODEL)
+            + (ONNX_FINGERPRINT_SUFFIX if sentiment_backend == "onnx" else ""),
+        )
+    extra_columns = [column for column in ("rating", "book_id") if column in reviews_df.columns]
+
+    # Predictions are aggregated chunk by chunk; only the preview rows are kept as a DataFrame
+    label_counts: Counter = Counter()
+    positive_reviews: List[str] = []
+    negative_reviews: List[str] = []
+    preview_chunks: List[pd.DataFrame] = []
+    preview_rows = 0
+    sentiment_total = 0
+    # The model is only loaded if some review is not in the cache
+    for chunk in iter_sentiment_batches(
         review_texts,
-        sentiment_pipeline=sentiment_pipe,
-    )
-
-    if "rating" in reviews_df.columns:
-        sentiment_results["rating"] = reviews_df["rating"].tolist()[: len(sentiment_results)]
-    if "book_id" in reviews_df.columns:
-        sentiment_results["book_id"] = reviews_df["book_id"].tolist()[: len(sentiment_results)]
-
-    positive_mask = sentiment_results["label"].str.contains("POS", case=False, na=False)
-    negative_mask = sentiment_results["label"].str.contains("NEG", case=False, na=False)
-
-    positive_reviews = sentiment_results.loc[positive_mask, "text"].tolist()
-    negative_reviews = sentiment_results.loc[negative_mask, "text"].tolist()
-
+        sentiment_pipeline=onnx_pipeline,
+        model_path=args.sentiment_model_dir,
+        fallback_model=DEFAULT_SENTIMENT_FALLBACK_MODEL,
+        batch_size=args.sentiment_batch_size,
+        cache=sentiment_cache,
+        backend=sentiment_backend,
+    ):
+        for column in extra_columns:
+            chunk[column] = reviews_df[column].iloc[chunk.index].to_numpy()
+
+        label_counts.update(chunk["label"].value_counts().to_dict())
+        sentiment_total += len(chunk)
+        positive_mask = chunk["label"].str.contains("POS", case=False, na=False)
+        negative_mask = chunk["label"].str.contains("NEG", case=False, na=False)
+        positive_reviews.extend(chunk.loc[positive_mask, "text"].tolist())
+        negative_reviews.extend(chunk.loc[negative_mask, "text"].tolist())
+
+        if not args.sentiment_sample or args.sentiment_sample <= 0:
+            preview_chunks.append(chunk)
+        elif preview_rows < args.sentiment_sample:
+            preview_chunks.append(chunk.head(args.sentiment_sample - preview_rows))
+            preview_rows += len(preview_chunks[-1])
+    if sentiment_cache is not None:
+        sentiment_cache.close()
+
+    # Reviews are embedded once per run and reused by BERTopic fit/transform
+    embedding_store = ReviewEmbeddingStore(cache_dir=args.review_embedding_cache_dir or None)
     topic_dir = Path(args.topic_model_dir)
+    topic_started = time.time()
+    review_keys = _review_keys(reviews_df, review_texts)
     if args.refresh_topic_model or not topic_dir.exists():
+        incorporated = set(review_keys)
         topic_model = train_topic_model(
             documents=review_texts,
             save_dir=str(topic_dir),
             min_topic_size=args.topic_min_size,
+            embedding_store=embedding_store,
+            incorporated_reviews=incorporated,
         )
+        topic_update = {"mode": "full", "new_reviews": len(incorporated)}
     else:
         topic_model = BERTopic.load(str(topic_dir))
+        incorporated = load_incorporated_reviews(str(topic_dir))
+        topic_update = {"mode": "loaded", "new_reviews": 0}
+        if args.incremental_topic_model and not incorporated:
+            # Model saved before ids were tracked: its training set is unknown, so the
+            # current reviews become the baseline instead of being merged a second time
+            incorporated = set(review_keys)
+            save_incorporated_reviews(str(topic_dir), incorporated)
+            topic_update["mode"] = "baseline"
+        elif args.incremental_topic_model:
+            new_reviews = {
+                key: text
+                for key, text in zip(review_keys, review_texts)
+                if key not in incorporated and text.strip()
+            }
+            topic_update = {"mode": "incremental", "new_reviews": len(new_reviews)}
+            if len(new_reviews) >= args.topic_min_new_reviews:
+                incorporated |= set(new_reviews)
+                topic_model = update_topic_model(
+                    topic_model,
+                    list(new_reviews.values()),
+                    save_dir=str(topic_dir),
+                    min_topic_size=args.topic_min_size,
+                    embedding_store=embedding_store,
+                    incorporated_reviews=incorporated,
+                )
+            else:
+                topic_update["deferred"] = True
+    topic_update["incorporated_reviews"] = len(incorporated)
+    topic_update["seconds"] = round(time.time() - topic_started, 2)
 
     recommendation_payload = build_recommendations(
         sales_df=sales_df,
         forecast_payload=forecast_payload,
-        sentiment_df=sentiment_results,
+        sentiment_summary=_summarize_sentiment(label_counts),
         topic_model=topic_model,
         positive_reviews=positive_reviews,
         negative_reviews=negative_reviews,
         segmentation_df=segmentation_df,
         target_col=args.sales_target_col,
         date_col=args.sales_date_col,
+        embedding_store=embedding_store,
     )
+    embedding_store.save()
 
-    sentiment_preview = sentiment_results
-    if args.sentiment_sample and args.sentiment_sample > 0:
-        sentiment_preview = sentiment_results.head(args.sentiment_sample)
+    sentiment_preview = pd.concat(preview_chunks) if preview_chunks else pd.DataFrame()
 
     segment_preview = pd.DataFrame()
     if args.segment_preview != 0 and not segmentation_df.empty:
@@ -384,6 +555,11 @@ def main():
     output_payload = {
         "generated_at": datetime.utcnow().isoformat() + "Z",
         "runtime_seconds": round(time.time() - start_time, 2),
+        "runtime": {
+            "total_seconds": round(time.time() - start_time, 2),
+            "sentiment_cache": sentiment_cache.stats() if sentiment_cache is not None else None,
+            "review_embeddings": embedding_store.stats(),
+        },
         "data_summary": {
             "sales_rows": int(sales_df.shape[0]),
             "order_rows": int(orders_df.shape[0]),
@@ -399,14 +575,16 @@ def main():
         "sales_summary": recommendation_payload["sales_summary"],
         "sentiment": {
             "summary": recommendation_payload["sentiment_summary"],
-            "total_records": int(sentiment_results.shape[0]),
+            "total_records": int(sentiment_total),
             "predictions_sample": sentiment_preview.to_dict(orient="records"),
             "model_dir": str(args.sentiment_model_dir),
+            "backend": sentiment_backend,
         },
         "topics": {
             "insights": recommendation_payload["topic_insights"],
             "overview": topic_records,
             "model_dir": str(topic_dir),
+            "update": topic_update,
         },
         "segments": {
             "summary": recommendation_payload["segment_summary"],
@@ -0,0 +1,530 @@
+"""
+Kho điểm profile dạng cột (columnar) cho pipeline huấn luyện gợi ý.
+
+Thay vì `defaultdict(lambda: defaultdict(float))` với khoá chuỗi ("user:123" -> "4567"),
+mỗi profile và mỗi sách được intern thành chỉ số nguyên; điểm được cộng dồn vào các mảng
+NumPy dạng COO rồi định kỳ gộp (compact) thành ma trận thưa profile × sách dạng CSR.
+Mỗi cặp (profile, sách) chỉ tốn 16 byte (cột int32, điểm float64, thứ tự chèn int32)
+thay vì hơn một trăm byte của dict lồng nhau.
+"""
+
+from __future__ import annotations
+
+import gc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+
+# Giá trị đánh dấu "chưa có thời gian sự kiện" trong mảng lastEventAt (micro giây)
+_NO_TIMESTAMP = np.iinfo(np.int64).min
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_micros(value: datetime) -> int:
+    """Đổi datetime (naive được hiểu là UTC như pymongo trả về) sang micro giây epoch."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - _EPOCH
+    return (delta.days * 86_400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _from_micros(value: int) -> datetime:
+    """Ngược lại với _to_micros: trả về datetime naive UTC (cùng dạng pymongo)."""
+    seconds, micros = divmod(int(value), 1_000_000)
+    moment = datetime.fromtimestamp(seconds, timezone.utc).replace(microsecond=micros)
+    return moment.replace(tzinfo=None)
+
+
+class ProfileStore:
+    """
+    Ma trận điểm profile × sách với khoá đã được intern.
+
+    - `profile_keys[i]` là khoá profile của hàng i; `book_ids[j]` là product_id của cột j.
+    - Các entry được giữ dạng CSR (indptr theo hàng, cột sắp tăng dần trong hàng);
+      `first_seen` là hạng int32 của lần đầu cặp (profile, sách) xuất hiện, để tái hiện đúng
+      thứ tự chèn của dict khi hoà điểm.
+    - Metadata (eventCount, eventTypes, lastEventAt) lưu dạng mảng theo hàng.
+    """
+
+    def __init__(self, chunk_size: int = 262_144):
+        self.chunk_size = max(1, int(chunk_size))
+        self.profile_keys: List[str] = []
+        self._profile_index: Dict[str, int] = {}
+        self._book_list: List[int] = []
+        self._book_index: Dict[int, int] = {}
+        self.event_types: List[str] = []
+        self._event_type_index: Dict[str, int] = {}
+
+        # Metadata theo hàng (mở rộng dần theo số profile)
+        self._event_counts = np.zeros(1024, dtype=np.int64)
+        self._last_event_at = np.full(1024, _NO_TIMESTAMP, dtype=np.int64)
+        self._type_counts = np.zeros((1024, 4), dtype=np.int32)
+
+        # Phần đã gộp dạng CSR: _indptr theo hàng, các entry sắp theo (hàng, cột).
+        # Khoá (hàng, cột) chỉ được dựng tạm trong compact, không giữ thường trực.
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._cols = np.zeros(0, dtype=np.int32)
+        self._values = np.zeros(0, dtype=np.float64)
+        self._first_seen = np.zeros(0, dtype=np.int32)
+
+        # Bộ đệm COO cho các điểm mới cộng vào (cấp phát khi cần, giải phóng sau compact)
+        self._buf_rows: Optional[np.ndarray] = None
+        self._buf_cols: Optional[np.ndarray] = None
+        self._buf_values: Optional[np.ndarray] = None
+        self._buf_len = 0
+
+    # ------------------------------------------------------------------ intern
+    def _profile_idx(self, profile_key: str) -> int:
+        idx = self._profile_index.get(profile_key)
+        if idx is None:
+            idx = len(self.profile_keys)
+            self._profile_index[profile_key] = idx
+            self.profile_keys.append(profile_key)
+            if idx >= len(self._event_counts):
+                self._grow_rows(idx + 1)
+        return idx
+
+    def _book_idx(self, book_id: int) -> int:
+        idx = self._book_index.get(book_id)
+        if idx is None:
+            idx = len(self._book_list)
+            self._book_index[book_id] = idx
+            self._book_list.append(book_id)
+        return idx
+
+    def _event_type_idx(self, event_type: str) -> int:
+        idx = self._event_type_index.get(event_type)
+        if idx is None:
+            idx = len(self.event_types)
+            self._event_type_index[event_type] = idx
+            self.event_types.append(event_type)
+            if idx >= self._type_counts.shape[1]:
+                extra = np.zeros((self._type_counts.shape[0], self._type_counts.shape[1]), dtype=np.int32)
+                self._type_counts = np.hstack([self._type_counts, extra])
+        return idx
+
+    def _grow_rows(self, needed: int) -> None:
+        capacity = max(needed, len(self._event_counts) * 2)
+        extra = capacity - len(self._event_counts)
+        self._event_counts = np.concatenate([self._event_counts, np.zeros(extra, dtype=np.int64)])
+        self._last_event_at = np.concatenate(
+            [self._last_event_at, np.full(extra, _NO_TIMESTAMP, dtype=np.int64)]
+        )
+        self._type_counts = np.vstack(
+            [self._type_counts, np.zeros((extra, self._type_counts.shape[1]), dtype=np.int32)]
+        )
+
+    def _ensure_buffer(self) -> None:
+        if self._buf_len >= self.chunk_size:
+            self.compact()
+        if self._buf_rows is None:
+            self._buf_rows = np.empty(self.chunk_size, dtype=np.int32)
+            self._buf_cols = np.empty(self.chunk_size, dtype=np.int32)
+            self._buf_values = np.empty(self.chunk_size, dtype=np.float64)
+
+    # ------------------------------------------------------------------ ghi
+    def add_score(self, profile_key: str, book_id: int, score: float) -> None:
+        """Cộng điểm cho cặp (profile, sách)."""
+        self._ensure_buffer()
+        pos = self._buf_len
+        self._buf_rows[pos] = self._profile_idx(profile_key)
+        self._buf_cols[pos] = self._book_idx(int(book_id))
+        self._buf_values[pos] = score
+        self._buf_len = pos + 1
+
+    def add_events(
+        self,
+        profile_key: str,
+        event_type: str,
+        count: int = 1,
+        occurred_at: Optional[datetime] = None,
+    ) -> None:
+        """Ghi nhận `count` sự kiện loại `event_type` cho profile (phục vụ metadata)."""
+        row = self._profile_idx(profile_key)
+        col = self._event_type_idx(event_type)
+        self._event_counts[row] += count
+        self._type_counts[row, col] += count
+        if isinstance(occurred_at, datetime):
+            micros = _to_micros(occurred_at)
+            if micros > self._last_event_at[row]:
+                self._last_event_at[row] = micros
+
+    def add_batch(
+        self,
+        profile_keys: Sequence[str],
+        book_ids: Sequence[int],
+        scores: Sequence[float],
+        event_types: Sequence[str],
+        occurred_at: Sequence[Optional[datetime]],
+    ) -> None:
+        """
+        Gộp một lô sự kiện đã giải mã (các dãy song song, mỗi phần tử là một sự kiện).
+        Tương đương gọi add_score + add_events cho từng sự kiện theo đúng thứ tự, nhưng
+        metadata được cộng bằng np.add.at / np.maximum.at trên cả lô.
+        """
+        size = len(profile_keys)
+        if not size:
+            return
+        rows = np.fromiter((self._profile_idx(key) for key in profile_keys), dtype=np.int32, count=size)
+        cols = np.fromiter((self._book_idx(int(pid)) for pid in book_ids), dtype=np.int32, count=size)
+        type_cols = np.fromiter(
+            (self._event_type_idx(etype) for etype in event_types), dtype=np.int64, count=size
+        )
+        micros = np.fromiter(
+            (_to_micros(value) if isinstance(value, datetime) else _NO_TIMESTAMP for value in occurred_at),
+            dtype=np.int64,
+            count=size,
+        )
+        values = np.asarray(scores, dtype=np.float64)
+
+        offset = 0
+        while offset < size:
+            self._ensure_buffer()
+            take = min(self.chunk_size - self._buf_len, size - offset)
+            end = self._buf_len + take
+            self._buf_rows[self._buf_len : end] = rows[offset : offset + take]
+            self._buf_cols[self._buf_len : end] = cols[offset : offset + take]
+            self._buf_values[self._buf_len : end] = values[offset : offset + take]
+            self._buf_len = end
+            offset += take
+
+        np.add.at(self._event_counts, rows, 1)
+        np.add.at(self._type_counts, (rows, type_cols), 1)
+        np.maximum.at(self._last_event_at, rows, micros)
+
+    def compact(self) -> None:
+        """
+        Gộp bộ đệm COO vào phần đã gộp, cộng dồn các cặp (profile, sách) trùng nhau.
+        Chỉ bộ đệm được sắp xếp: phần đã gộp vốn đã sắp theo (hàng, cột) nên các cặp mới
+        được chèn vào đúng chỗ bằng searchsorted trên khoá dựng tạm từ indptr/cột,
+        không sắp lại toàn bộ ở mỗi lần gộp.
+        """
+        if self._buf_len == 0:
+            return
+        size = self._buf_len
+        keys = _pair_keys(self._buf_rows[:size], self._buf_cols[:size])
+        # sort ổn định => các entry trùng giữ nguyên thứ tự cộng dồn ban đầu
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        values = self._buf_values[:size][order]
+        self._buf_rows = self._buf_cols = self._buf_values = None
+        self._buf_len = 0
+
+        boundary = np.ones(size, dtype=bool)
+        boundary[1:] = keys[1:] != keys[:-1]
+        starts = np.flatnonzero(boundary)
+        unique_keys = keys[starts]
+
+        indptr = self.indptr()
+        existing = len(self._cols)
+        stored_keys = _pair_keys(np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), self._cols)
+        at = np.searchsorted(stored_keys, unique_keys)
+        fresh = np.ones(len(unique_keys), dtype=bool)
+        inside = at < existing
+        fresh[inside] = stored_keys[at[inside]] != unique_keys[inside]
+        del stored_keys
+        insert_at = at[fresh]
+        new_keys = unique_keys[fresh]
+        # Hạng thứ tự chèn: entry mới đứng sau mọi entry cũ, giữa chúng theo lần xuất hiện đầu
+        first_order = order[starts][fresh]
+        ranks = np.empty(len(first_order), dtype=np.int32)
+        ranks[np.argsort(first_order)] = np.arange(existing, existing + len(first_order), dtype=np.int32)
+        self._cols = np.insert(self._cols, insert_at, (new_keys & 0xFFFFFFFF).astype(np.int32))
+        self._values = np.insert(self._values, insert_at, 0.0)
+        self._first_seen = np.insert(self._first_seen, insert_at, ranks)
+        added = np.bincount(new_keys >> 32, minlength=len(indptr) - 1)
+        self._indptr = indptr + np.concatenate([[0], np.cumsum(added)])
+
+        # Vị trí sau khi chèn = số cặp cũ đứng trước + số cặp mới đứng trước.
+        # np.add.at cộng tuần tự theo thứ tự sự kiện => kết quả trùng khớp từng bit với
+        # phép `+=` trên dict (reduceat dùng cộng theo cặp nên có thể lệch ở chữ số cuối)
+        target = at + np.cumsum(fresh) - fresh
+        np.add.at(self._values, target[np.cumsum(boundary) - 1], values)
+
+    # ------------------------------------------------------------------ đọc
+    def __len__(self) -> int:
+        return len(self.profile_keys)
+
+    def __contains__(self, profile_key: object) -> bool:
+        return profile_key in self._profile_index
+
+    @property
+    def book_ids(self) -> np.ndarray:
+        """product_id theo thứ tự cột."""
+        return np.asarray(self._book_list, dtype=np.int64)
+
+    @property
+    def event_counts(self) -> np.ndarray:
+        """Số sự kiện theo hàng profile."""
+        return self._event_counts[: len(self.profile_keys)]
+
+    def last_event_seconds(self) -> np.ndarray:
+        """Thời điểm sự kiện cuối của từng hàng (giây epoch UTC, NaN nếu chưa có)."""
+        micros = self._last_event_at[: len(self.profile_keys)]
+        return np.where(micros == _NO_TIMESTAMP, np.nan, micros / 1_000_000.0)
+
+    def entries(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Trả về (cols, values, first_seen) của các entry đã gộp, sắp theo (hàng, cột);
+        hàng của từng entry suy ra từ indptr().
+        """
+        self.compact()
+        return self._cols, self._values, self._first_seen
+
+    def indptr(self) -> np.ndarray:
+        """Con trỏ đầu/cuối từng hàng trong entries() (giống CSR.indptr)."""
+        self.compact()
+        missing = len(self.profile_keys) + 1 - len(self._indptr)
+        if missing > 0:
+            # Profile mới chỉ có sự kiện metadata (chưa có entry) -> hàng rỗng
+            self._indptr = np.concatenate([self._indptr, np.full(missing, self._indptr[-1])])
+        return self._indptr
+
+    def matrix(self) -> sparse.csr_matrix:
+        """Ma trận thưa profile × sách (scipy CSR)."""
+        cols, values, _ = self.entries()
+        shape = (len(self.profile_keys), len(self._book_list))
+        return sparse.csr_matrix((values, cols, self.indptr()), shape=shape)
+
+    def _row_order(self, start: int, end: int) -> np.ndarray:
+        """Thứ tự các entry của một hàng theo lần xuất hiện đầu tiên (thứ tự chèn dict)."""
+        return np.argsort(self._first_seen[start:end], kind="stable") + start
+
+    def scores_for(self, profile_key: str) -> Dict[str, float]:
+        """Map {book_id: score} của một profile (theo thứ tự chèn như aggregate_profiles)."""
+        row = self._profile_index.get(profile_key)
+        if row is None:
+            return {}
+        indptr = self.indptr()
+        positions = self._row_order(indptr[row], indptr[row + 1])
+        return {
+            str(self._book_list[col]): float(value)
+            for col, value in zip(self._cols[positions], self._values[positions])
+        }
+
+    def metadata_for(self, profile_key: str) -> Dict:
+        """Metadata của một profile cùng định dạng với aggregate_profiles."""
+        row = self._profile_index[profile_key]
+        event_types: Counter = Counter()
+        for col, count in enumerate(self._type_counts[row, : len(self.event_types)]):
+            if count:
+                event_types[self.event_types[col]] = int(count)
+        last = self._last_event_at[row]
+        return {
+            "eventCount": int(self._event_counts[row]),
+            "eventTypes": event_types,
+            "lastEventAt": None if last == _NO_TIMESTAMP else _from_micros(last),
+        }
+
+    def to_dicts(self) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
+        """Chuyển ngược về (raw_scores, metadata) dạng dict (chỉ dùng khi cần tương thích)."""
+        raw_scores = {key: self.scores_for(key) for key in self.profile_keys}
+        metadata = {key: self.metadata_for(key) for key in self.profile_keys}
+        return raw_scores, metadata
+
+    def book_totals(self, row_weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Tổng điểm của từng cột sách trên mọi profile.
+        `row_weights` (tuỳ chọn, theo hàng) nhân vào điểm trước khi cộng, ví dụ hệ số suy giảm.
+        """
+        cols, values, _ = self.entries()
+        if row_weights is not None:
+            values = values * np.repeat(np.asarray(row_weights, dtype=np.float64), np.diff(self.indptr()))
+        return np.bincount(cols, weights=values, minlength=len(self._book_list))
+
+    def prune(
+        self,
+        min_score: float,
+        top_k: int,
+        max_profiles: int,
+    ) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
+        """
+        Tương đương prune_profiles trên dict nhưng chạy vector hoá trên ma trận thưa:
+          - chọn max_profiles profile nhiều sự kiện nhất bằng chọn từng phần (argpartition),
+          - áp min_score như một mask trên toàn bộ entry,
+          - lấy top_k mỗi hàng bằng argpartition theo khối hàng cùng độ dài.
+        Thứ tự đầu ra (kể cả khi hoà điểm) trùng với prune_profiles.
+        """
+        cols, values, first_seen = self.entries()
+        indptr = self.indptr()
+
+        selected = _select_top_rows(self.event_counts, max_profiles)
+        lengths = indptr[selected + 1] - indptr[selected]
+        positions = _concat_ranges(indptr[selected], lengths)
+        owner = np.repeat(np.arange(len(selected)), lengths)
+
+        keep = values[positions] >= min_score
+        positions, owner = positions[keep], owner[keep]
+
+        if top_k > 0:
+            # Chỉ giữ entry >= giá trị lớn thứ top_k của hàng (có thể dư vài entry hoà điểm)
+            thresholds = _row_kth_largest(values[positions], owner, len(selected), top_k)
+            keep = values[positions] >= thresholds[owner]
+            positions, owner = positions[keep], owner[keep]
+
+        # Điểm giảm dần, hoà điểm thì sách xuất hiện trước đứng trước (như sort ổn định trên dict)
+        order = np.lexsort((first_seen[positions], -values[positions], owner))
+        positions, owner = positions[order], owner[order]
+
+        counts = np.bincount(owner, minlength=len(selected))
+        if top_k > 0:
+            starts = np.cumsum(counts) - counts
+            rank = np.arange(len(owner)) - starts[owner]
+            keep = rank < top_k
+            positions = positions[keep]
+            counts = np.minimum(counts, top_k)
+
+        # Dựng đầu ra từ các list phẳng: mỗi profile chỉ còn một lần cắt list + dict(zip)
+        # (dict giữ thứ tự chèn như OrderedDict của prune_profiles nhưng tạo rẻ hơn nhiều)
+        nonempty = counts > 0
+        rows = selected[nonempty]
+        ends = np.cumsum(counts[nonempty]).tolist()
+        starts = [0, *ends[:-1]]
+        book_ids = np.array([str(pid) for pid in self._book_list], dtype=object)
+        kept_books = book_ids[cols[positions]].tolist()
+        kept_values = values[positions].tolist()
+        keys = [self.profile_keys[row] for row in rows.tolist()]
+
+        with _gc_paused():
+            filtered_scores: Dict[str, Dict[str, float]] = {
+                key: dict(zip(kept_books[start:end], kept_values[start:end]))
+                for key, start, end in zip(keys, starts, ends)
+            }
+            filtered_meta = dict(zip(keys, self._metadata_rows(rows)))
+        return filtered_scores, filtered_meta
+
+    def _metadata_rows(self, rows: np.ndarray) -> List[Dict]:
+        """metadata_for của nhiều hàng, đọc các mảng metadata một lần cho cả danh sách."""
+        event_counts = self._event_counts[rows].tolist()
+        # datetime64[us] -> datetime naive UTC như _from_micros; _NO_TIMESTAMP trùng NaT -> None
+        last_event_at = self._last_event_at[rows].astype("datetime64[us]").tolist()
+        type_counts = self._type_counts[rows, : len(self.event_types)]
+        type_rows, type_cols = np.nonzero(type_counts)
+        type_names = np.array(self.event_types, dtype=object)[type_cols].tolist()
+        type_values = type_counts[type_rows, type_cols].tolist()
+        type_ends = np.cumsum(np.bincount(type_rows, minlength=len(rows))).tolist()
+        type_starts = [0, *type_ends[:-1]]
+        return [
+            {
+                "eventCount": count,
+                "eventTypes": _counter(zip(type_names[start:end], type_values[start:end])),
+                "lastEventAt": last,
+            }
+            for count, last, start, end in zip(event_counts, last_event_at, type_starts, type_ends)
+        ]
+
+    @classmethod
+    def from_dicts(
+        cls,
+        raw_scores: Dict[str, Dict[str, float]],
+        metadata: Dict[str, Dict],
+    ) -> "ProfileStore":
+        """Dựng store từ (raw_scores, metadata) dạng dict, giữ nguyên thứ tự chèn."""
+        total = sum(len(score_map) for score_map in raw_scores.values())
+        store = cls(chunk_size=max(1, total))
+        for key, score_map in raw_scores.items():
+            meta = metadata.get(key, {})
+            for book_id_str, score in score_map.items():
+                store.add_score(key, int(book_id_str), float(score))
+            row = store._profile_idx(key)
+            store._event_counts[row] = int(meta.get("eventCount", 0))
+            for etype, count in (meta.get("eventTypes") or {}).items():
+                store._type_counts[row, store._event_type_idx(etype)] = int(count)
+            if isinstance(meta.get("lastEventAt"), datetime):
+                store._last_event_at[row] = _to_micros(meta["lastEventAt"])
+        store.compact()
+        return store
+
+
+def _counter(pairs) -> Counter:
+    """
+    Counter từ các cặp (khoá, số đếm) không trùng khoá. Bỏ qua Counter.__init__/update (kiểm tra
+    Mapping ở tầng Python) vì hàm được gọi cho từng profile khi dựng metadata.
+    """
+    counter = Counter.__new__(Counter)
+    dict.update(counter, pairs)
+    return counter
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Tắt GC vòng (cyclic GC) khi dựng hàng trăm nghìn dict/Counter không chứa vòng tham chiếu:
+    các lượt thu gom kích hoạt theo số object mới tạo chiếm gần nửa thời gian dựng đầu ra.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _pair_keys(rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """Khoá int64 của cặp (hàng, cột) giữ đúng thứ tự (hàng, cột) khi so sánh."""
+    return (rows.astype(np.int64) << 32) | cols.astype(np.int64)
+
+
+def _concat_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Nối các dải [start, start + length) thành một mảng chỉ số (không vòng lặp Python)."""
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(total, dtype=np.int64)
+
+
+def _select_top_rows(event_counts: np.ndarray, max_profiles: int) -> np.ndarray:
+    """
+    Chọn các hàng theo eventCount giảm dần (hoà thì hàng nhỏ hơn trước, như sorted ổn định).
+    Với max_profiles > 0 chỉ chọn từng phần bằng np.partition thay vì sắp xếp toàn bộ.
+    """
+    total = len(event_counts)
+    if max_profiles <= 0 or max_profiles >= total:
+        return np.argsort(-event_counts, kind="stable")
+
+    kth = -np.partition(-event_counts, max_profiles - 1)[max_profiles - 1]
+    above = np.flatnonzero(event_counts > kth)
+    ties = np.flatnonzero(event_counts == kth)[: max_profiles - len(above)]
+    candidates = np.sort(np.concatenate([above, ties]))
+    return candidates[np.argsort(-event_counts[candidates], kind="stable")]
+
+
+def _row_kth_largest(
+    values: np.ndarray,
+    owner: np.ndarray,
+    n_rows: int,
+    k: int,
+) -> np.ndarray:
+    """
+    Giá trị lớn thứ k của từng hàng (-inf nếu hàng có <= k phần tử).
+    `owner` phải không giảm. Các hàng dài hơn k được gom theo độ dài (luỹ thừa 2) thành
+    khối dày đặc để gọi np.partition một lần cho cả khối.
+    """
+    thresholds = np.full(n_rows, -np.inf)
+    counts = np.bincount(owner, minlength=n_rows)
+    long_rows = np.flatnonzero(counts > k)
+    if not len(long_rows):
+        return thresholds
+
+    starts = np.cumsum(counts) - counts
+    widths = 1 << np.ceil(np.log2(counts[long_rows])).astype(np.int64)
+    for width in np.unique(widths):
+        block_rows = long_rows[widths == width]
+        block_counts = counts[block_rows]
+        block = np.full((len(block_rows), int(width)), -np.inf)
+        slot = np.repeat(np.arange(len(block_rows)), block_counts)
+        column = _concat_ranges(np.zeros(len(block_rows), dtype=np.int64), block_counts)
+        block[slot, column] = values[_concat_ranges(starts[block_rows], block_counts)]
+        kth = int(width) - k
+        thresholds[block_rows] = np.partition(block, kth, axis=1)[:, kth]
+    return thresholds
+
+
+__all__ = ["ProfileStore"]
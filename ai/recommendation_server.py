@@ -0,0 +1,447 @@
+"""
+Tiến trình phục vụ gợi ý trực tuyến cho một profile.
+
+Giữ sẵn trong bộ nhớ các thành phần mà train_recommendations.py dựng mỗi lượt chạy
+(EmbeddingIndex, mảng độ phổ biến, bảng sách liên quan) và chấm điểm một profile từ các
+sự kiện gần đây của nó trong vài mili-giây, thay vì phải chờ lượt huấn luyện kế tiếp:
+    sự kiện -> điểm hành vi (cùng EVENT_WEIGHTS/decay) -> prune -> rerank embedding -> heuristic
+
+Giao tiếp:
+  - HTTP:  POST /recommend {"events": [...], "topK": 25}   GET /health
+  - --stdio: mỗi dòng stdin là một request JSON, mỗi dòng stdout là một response JSON
+    (request có "id" thì response trả lại "id" đó).
+  "topK" (tuỳ chọn) phải là số nguyên dương; giá trị khác -> HTTP 400 / object {"error": ...}.
+Mỗi sự kiện có cùng trường như recommendation_feedbacks: bookId, eventType, value,
+finalScore, occurredAt (ISO 8601). Bước LLM không được dùng ở đây vì không đáp ứng độ trễ.
+
+Độ phổ biến lấy từ file do train_recommendations.py ghi (--serving-dir), láng giềng đồng
+xuất hiện từ --cooccurrence-dir (nếu lượt huấn luyện có bật); cả hai được nạp lại khi file
+đổi. --benchmark N đo độ trễ (p50/p99) trên N request tổng hợp rồi thoát.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from ann_index import ANN_BACKENDS
+from cooccurrence import DEFAULT_MODEL_DIR as DEFAULT_COOCCURRENCE_DIR, CooccurrenceModel
+from embedding_cache import DEFAULT_CACHE_DIR as DEFAULT_EMBEDDING_CACHE_DIR, EmbeddingCache
+from embedding_rerank import (
+    DEFAULT_MODEL_NAME as EMBEDDING_MODEL_NAME,
+    POPULARITY_SCALES,
+    EmbeddingIndex,
+    load_popularity_totals,
+    popularity_from_totals,
+    rerank_profiles_with_embeddings,
+)
+from related_books import DEFAULT_CACHE_DIR as DEFAULT_RELATED_BOOKS_DIR, DEFAULT_TOP_N, RelatedBooksTable
+from train_recommendations import (
+    DEFAULT_COOCCURRENCE_WEIGHT,
+    DEFAULT_SERVING_DIR,
+    EMBEDDING_RERANK_WEIGHTS,
+    EVENT_WEIGHTS,
+    POPULARITY_TOTALS_FILE,
+    HybridLLMReranker,
+    TimeDecay,
+    build_rerank_candidate_arrays,
+    event_score,
+    load_book_metadata,
+    now_utc,
+)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Khoảng thời gian tối thiểu (giây) giữa hai lần kiểm tra file độ phổ biến có thay đổi hay không
+DEFAULT_RELOAD_INTERVAL = 30.0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Phục vụ gợi ý sách trực tuyến cho một profile.")
+    parser.add_argument("--book-meta-json", required=True, help="File JSON metadata sách (giống train_recommendations.py).")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--stdio", action="store_true", help="Giao tiếp JSON-lines qua stdin/stdout thay vì HTTP.")
+    parser.add_argument("--top-k", type=int, default=25)
+    parser.add_argument("--min-score", type=float, default=0.2)
+    parser.add_argument(
+        "--decay-half-life-days",
+        type=float,
+        default=0.0,
+        help="Chu kỳ bán rã (ngày) của điểm sự kiện, nên trùng với lượt huấn luyện (0 = tắt).",
+    )
+    parser.add_argument("--serving-dir", default=DEFAULT_SERVING_DIR, help="Thư mục chứa file độ phổ biến của lượt huấn luyện.")
+    parser.add_argument("--popularity-scale", choices=POPULARITY_SCALES, default="linear")
+    parser.add_argument(
+        "--cooccurrence-dir",
+        default=DEFAULT_COOCCURRENCE_DIR,
+        help="Thư mục mô hình đồng xuất hiện của lượt huấn luyện (bỏ qua nếu chưa có).",
+    )
+    parser.add_argument("--cooccurrence-weight", type=float, default=DEFAULT_COOCCURRENCE_WEIGHT)
+    parser.add_argument("--reload-interval", type=float, default=DEFAULT_RELOAD_INTERVAL)
+    parser.add_argument("--embedding-cache-dir", default=DEFAULT_EMBEDDING_CACHE_DIR)
+    parser.add_argument("--ann-backend", choices=ANN_BACKENDS, default="exact")
+    parser.add_argument("--ann-nprobe", type=int, default=8)
+    parser.add_argument("--related-top-n", type=int, default=DEFAULT_TOP_N)
+    parser.add_argument("--related-cache-dir", default=DEFAULT_RELATED_BOOKS_DIR)
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=0,
+        help="Đo độ trễ trên N request tổng hợp (sự kiện ngẫu nhiên trên catalog) rồi thoát.",
+    )
+    parser.add_argument("--seed", type=int, default=13, help="Seed cho request tổng hợp của --benchmark.")
+    return parser.parse_args()
+
+
+def _parse_time(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+class RecommendationService:
+    """
+    Chấm điểm một profile từ các sự kiện của nó với các thành phần đã nạp sẵn.
+    An toàn khi gọi recommend() từ nhiều luồng (chỉ đọc; nạp lại độ phổ biến và bộ đếm
+    request được khoá).
+    """
+
+    def __init__(
+        self,
+        book_meta: Dict[int, Dict],
+        *,
+        top_k: int = 25,
+        min_score: float = 0.2,
+        decay_half_life_days: float = 0.0,
+        popularity_path: Optional[str] = None,
+        popularity_scale: str = "linear",
+        cooccurrence_dir: Optional[str] = None,
+        cooccurrence_weight: float = DEFAULT_COOCCURRENCE_WEIGHT,
+        reload_interval: float = DEFAULT_RELOAD_INTERVAL,
+        embedding_cache_dir: Optional[str] = None,
+        ann_backend: str = "exact",
+        ann_nprobe: int = 8,
+        related_top_n: int = DEFAULT_TOP_N,
+        related_cache_dir: Optional[str] = None,
+    ):
+        if not book_meta:
+            raise ValueError("Cần metadata sách để phục vụ gợi ý.")
+        self.book_meta = book_meta
+        self.top_k = top_k
+        self.min_score = min_score
+        self.decay_half_life_days = decay_half_life_days
+        self.popularity_path = Path(popularity_path) if popularity_path else None
+        self.popularity_scale = popularity_scale
+        self.cooccurrence_dir = Path(cooccurrence_dir) if cooccurrence_dir else None
+        self.cooccurrence_weight = cooccurrence_weight
+        self.reload_interval = reload_interval
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+
+        self.index = EmbeddingIndex(
+            model_name=EMBEDDING_MODEL_NAME,
+            cache=EmbeddingCache(embedding_cache_dir, EMBEDDING_MODEL_NAME) if embedding_cache_dir else None,
+            ann_backend=ann_backend,
+            ann_nprobe=ann_nprobe,
+        )
+        self.index.build(book_meta)
+        self.related = (
+            RelatedBooksTable.load_or_build(book_meta, top_n=related_top_n, cache_dir=related_cache_dir)
+            if related_top_n > 0
+            else None
+        )
+
+        self.popularity = np.zeros(len(self.index.book_ids), dtype=np.float64)
+        self.popularity_generated_at: Optional[datetime] = None
+        self.cooccurrence: Optional[Any] = None
+        self._mtimes: Dict[str, Optional[float]] = {}
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self.reload(force=True)
+
+    def _changed_since_load(self, name: str, path: Optional[Path]) -> Optional[float]:
+        """mtime mới của file nếu khác lần nạp trước, ngược lại None."""
+        if path is None:
+            return None
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            return None
+        return mtime if mtime != self._mtimes.get(name) else None
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Nạp lại độ phổ biến / láng giềng đồng xuất hiện nếu file của lượt huấn luyện đã đổi.
+        Mỗi phần được thay bằng một phép gán nên các luồng đang chấm điểm vẫn thấy bản cũ
+        nhất quán. Trả về True nếu có nạp.
+        """
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.reload_interval:
+            return False
+        reloaded = False
+        with self._reload_lock:
+            self._checked_at = now
+            mtime = self._changed_since_load("popularity", self.popularity_path)
+            loaded = load_popularity_totals(self.popularity_path) if mtime is not None else None
+            if loaded is not None:
+                total_ids, totals, generated_at = loaded
+                self.popularity = popularity_from_totals(
+                    total_ids, totals, self.index.book_ids, scale=self.popularity_scale
+                )
+                self.popularity_generated_at = generated_at
+                self._mtimes["popularity"] = mtime
+                reloaded = True
+
+            neighbors_file = self.cooccurrence_dir / "neighbors.npz" if self.cooccurrence_dir else None
+            mtime = self._changed_since_load("cooccurrence", neighbors_file)
+            model = CooccurrenceModel.load(self.cooccurrence_dir) if mtime is not None else None
+            if model is not None:
+                self.cooccurrence = model.aligned(self.index.book_ids)
+                self._mtimes["cooccurrence"] = mtime
+                reloaded = True
+        return reloaded
+
+    def score_events(self, events: List[Dict], now: Optional[datetime] = None) -> Dict[str, float]:
+        """
+        Điểm hành vi theo sách của một profile, cùng cách tính với aggregate_profiles.
+        Sự kiện không phải object hoặc không có bookId hợp lệ bị bỏ qua.
+        """
+        decay = TimeDecay(self.decay_half_life_days, now or now_utc()) if self.decay_half_life_days > 0 else None
+        scores: Dict[str, float] = {}
+        for event in events:
+            if not isinstance(event, dict):
+                continue
+            try:
+                book_id_str = str(int(event.get("bookId")))
+            except (TypeError, ValueError):
+                continue
+            score = event_score(event)
+            if decay is not None and decay.applies_to(event):
+                score *= decay.weight(_parse_time(event.get("occurredAt")))
+            scores[book_id_str] = scores.get(book_id_str, 0.0) + score
+        return scores
+
+    def recommend(self, events: List[Dict], top_k: Optional[int] = None) -> OrderedDict:
+        """Top-k (product_id -> điểm hành vi) cho một profile, giống một hàng kết quả của run_training."""
+        if top_k is None:
+            top_k = self.top_k
+        elif top_k <= 0:
+            raise ValueError("topK phải là số nguyên dương.")
+        self.reload()
+        with self._requests_lock:
+            self.requests += 1
+        pairs = [(pid, score) for pid, score in self.score_events(events).items() if score >= self.min_score]
+        if not pairs:
+            return OrderedDict()
+        pairs.sort(key=lambda item: item[1], reverse=True)
+        score_map = OrderedDict(pairs[:top_k])
+
+        cooccurrence = self.cooccurrence
+        weights = dict(EMBEDDING_RERANK_WEIGHTS)
+        if cooccurrence is not None:
+            weights["cooccurrence"] = self.cooccurrence_weight
+        ranked = rerank_profiles_with_embeddings(
+            {"profile": score_map},
+            book_meta=self.book_meta,
+            book_popularity=self.popularity,
+            top_k=top_k,
+            weights=weights,
+            index=self.index,
+            cooccurrence=cooccurrence,
+        )["profile"]
+        if self.related is None or not ranked:
+            return ranked
+        pids, base, flags = build_rerank_candidate_arrays(ranked, self.related)
+        best = HybridLLMReranker.heuristic_top_k(base, flags, top_k)
+        return OrderedDict((str(pid), score) for pid, score in zip(pids[best].tolist(), base[best].tolist()))
+
+    def handle(self, request: Dict) -> Dict[str, Any]:
+        """Xử lý một request JSON, trả về response JSON (lỗi đầu vào -> ValueError/TypeError)."""
+        if not isinstance(request, dict):
+            raise ValueError("Request phải là một object JSON.")
+        events = request.get("events")
+        if not isinstance(events, list):
+            raise ValueError("Request cần trường 'events' dạng list.")
+        top_k = request.get("topK")
+        # bool là lớp con của int trong Python nhưng không phải số lượng hợp lệ
+        if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k <= 0):
+            raise ValueError("topK phải là số nguyên dương.")
+        started = time.perf_counter()
+        ranked = self.recommend(events, top_k)
+        return {
+            "productIds": [int(pid) for pid in ranked],
+            "scores": [round(float(score), 6) for score in ranked.values()],
+            "latencyMs": round((time.perf_counter() - started) * 1000.0, 3),
+        }
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "books": len(self.index.book_ids),
+            "relatedTopN": self.related.top_n if self.related is not None else 0,
+            "popularityGeneratedAt": (
+                self.popularity_generated_at.isoformat() if self.popularity_generated_at else None
+            ),
+            "cooccurrence": self.cooccurrence is not None,
+            "requests": self.requests,
+        }
+
+
+def _make_handler(service: RecommendationService) -> type:
+    class RecommendationHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, payload: Dict[str, Any]) -> None:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self._send(200, service.health())
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if self.path != "/recommend":
+                self._send(404, {"error": "not found"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+                self._send(200, service.handle(request))
+            except (ValueError, TypeError, AttributeError) as exc:
+                self._send(400, {"error": str(exc)})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            # Không ghi log truy cập cho từng request (gây trễ khi tải cao)
+            return
+
+    return RecommendationHandler
+
+
+def serve_http(service: RecommendationService, host: str, port: int) -> None:
+    server = ThreadingHTTPServer((host, port), _make_handler(service))
+    print(f"[RecommendationServer] Đang lắng nghe http://{host}:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve_stdio(service: RecommendationService) -> None:
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        request: Dict[str, Any] = {}
+        try:
+            request = json.loads(line)
+            response = service.handle(request)
+        except (ValueError, TypeError, AttributeError) as exc:
+            response = {"error": str(exc)}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        sys.stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+
+def synthetic_requests(book_ids: List[int], count: int, seed: int = 13) -> List[Dict]:
+    """Request tổng hợp: mỗi profile 1–30 sự kiện ngẫu nhiên trên catalog trong 30 ngày gần đây."""
+    rng = random.Random(seed)
+    now = time.time()
+    event_types = list(EVENT_WEIGHTS)
+    requests: List[Dict] = []
+    for _ in range(count):
+        events = [
+            {
+                "bookId": rng.choice(book_ids),
+                "eventType": rng.choice(event_types),
+                "occurredAt": datetime.fromtimestamp(now - rng.uniform(0, 30 * 86_400), timezone.utc).isoformat(),
+            }
+            for _ in range(rng.randint(1, 30))
+        ]
+        requests.append({"events": events})
+    return requests
+
+
+def run_benchmark(service: RecommendationService, count: int, seed: int = 13) -> Dict[str, Any]:
+    """Độ trễ từng request (ms) đo trên service đã nạp sẵn; vài request đầu dùng để làm nóng."""
+    requests = synthetic_requests(list(service.index.book_ids), count, seed)
+    for request in requests[: min(10, count)]:
+        service.handle(request)
+    latencies = np.empty(count, dtype=np.float64)
+    for position, request in enumerate(requests):
+        started = time.perf_counter()
+        service.handle(request)
+        latencies[position] = (time.perf_counter() - started) * 1000.0
+    return {
+        "requests": count,
+        "books": len(service.index.book_ids),
+        "p50Ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95Ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99Ms": round(float(np.percentile(latencies, 99)), 3),
+        "maxMs": round(float(latencies.max()), 3),
+        "meanMs": round(float(latencies.mean()), 3),
+    }
+
+
+def main():
+    args = parse_args()
+    # stdout là kênh dữ liệu ở chế độ --stdio nên log khi khởi động được đẩy sang stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        started = time.perf_counter()
+        service = RecommendationService(
+            load_book_metadata(args.book_meta_json),
+            top_k=args.top_k,
+            min_score=args.min_score,
+            decay_half_life_days=args.decay_half_life_days,
+            popularity_path=str(Path(args.serving_dir) / POPULARITY_TOTALS_FILE) if args.serving_dir else None,
+            popularity_scale=args.popularity_scale,
+            cooccurrence_dir=args.cooccurrence_dir or None,
+            cooccurrence_weight=args.cooccurrence_weight,
+            reload_interval=args.reload_interval,
+            embedding_cache_dir=args.embedding_cache_dir or None,
+            ann_backend=args.ann_backend,
+            ann_nprobe=args.ann_nprobe,
+            related_top_n=args.related_top_n,
+            related_cache_dir=args.related_cache_dir or None,
+        )
+        startup_seconds = round(time.perf_counter() - started, 3)
+
+    if args.benchmark > 0:
+        report = run_benchmark(service, args.benchmark, args.seed)
+        report["startupSeconds"] = startup_seconds
+        print(json.dumps(report, ensure_ascii=False))
+    elif args.stdio:
+        serve_stdio(service)
+    else:
+        serve_http(service, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Bảng "sách liên quan" tính trước cho bước mở rộng ứng viên của apply_llm_rerank.
+
+Mỗi sách giữ tối đa `top_n` sách liên quan nhất theo điểm trùng danh mục (1.0), tác giả (0.6)
+và nhà xuất bản (0.4) — cùng trọng số với heuristic của HybridLLMReranker; hoà điểm thì
+product_id nhỏ hơn đứng trước. Bảng được lưu theo phiên bản catalog (dấu vân tay của
+product_id + category/author/publisher) dạng `.npy` đọc bằng memory-map:
+    <cache_dir>/<fingerprint>/book_ids.npy   product_id theo thứ tự hàng (tăng dần)
+    <cache_dir>/<fingerprint>/related.npy    product_id liên quan (N × top_n int32, đệm -1)
+    <cache_dir>/<fingerprint>/flags.npy      bitmask trùng 1=danh mục, 2=tác giả, 4=NXB
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = "ai/models/related_books"
+DEFAULT_TOP_N = 200
+
+SAME_CATEGORY = 1
+SAME_AUTHOR = 2
+SAME_PUBLISHER = 4
+
+# Điểm theo bitmask, nhân 10 để so sánh bằng số nguyên (1.0 / 0.6 / 0.4)
+_FLAG_SCORES = np.array([(m & 1) * 10 + (m >> 1 & 1) * 6 + (m >> 2 & 1) * 4 for m in range(8)], dtype=np.int64)
+_FIELDS = ("category_id", "author_id", "publisher_id")
+
+_INT32 = np.iinfo(np.int32)
+
+
+def _related_dtype(pids: np.ndarray) -> np.dtype:
+    """int32 cho bảng related (một nửa bộ nhớ của int64); int64 chỉ khi product_id vượt int32."""
+    if len(pids) and (pids[0] < _INT32.min or pids[-1] > _INT32.max):
+        return np.dtype(np.int64)
+    return np.dtype(np.int32)
+
+
+def _encode(values: list) -> Tuple[np.ndarray, Dict[int, np.ndarray]]:
+    """Mã hoá một trường metadata thành mã nguyên (None = -1) và posting list theo mã."""
+    codes: Dict[object, int] = {}
+    encoded = np.array(
+        [-1 if value is None else codes.setdefault(value, len(codes)) for value in values],
+        dtype=np.int64,
+    )
+    order = np.argsort(encoded, kind="stable")
+    sorted_codes = encoded[order]
+    postings: Dict[int, np.ndarray] = {}
+    boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+    for chunk in np.split(order, boundaries):
+        if len(chunk) and encoded[chunk[0]] >= 0:
+            postings[int(encoded[chunk[0]])] = chunk
+    return encoded, postings
+
+
+def catalog_fingerprint(book_meta: Dict[int, Dict], top_n: int) -> str:
+    digest = hashlib.sha1(f"top_n={top_n}".encode("utf-8"))
+    for pid in sorted(book_meta):
+        meta = book_meta[pid]
+        digest.update(repr((pid, *(meta.get(field) for field in _FIELDS))).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class RelatedBooksTable:
+    """Bảng top-N sách liên quan; tra cứu theo product_id trả về mảng kích thước cố định."""
+
+    def __init__(self, book_ids: np.ndarray, related: np.ndarray, flags: np.ndarray):
+        self.book_ids = book_ids
+        self.related = related
+        self.flags = flags
+        self._row_of = {int(pid): row for row, pid in enumerate(book_ids)}
+
+    @property
+    def top_n(self) -> int:
+        return int(self.related.shape[1]) if self.related.ndim == 2 else 0
+
+    def lookup(self, pid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(product_id liên quan, bitmask trùng) của một sách; rỗng nếu sách không có trong catalog."""
+        row = self._row_of.get(pid)
+        if row is None:
+            return np.empty(0, dtype=self.related.dtype), np.empty(0, dtype=np.uint8)
+        ids = self.related[row]
+        valid = ids >= 0
+        return ids[valid], self.flags[row][valid]
+
+    @classmethod
+    def build(cls, book_meta: Dict[int, Dict], top_n: int = DEFAULT_TOP_N) -> "RelatedBooksTable":
+        """
+        Tính bảng trên toàn catalog. Các sách cùng bộ (danh mục, tác giả, NXB) có chung tập
+        ứng viên nên chỉ tính một lần cho mỗi bộ rồi bỏ chính sách đó ra.
+        """
+        pids = np.array(sorted(book_meta), dtype=np.int64)
+        n_books = len(pids)
+        columns = [_encode([book_meta[int(pid)].get(field) for pid in pids]) for field in _FIELDS]
+        codes = np.stack([encoded for encoded, _ in columns], axis=1)
+
+        related = np.full((n_books, top_n), -1, dtype=_related_dtype(pids))
+        flags = np.zeros((n_books, top_n), dtype=np.uint8)
+        if not n_books or top_n <= 0:
+            return cls(pids, related, flags)
+
+        group_keys, group_of = np.unique(codes, axis=0, return_inverse=True)
+        group_of = group_of.reshape(-1)
+        members_order = np.argsort(group_of, kind="stable")
+        boundaries = np.flatnonzero(np.diff(group_of[members_order])) + 1
+        for members in np.split(members_order, boundaries):
+            key = group_keys[group_of[members[0]]]
+            postings = [
+                column_postings[int(code)]
+                for (_, column_postings), code in zip(columns, key)
+                if code >= 0
+            ]
+            if not postings:
+                continue
+            # Hàng đã sắp theo product_id nên thứ tự chỉ số cũng là thứ tự product_id
+            universe = np.unique(np.concatenate(postings))
+            mask = (
+                (codes[universe, 0] == key[0]) * SAME_CATEGORY
+                + (codes[universe, 1] == key[1]) * SAME_AUTHOR
+                + (codes[universe, 2] == key[2]) * SAME_PUBLISHER
+            ).astype(np.uint8)
+            # Khoá sắp xếp: điểm giảm dần, hoà thì vị trí (product_id) tăng dần
+            rank_key = -_FLAG_SCORES[mask] * len(universe) + np.arange(len(universe))
+            take = min(top_n + len(members), len(universe))
+            best = np.argpartition(rank_key, take - 1)[:take] if take < len(universe) else np.arange(len(universe))
+            best = best[np.argsort(rank_key[best], kind="stable")]
+            for row in members:
+                chosen = best[universe[best] != row][:top_n]
+                related[row, : len(chosen)] = pids[universe[chosen]]
+                flags[row, : len(chosen)] = mask[chosen]
+        return cls(pids, related, flags)
+
+    def save(self, path: Path) -> None:
+        path.mkdir(parents=True, exist_ok=True)
+        for name, array in (("book_ids", self.book_ids), ("related", self.related), ("flags", self.flags)):
+            tmp = path / f"{name}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, path / f"{name}.npy")
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["RelatedBooksTable"]:
+        files = [path / f"{name}.npy" for name in ("book_ids", "related", "flags")]
+        if not all(file.exists() for file in files):
+            return None
+        try:
+            book_ids, related, flags = (np.load(file, mmap_mode="r") for file in files)
+        except (OSError, ValueError) as exc:
+            print(f"[RelatedBooks] Bỏ qua bảng hỏng tại {path}: {exc}")
+            return None
+        return cls(np.asarray(book_ids), related, flags)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        book_meta: Dict[int, Dict],
+        *,
+        top_n: int = DEFAULT_TOP_N,
+        cache_dir: Optional[str | os.PathLike] = None,
+    ) -> "RelatedBooksTable":
+        """Nạp bảng của đúng phiên bản catalog nếu đã có, không thì tính rồi lưu lại."""
+        if not cache_dir:
+            return cls.build(book_meta, top_n)
+        path = Path(cache_dir) / catalog_fingerprint(book_meta, top_n)
+        table = cls.load(path)
+        if table is None:
+            table = cls.build(book_meta, top_n)
+            table.save(path)
+        return table
+
+
+__all__ = [
+    "RelatedBooksTable",
+    "catalog_fingerprint",
+    "DEFAULT_CACHE_DIR",
+    "DEFAULT_TOP_N",
+    "SAME_CATEGORY",
+    "SAME_AUTHOR",
+    "SAME_PUBLISHER",
+]
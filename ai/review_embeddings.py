@@ -0,0 +1,116 @@
+"""
+Per-run store of review sentence embeddings shared by the topic stages.
+
+BERTopic embeds every document it is given: once for all reviews in `fit`, then
+again for the positive and negative subsets in `transform`. The store encodes each
+distinct review text once per run (in batches), hands the vectors to BERTopic as
+precomputed embeddings and can persist them through `EmbeddingCache`, so reviews
+resent by the backend are not re-encoded on the next run either:
+    <cache_dir>/<model>/embeddings.npy, keys.npy
+Vectors are left unnormalized, exactly as BERTopic would compute them itself.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from embedding_cache import EmbeddingCache, content_key
+
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Kept apart from the (normalized) book embedding cache of the recommendation rerank
+DEFAULT_CACHE_DIR = "ai/models/review_embedding_cache"
+DEFAULT_BATCH_SIZE = 64
+
+
+class ReviewEmbeddingStore:
+    """Text -> embedding for one run, backed by an optional on-disk cache."""
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL_NAME,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        cache_dir: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache = EmbeddingCache(cache_dir, model_name) if cache_dir else None
+        self._model: Optional[SentenceTransformer] = None
+        self._rows: Dict[str, int] = {}
+        self._vectors: List[np.ndarray] = []
+        self.texts_requested = 0
+        self.texts_encoded = 0
+        self.encode_calls = 0
+
+    @property
+    def model(self) -> SentenceTransformer:
+        """The SentenceTransformer, loaded on first use (not at all if every text is cached)."""
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embeddings for `texts` in order; only texts unseen in this run and the cache are encoded."""
+        self.texts_requested += len(texts)
+        new_texts = list(dict.fromkeys(text for text in texts if text not in self._rows))
+        if new_texts:
+            missing = list(range(len(new_texts)))
+            positions: List[int] = []
+            if self.cache is not None:
+                positions, missing = self.cache.lookup(
+                    [content_key(self.model_name, text) for text in new_texts]
+                )
+            encoded = self._encode([new_texts[idx] for idx in missing]) if missing else None
+
+            dim = encoded.shape[1] if encoded is not None else self.cache.matrix.shape[1]
+            vectors = np.empty((len(new_texts), dim), dtype=np.float32)
+            cached = [idx for idx, pos in enumerate(positions) if pos >= 0]
+            if cached:
+                vectors[cached] = self.cache.vectors([positions[idx] for idx in cached])
+            if encoded is not None:
+                vectors[missing] = encoded
+
+            for text, vector in zip(new_texts, vectors):
+                self._rows[text] = len(self._vectors)
+                self._vectors.append(vector)
+
+        if not texts:
+            return np.empty((0, self._vectors[0].shape[0] if self._vectors else 0), dtype=np.float32)
+        return np.stack([self._vectors[self._rows[text]] for text in texts])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        self.encode_calls += 1
+        self.texts_encoded += len(texts)
+        return np.asarray(
+            self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=len(texts) >= self.batch_size,
+            ),
+            dtype=np.float32,
+        )
+
+    def save(self) -> None:
+        """Persist the embeddings of this run's reviews (older reviews drop out of the cache)."""
+        if self.cache is None or not self._rows:
+            return
+        keys = [content_key(self.model_name, text) for text in self._rows]
+        if not self.cache.is_current(keys):
+            self.cache.save(keys, np.stack(self._vectors))
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "model": self.model_name,
+            "texts_requested": self.texts_requested,
+            "texts_encoded": self.texts_encoded,
+            "encodes_saved": self.texts_requested - self.texts_encoded,
+            "encode_calls": self.encode_calls,
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
+
+__all__ = ["ReviewEmbeddingStore", "DEFAULT_MODEL_NAME", "DEFAULT_CACHE_DIR"]
@@ -0,0 +1,138 @@
+"""
+Persistent cache of review sentiment predictions.
+
+The backend resends mostly the same recent reviews on every pipeline run, so
+predictions are stored per (model fingerprint, normalized review text hash) and
+only unseen texts go through the model. The fingerprint changes whenever the
+fine-tuned model directory is retrained, which invalidates old entries without
+having to delete them. Data lives in one SQLite file (WAL):
+    <cache_dir>/sentiment.sqlite3
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Sequence, Tuple
+
+
+DEFAULT_CACHE_DIR = "ai/models/sentiment_cache"
+
+# Files up to this size are hashed by content; larger ones (weights) by size + mtime
+_CONTENT_HASH_LIMIT = 1 << 20
+# SQLite limits the number of bound parameters per statement
+_LOOKUP_CHUNK = 500
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_review_text(text: str) -> str:
+    """Unicode NFC with whitespace collapsed, so formatting-only edits share a cache entry."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", str(text))).strip()
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_review_text(text).encode("utf-8")).hexdigest()
+
+
+def model_fingerprint(model_path: str, fallback_model: str) -> str:
+    """Identify the model `load_sentiment_model` would load for these arguments."""
+    resolved = Path(model_path)
+    if not resolved.exists():
+        return "hf:" + fallback_model
+
+    digest = hashlib.sha1()
+    for file in sorted(path for path in resolved.rglob("*") if path.is_file()):
+        stat = file.stat()
+        digest.update(str(file.relative_to(resolved)).encode("utf-8"))
+        if stat.st_size <= _CONTENT_HASH_LIMIT:
+            digest.update(file.read_bytes())
+        else:
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return "dir:" + digest.hexdigest()
+
+
+class SentimentCache:
+    """Map text key -> (label, score) for one model fingerprint."""
+
+    def __init__(self, cache_dir: str | Path, fingerprint: str):
+        self.path = Path(cache_dir) / "sentiment.sqlite3"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.inference_seconds = 0.0
+        # Inference time the hits would have cost, from the per-review time stored with each entry
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " model TEXT NOT NULL, key TEXT NOT NULL, label TEXT NOT NULL, score REAL NOT NULL,"
+            " seconds REAL NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (model, key))"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, Tuple[str, float]]:
+        """Cached (label, score) for the keys found; hit/miss counters follow `keys` as given."""
+        found: Dict[str, Tuple[str, float]] = {}
+        counts = Counter(keys)
+        unique = list(counts)
+        with self._lock:
+            for start in range(0, len(unique), _LOOKUP_CHUNK):
+                chunk = unique[start : start + _LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    "SELECT key, label, score, seconds FROM predictions"
+                    f" WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                    (self.fingerprint, *chunk),
+                ).fetchall()
+                for key, label, score, seconds in rows:
+                    found[key] = (label, float(score))
+                    self.saved_seconds += float(seconds) * counts[key]
+            hits = sum(counts[key] for key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, entries: Iterable[Tuple[str, str, float]], seconds_per_text: float) -> None:
+        """Store (key, label, score) rows predicted at `seconds_per_text` each."""
+        now = time.time()
+        rows = [(self.fingerprint, key, label, float(score), seconds_per_text, now) for key, label, score in entries]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO predictions (model, key, label, score, seconds, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self.hits + self.misses
+        return {
+            "path": str(self.path),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "inference_seconds": round(self.inference_seconds, 3),
+            "inference_seconds_saved": round(self.saved_seconds, 3),
+        }
+
+
+__all__ = [
+    "SentimentCache",
+    "model_fingerprint",
+    "normalize_review_text",
+    "text_key",
+    "DEFAULT_CACHE_DIR",
+]
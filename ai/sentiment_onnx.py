@@ -0,0 +1,180 @@
+"""
+ONNX Runtime backend for the sentiment model on CPU-only hosts.
+
+The fine-tuned model (or the public fallback checkpoint) is exported to ONNX once,
+quantized with dynamic int8 weights and cached per model fingerprint:
+    <cache_dir>/<sha1(fingerprint)>/model_quantized.onnx   + tokenizer/config files
+Export and inference go through `optimum[onnxruntime]`, which is optional: when it
+is missing, or the export fails, callers fall back to the PyTorch pipeline.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import importlib
+import numbers
+import platform
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from sentiment_cache import model_fingerprint
+
+
+SENTIMENT_BACKENDS = ("torch", "onnx")
+DEFAULT_ONNX_CACHE_DIR = "ai/models/sentiment_onnx"
+QUANTIZED_FILE = "model_quantized.onnx"
+# Appended to the model fingerprint of the prediction cache: int8 scores differ slightly
+ONNX_FINGERPRINT_SUFFIX = ":onnx-int8"
+
+
+def _load_optimum() -> Optional[Any]:
+    try:
+        return importlib.import_module("optimum.onnxruntime")
+    except ImportError:
+        return None
+
+
+def _resolve_source(model_path: str, fallback_model: str) -> str:
+    """Same model `load_sentiment_model` would load: the local directory if present."""
+    return str(Path(model_path)) if Path(model_path).exists() else fallback_model
+
+
+def export_quantized_onnx(
+    model_path: str,
+    fallback_model: str,
+    cache_dir: str = DEFAULT_ONNX_CACHE_DIR,
+) -> Optional[Path]:
+    """Directory with the int8 ONNX export of the current model, exporting it if needed.
+
+    Returns None (after printing why) when optimum/onnxruntime is not installed or the
+    export fails, so the caller can keep using the PyTorch pipeline.
+    """
+    fingerprint = model_fingerprint(model_path, fallback_model)
+    target = Path(cache_dir) / hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+    if (target / QUANTIZED_FILE).exists():
+        return target
+
+    optimum = _load_optimum()
+    if optimum is None:
+        print("[Sentiment] optimum[onnxruntime] is not installed; using the PyTorch backend.")
+        return None
+
+    source = _resolve_source(model_path, fallback_model)
+    staging = target.with_name(target.name + ".tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    try:
+        transformers = importlib.import_module("transformers")
+        configuration = importlib.import_module("optimum.onnxruntime.configuration")
+        print(f"[Sentiment] Exporting `{source}` to ONNX (dynamic int8) at: {target}")
+        model = optimum.ORTModelForSequenceClassification.from_pretrained(source, export=True)
+        model.save_pretrained(staging)
+        transformers.AutoTokenizer.from_pretrained(source).save_pretrained(staging)
+
+        machine = platform.machine().lower()
+        if machine in ("arm64", "aarch64"):
+            qconfig = configuration.AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+        else:
+            qconfig = configuration.AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer = optimum.ORTQuantizer.from_pretrained(staging)
+        quantizer.quantize(save_dir=staging, quantization_config=qconfig)
+    except Exception as exc:  # noqa: BLE001 - any export failure falls back to torch
+        shutil.rmtree(staging, ignore_errors=True)
+        print(f"[Sentiment] ONNX export failed ({exc}); using the PyTorch backend.")
+        return None
+
+    shutil.rmtree(target, ignore_errors=True)
+    staging.rename(target)
+    return target
+
+
+def load_onnx_sentiment_pipeline(export_dir: Path):
+    """Hugging Face sentiment pipeline running the quantized model on ONNX Runtime."""
+    optimum = _load_optimum()
+    transformers = importlib.import_module("transformers")
+    model = optimum.ORTModelForSequenceClassification.from_pretrained(
+        str(export_dir), file_name=QUANTIZED_FILE
+    )
+    tokenizer = transformers.AutoTokenizer.from_pretrained(str(export_dir))
+    return transformers.pipeline("sentiment-analysis", model=model, tokenizer=tokenizer)
+
+
+def _polarity(label: Any) -> Optional[str]:
+    """"positive"/"negative" for a model or gold label: names, LABEL_1/LABEL_0 or 1/0."""
+    if isinstance(label, numbers.Real):
+        if label == 1:
+            return "positive"
+        if label == 0:
+            return "negative"
+        return None
+    text = str(label or "").strip().upper()
+    if "POS" in text or text in ("LABEL_1", "1"):
+        return "positive"
+    if "NEG" in text or text in ("LABEL_0", "0"):
+        return "negative"
+    return None
+
+
+def compare_sentiment_backends(
+    texts: Sequence[str],
+    reference_pipeline,
+    candidate_pipeline,
+    gold_labels: Optional[Sequence[Any]] = None,
+    batch_size: int = 32,
+) -> Dict[str, Any]:
+    """Accuracy parity of two pipelines on the same texts.
+
+    Reports label agreement, score differences and, when ``gold_labels`` are given
+    ("positive"/"negative" or 1/0; others are skipped), the accuracy of each pipeline.
+    """
+    texts = [str(text) for text in texts]
+    outputs: List[List[Dict[str, Any]]] = []
+    seconds: List[float] = []
+    for pipe in (reference_pipeline, candidate_pipeline):
+        started = time.perf_counter()
+        outputs.append(list(pipe(texts, truncation=True, batch_size=batch_size)))
+        seconds.append(time.perf_counter() - started)
+    reference, candidate = outputs
+
+    agree = sum(1 for ref, cand in zip(reference, candidate) if ref["label"] == cand["label"])
+    score_diffs = [
+        abs(float(ref["score"]) - float(cand["score"]))
+        for ref, cand in zip(reference, candidate)
+        if ref["label"] == cand["label"]
+    ]
+    report: Dict[str, Any] = {
+        "reviews": len(texts),
+        "label_agreement": round(agree / len(texts), 4) if texts else 0.0,
+        "max_score_diff": round(max(score_diffs), 4) if score_diffs else 0.0,
+        "mean_score_diff": round(sum(score_diffs) / len(score_diffs), 4) if score_diffs else 0.0,
+        "reference_seconds": round(seconds[0], 3),
+        "candidate_seconds": round(seconds[1], 3),
+        "speedup": round(seconds[0] / seconds[1], 2) if seconds[1] > 0 else None,
+    }
+
+    if gold_labels is not None:
+        scored = [
+            (gold, ref, cand)
+            for gold, ref, cand in zip((_polarity(label) for label in gold_labels), reference, candidate)
+            if gold is not None
+        ]
+        if scored:
+            report["labelled_reviews"] = len(scored)
+            report["reference_accuracy"] = round(
+                sum(gold == _polarity(ref["label"]) for gold, ref, _ in scored) / len(scored), 4
+            )
+            report["candidate_accuracy"] = round(
+                sum(gold == _polarity(cand["label"]) for gold, _, cand in scored) / len(scored), 4
+            )
+    return report
+
+
+__all__ = [
+    "SENTIMENT_BACKENDS",
+    "DEFAULT_ONNX_CACHE_DIR",
+    "ONNX_FINGERPRINT_SUFFIX",
+    "compare_sentiment_backends",
+    "export_quantized_onnx",
+    "load_onnx_sentiment_pipeline",
+]
@@ -16,25 +16,70 @@ import json
 from collections import Counter, defaultdict, OrderedDict
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
+import multiprocessing
 import os
+import threading
+import time
+import sys
+import urllib.request
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from queue import Empty, Full
 
 import importlib
 
 MongoClient: Any
+UpdateOne: Any
+DeleteOne: Any
+PyMongoError: Any
 try:
-    MongoClient = importlib.import_module("pymongo").MongoClient
+    _pymongo = importlib.import_module("pymongo")
+    MongoClient = _pymongo.MongoClient
+    UpdateOne = _pymongo.UpdateOne
+    DeleteOne = _pymongo.DeleteOne
+    PyMongoError = importlib.import_module("pymongo.errors").PyMongoError
 except ImportError as _pymongo_exc:  # pragma: no cover
     MongoClient = None  # type: ignore[assignment]
+    UpdateOne = None  # type: ignore[assignment]
+    DeleteOne = None  # type: ignore[assignment]
+    PyMongoError = Exception  # type: ignore[assignment]
     _PYMONGO_IMPORT_ERROR = _pymongo_exc
 else:
     _PYMONGO_IMPORT_ERROR = None
 
+try:
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None  # type: ignore[assignment]
+
+import numpy as np
+
+from profile_store import ProfileStore
+from ann_index import ANN_BACKENDS
+from embedding_cache import DEFAULT_CACHE_DIR as DEFAULT_EMBEDDING_CACHE_DIR, EmbeddingCache
+from related_books import (
+    DEFAULT_CACHE_DIR as DEFAULT_RELATED_BOOKS_DIR,
+    DEFAULT_TOP_N as DEFAULT_RELATED_TOP_N,
+    SAME_AUTHOR,
+    SAME_CATEGORY,
+    SAME_PUBLISHER,
+    RelatedBooksTable,
+)
+from cooccurrence import DEFAULT_MODEL_DIR as DEFAULT_COOCCURRENCE_DIR, CooccurrenceModel
+from event_snapshot import export_snapshot, iter_snapshot_batches, read_manifest, snapshot_reference_time
+from llm_response_cache import DEFAULT_CACHE_DIR as DEFAULT_LLM_CACHE_DIR, LLMResponseCache, candidate_key
 from embedding_rerank import (
     DEFAULT_MODEL_NAME as EMBEDDING_MODEL_NAME,
-    aggregate_book_popularity,
+    DEFAULT_RERANK_MEMORY_MB,
+    POPULARITY_SCALES,
+    EmbeddingIndex,
+    popularity_from_totals,
+    popularity_totals,
+    rerank_block_size,
     rerank_profiles_with_embeddings,
+    save_popularity_totals,
 )
 
 # Các giá trị mặc định (có thể override bằng tham số CLI)
@@ -43,9 +88,37 @@ DEFAULT_DB_NAME = "customer_tracking"
 DEFAULT_EVENTS_COLLECTION = "recommendation_feedbacks"
 DEFAULT_PROFILES_COLLECTION = "profiles"
 DEFAULT_RECOMMENDATIONS_COLLECTION = "recommendations"
+DEFAULT_STATE_COLLECTION = "recommendation_training_state"
+
+# Thư mục chứa dữ liệu do lượt huấn luyện để lại cho tiến trình phục vụ (recommendation_server.py)
+DEFAULT_SERVING_DIR = "ai/models/serving"
+POPULARITY_TOTALS_FILE = "popularity.npz"
+
+# Kích thước lô bulk_write và số lần thử lại khi một lô bị lỗi
+DEFAULT_WRITE_BATCH_SIZE = 1000
+DEFAULT_WRITE_RETRIES = 2
+
+# Số sự kiện mỗi lô khi đọc bằng find_raw_batches (--ingest raw-batches)
+DEFAULT_INGEST_BATCH_SIZE = 10_000
+
+# Cách khởi tạo worker ở chế độ --workers: "spawn" vì MongoClient không an toàn khi fork
+SHARD_START_METHOD = "spawn"
+# Số lô sự kiện tối đa chờ trong hàng đợi của mỗi shard (giới hạn bộ nhớ của tiến trình điều phối)
+SHARD_QUEUE_BATCHES = 4
+# Dời mốc suy giảm của profile khi mốc đã cũ hơn số chu kỳ bán rã này (2^32 vẫn an toàn với float64)
+DECAY_REBASE_HALF_LIVES = 32.0
+
+# Số request LLM rerank chạy đồng thời và timeout (giây) cho mỗi request
+DEFAULT_LLM_MAX_IN_FLIGHT = 4
+DEFAULT_LLM_TIMEOUT = 30.0
+
+# Khoá đặc biệt trong collection state để lưu high-water mark của lần chạy trước
+WATERMARK_STATE_KEY = "__watermark__"
 
 # Trọng số mặc định cho điểm hành vi / embedding / độ phổ biến khi rerank
 EMBEDDING_RERANK_WEIGHTS = {"behavior": 0.6, "embedding": 0.3, "popularity": 0.1}
+# Trọng số mặc định của điểm đồng xuất hiện item-item khi bật --cooccurrence-top-n
+DEFAULT_COOCCURRENCE_WEIGHT = 0.2
 
 # Thang điểm rút gọn nếu sự kiện không có finalScore/value riêng
 EVENT_WEIGHTS = {
@@ -61,8 +134,8 @@ def now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
 
-def parse_args() -> argparse.Namespace:
-    """Đọc tham số dòng lệnh và trả về Namespace."""
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Đọc tham số dòng lệnh (mặc định sys.argv) và trả về Namespace."""
     parser = argparse.ArgumentParser(description="Huấn luyện gợi ý cá nhân hoá từ MongoDB.")
     parser.add_argument("--mongo-uri", default=DEFAULT_MONGO_URI, help="Chuỗi kết nối MongoDB.")
     parser.add_argument("--mongo-db", default=DEFAULT_DB_NAME, help="Tên database MongoDB.")
@@ -103,24 +176,216 @@ def parse_args() -> argparse.Namespace:
         "--max-profiles",
         type=int,
         default=0,
-        help="Giới hạn số profile xử lý (0 = tất cả, hữu ích khi debug).",
+        help="Giới hạn số profile xử lý (0 = tất cả, hữu ích khi debug; với --workers áp dụng cho từng shard).",
     )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Chỉ tính toán, không ghi kết quả vào MongoDB.",
     )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        default=DEFAULT_EMBEDDING_CACHE_DIR,
+        help="Thư mục cache embedding sách theo nội dung (chuỗi rỗng = tắt cache).",
+    )
+    parser.add_argument(
+        "--ann-backend",
+        choices=ANN_BACKENDS,
+        default="exact",
+        help=(
+            "Tìm sách tương tự: exact (quét toàn bộ), hoặc ANN gần đúng: auto, faiss-hnsw "
+            "(= faiss), faiss-ivf, numpy (IVF thuần NumPy)."
+        ),
+    )
+    parser.add_argument(
+        "--ann-nprobe",
+        type=int,
+        default=8,
+        help="Số cụm IVF quét mỗi truy vấn (HNSW: efSearch = 16 × nprobe).",
+    )
+    parser.add_argument(
+        "--popularity-scale",
+        choices=POPULARITY_SCALES,
+        default="linear",
+        help="Thang độ phổ biến dùng khi rerank: tổng điểm tuyến tính hoặc log1p.",
+    )
+    parser.add_argument(
+        "--popularity-half-life-days",
+        type=float,
+        default=0.0,
+        help=(
+            "Chu kỳ bán rã (ngày) theo lần tương tác cuối của profile khi tính độ phổ biến dùng cho "
+            "rerank (0 = tắt). Độc lập với --decay-half-life-days: khi bật cả hai, độ phổ biến là tổng "
+            "điểm đã suy giảm theo từng sự kiện rồi lại nhân hệ số theo lần tương tác cuối. Với "
+            "--incremental, chỉ các profile được ghi lại trong lượt chạy mới dùng độ phổ biến mới."
+        ),
+    )
+    parser.add_argument(
+        "--decay-half-life-days",
+        type=float,
+        default=0.0,
+        help=(
+            "Chu kỳ bán rã (ngày) của điểm từng sự kiện, áp ngay khi gom điểm nên ảnh hưởng cả điểm "
+            "profile lẫn độ phổ biến (0 = tắt; bỏ qua finalScore). Với --incremental, mọi profile có "
+            "điểm suy giảm được ghi lại ở mỗi lượt chạy."
+        ),
+    )
+    parser.add_argument(
+        "--cooccurrence-top-n",
+        type=int,
+        default=0,
+        help="Số láng giềng đồng xuất hiện giữ cho mỗi sách, dùng làm nguồn ứng viên khi rerank (0 = tắt).",
+    )
+    parser.add_argument(
+        "--cooccurrence-dir",
+        default=DEFAULT_COOCCURRENCE_DIR,
+        help="Thư mục lưu mô hình đồng xuất hiện để cập nhật tăng dần ở lần chạy sau (chuỗi rỗng = không lưu).",
+    )
+    parser.add_argument(
+        "--cooccurrence-weight",
+        type=float,
+        default=DEFAULT_COOCCURRENCE_WEIGHT,
+        help="Trọng số điểm đồng xuất hiện trong rerank embedding.",
+    )
+    parser.add_argument(
+        "--rerank-block-size",
+        type=int,
+        default=None,
+        help=(
+            "Số profile rerank embedding cùng lúc bằng phép toán ma trận (0 = từng profile; "
+            "mặc định suy ra từ --rerank-memory-mb và số sách)."
+        ),
+    )
+    parser.add_argument(
+        "--rerank-memory-mb",
+        type=float,
+        default=DEFAULT_RERANK_MEMORY_MB,
+        help="Bộ nhớ tạm cho mỗi khối rerank (ma trận profile × sách ~12 byte/ô) khi không đặt --rerank-block-size.",
+    )
+    parser.add_argument(
+        "--write-batch-size",
+        type=int,
+        default=DEFAULT_WRITE_BATCH_SIZE,
+        help="Số thao tác upsert trong mỗi lô bulk_write.",
+    )
+    parser.add_argument(
+        "--write-retries",
+        type=int,
+        default=DEFAULT_WRITE_RETRIES,
+        help="Số lần thử lại một lô bulk_write bị lỗi.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Số tiến trình; >1 chia profile theo hash thành từng shard xử lý song song "
+            "(tiến trình điều phối đọc sự kiện một lần rồi chuyển cho shard sở hữu)."
+        ),
+    )
+    parser.add_argument(
+        "--parallel-writes",
+        action="store_true",
+        help="Ghi collection profiles và recommendations đồng thời.",
+    )
+    parser.add_argument(
+        "--related-top-n",
+        type=int,
+        default=DEFAULT_RELATED_TOP_N,
+        help="Số sách liên quan tính sẵn cho mỗi sách khi mở rộng ứng viên (0 = toàn bộ posting list).",
+    )
+    parser.add_argument(
+        "--related-cache-dir",
+        default=DEFAULT_RELATED_BOOKS_DIR,
+        help="Thư mục lưu bảng sách liên quan theo phiên bản catalog (chuỗi rỗng để không lưu).",
+    )
+    parser.add_argument(
+        "--llm-max-in-flight",
+        type=int,
+        default=DEFAULT_LLM_MAX_IN_FLIGHT,
+        help="Số request LLM rerank tối đa chạy đồng thời (1 = tuần tự).",
+    )
+    parser.add_argument(
+        "--llm-rate-limit",
+        type=float,
+        default=0.0,
+        help="Số request LLM tối đa mỗi giây (token bucket, 0 = không giới hạn).",
+    )
+    parser.add_argument(
+        "--llm-timeout",
+        type=float,
+        default=DEFAULT_LLM_TIMEOUT,
+        help="Timeout (giây) cho mỗi request LLM; quá hạn thì fallback heuristic.",
+    )
+    parser.add_argument(
+        "--llm-cache-dir",
+        default=DEFAULT_LLM_CACHE_DIR,
+        help="Thư mục cache phản hồi LLM theo tập ứng viên (chuỗi rỗng để tắt).",
+    )
     parser.add_argument(
         "--report-json",
         default=None,
         help="Đường dẫn file JSON để ghi lại báo cáo huấn luyện.",
     )
+    parser.add_argument(
+        "--aggregation-engine",
+        choices=["python", "mongo"],
+        default="python",
+        help="Nơi gom điểm profile: python (duyệt từng sự kiện) hoặc mongo (pipeline $group trên server).",
+    )
+    parser.add_argument(
+        "--profile-store",
+        choices=["dict", "columnar"],
+        default="dict",
+        help="Cấu trúc gom điểm: dict lồng nhau hoặc ProfileStore dạng cột (tiết kiệm bộ nhớ).",
+    )
+    parser.add_argument(
+        "--ingest",
+        choices=("cursor", "raw-batches"),
+        default="raw-batches",
+        help="Cách đọc sự kiện với engine python: cursor từng document hoặc lô BSON thô giải mã theo khối.",
+    )
+    parser.add_argument(
+        "--ingest-batch-size",
+        type=int,
+        default=DEFAULT_INGEST_BATCH_SIZE,
+        help="Số sự kiện mỗi lô khi đọc dữ liệu.",
+    )
+    parser.add_argument(
+        "--export-snapshot",
+        default=None,
+        help="Xuất sự kiện trong cửa sổ history_days ra thư mục snapshot (NPZ theo ngày) rồi thoát.",
+    )
+    parser.add_argument(
+        "--events-snapshot",
+        default=None,
+        help="Đọc sự kiện từ thư mục snapshot thay vì collection MongoDB (chỉ engine python).",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Chỉ đọc sự kiện mới kể từ watermark lần trước và cập nhật các profile bị thay đổi. "
+            "Watermark theo occurredAt: sự kiện đến muộn (occurredAt trước watermark) chỉ được "
+            "tính ở lượt chạy đầy đủ kế tiếp."
+        ),
+    )
+    parser.add_argument(
+        "--state-collection",
+        default=DEFAULT_STATE_COLLECTION,
+        help="Collection lưu watermark + điểm tích luỹ theo ngày cho chế độ --incremental.",
+    )
+    parser.add_argument(
+        "--serving-dir",
+        default=DEFAULT_SERVING_DIR,
+        help="Thư mục ghi tổng độ phổ biến cho recommendation_server.py (chuỗi rỗng = không ghi).",
+    )
     parser.add_argument(
         "--book-meta-json",
         default=None,
         help="(Tuỳ chọn) file JSON chứa metadata sách (category/author/publisher) để LLM ưu tiên sách liên quan.",
     )
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def normalize_key(event: Dict) -> str | None:
@@ -155,15 +420,116 @@ def event_score(event: Dict) -> float:
     return 1.0
 
 
-def iter_events(collection, history_days: int) -> Iterable[Dict]:
-    """Iterator trả về các sự kiện phù hợp với khoảng thời gian yêu cầu."""
-    query = {}
+class TimeDecay:
+    """
+    Suy giảm điểm theo thời gian: sự kiện cách mốc `now` một khoảng Δ được nhân 0.5^(Δ/half_life).
+
+    Điểm được tích luỹ trong "hệ quy chiếu" của một mốc cố định `anchor`: mỗi sự kiện góp
+    score · 2^((t - anchor)/H). Giá trị tại thời điểm bất kỳ = tổng đã lưu · 2^(-(now - anchor)/H),
+    nên tổng đã lưu có thể cộng thêm sự kiện mới hoặc dời mốc (rebase) chỉ bằng một phép nhân,
+    không phải tính lại từ sự kiện thô. Sự kiện không có thời gian được coi như xảy ra tại anchor.
+    Không áp cho finalScore (backend đã tự tính decay nếu gửi finalScore).
+    """
+
+    def __init__(self, half_life_days: float, anchor: datetime):
+        self.half_life_days = float(half_life_days)
+        self.anchor = anchor if anchor.tzinfo is not None else anchor.replace(tzinfo=timezone.utc)
+        self._half_life_seconds = self.half_life_days * 86_400.0
+        self._anchor_seconds = self.anchor.timestamp()
+
+    def half_lives_since_anchor(self, moment: datetime) -> float:
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return (moment.timestamp() - self._anchor_seconds) / self._half_life_seconds
+
+    def weight(self, occurred_at: Any) -> float:
+        """Hệ số của một sự kiện trong hệ quy chiếu anchor."""
+        if not isinstance(occurred_at, datetime):
+            return 1.0
+        return 2.0 ** self.half_lives_since_anchor(occurred_at)
+
+    def weights(self, occurred_at: Iterable[Any]) -> np.ndarray:
+        """Bản vector hoá của weight() cho cả một lô sự kiện."""
+        seconds = np.fromiter(
+            (
+                (value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)).timestamp()
+                if isinstance(value, datetime)
+                else np.nan
+                for value in occurred_at
+            ),
+            dtype=np.float64,
+        )
+        exponents = (seconds - self._anchor_seconds) / self._half_life_seconds
+        return np.where(np.isnan(exponents), 1.0, np.exp2(exponents))
+
+    def scale_to(self, moment: datetime) -> float:
+        """Hệ số đổi tổng đã lưu (hệ quy chiếu anchor) thành điểm đã suy giảm tại `moment`."""
+        return 2.0 ** -self.half_lives_since_anchor(moment)
+
+    def applies_to(self, event: Dict) -> bool:
+        return event.get("finalScore") is None
+
+
+def build_events_query(
+    history_days: int,
+    after: Optional[Tuple[datetime, Any]] = None,
+) -> Dict:
+    """Dựng điều kiện lọc sự kiện theo cửa sổ history_days và (tuỳ chọn) watermark."""
+    conditions: List[Dict] = []
     if history_days > 0:
         since = now_utc() - timedelta(days=history_days)
-        query["occurredAt"] = {"$gte": since}
+        conditions.append({"occurredAt": {"$gte": since}})
+    if after is not None:
+        last_at, last_id = after
+        conditions.append(
+            {
+                "$or": [
+                    {"occurredAt": {"$gt": last_at}},
+                    {"occurredAt": last_at, "_id": {"$gt": last_id}},
+                ]
+            }
+        )
+
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def iter_events(
+    collection,
+    history_days: int,
+    *,
+    after: Optional[Tuple[datetime, Any]] = None,
+    ordered: bool = False,
+) -> Iterable[Dict]:
+    """
+    Iterator trả về các sự kiện phù hợp với khoảng thời gian yêu cầu.
+    Với `ordered=True` (chế độ incremental) sự kiện được sắp theo (occurredAt, _id) và giữ
+    lại `_id` để cập nhật watermark; nếu truyền `after=(occurredAt, _id)` thì chỉ lấy các
+    sự kiện nằm sau watermark đó. Thứ tự này dựa vào index của ensure_event_indexes;
+    allowDiskUse chỉ là lưới an toàn khi index chưa có.
+
+    Lưu ý: watermark theo occurredAt (thời điểm xảy ra), nên sự kiện được ghi muộn với
+    occurredAt nhỏ hơn watermark sẽ không bao giờ được gộp ở chế độ incremental; chạy lại
+    một lượt đầy đủ (không --incremental) để đưa chúng vào.
+    """
+    query, projection, sort = _event_find_spec(history_days, after, ordered)
+    if sort:
+        return collection.find(query, projection, sort=sort, allow_disk_use=True)
+    return collection.find(query, projection)
 
+
+def _event_find_spec(
+    history_days: int,
+    after: Optional[Tuple[datetime, Any]],
+    ordered: bool,
+) -> Tuple[Dict, Dict, Optional[List[Tuple[str, int]]]]:
+    """(query, projection, sort) dùng chung cho iter_events và iter_event_batches."""
+    ordered = ordered or after is not None
     projection = {
-        "_id": 0,
+        "_id": 1 if ordered else 0,
         "userId": 1,
         "sessionId": 1,
         "bookId": 1,
@@ -172,34 +538,148 @@ def iter_events(collection, history_days: int) -> Iterable[Dict]:
         "value": 1,
         "occurredAt": 1,
     }
-    return collection.find(query, projection)
+    sort = [("occurredAt", 1), ("_id", 1)] if ordered else None
+    return build_events_query(history_days, after), projection, sort
+
+
+def iter_event_batches(
+    collection,
+    history_days: int,
+    *,
+    after: Optional[Tuple[datetime, Any]] = None,
+    ordered: bool = False,
+    batch_size: int = DEFAULT_INGEST_BATCH_SIZE,
+) -> Iterable[List[Dict]]:
+    """
+    Đọc sự kiện theo lô lớn bằng find_raw_batches: mỗi lô là một khối BSON thô được giải mã
+    một lần bằng bson.decode_all (C) thay vì dựng từng document qua cursor.
+    Cùng bộ lọc/projection/thứ tự với iter_events.
+    """
+    decode_all = importlib.import_module("bson").decode_all
+    query, projection, sort = _event_find_spec(history_days, after, ordered)
+    options: Dict[str, Any] = {"batch_size": batch_size}
+    if sort:
+        options.update(sort=sort, allow_disk_use=True)
+    for chunk in collection.find_raw_batches(query, projection, **options):
+        yield decode_all(chunk, collection.codec_options)
+
+
+EVENT_ORDER_INDEX = [("occurredAt", 1), ("_id", 1)]
+
+
+def ensure_event_indexes(collection) -> None:
+    """
+    Index (occurredAt, _id) phục vụ thứ tự đọc của chế độ incremental; thiếu nó thì lượt
+    chạy đầu trên collection lớn phải sắp xếp toàn bộ trong bộ nhớ (giới hạn 100 MB).
+    create_index không làm gì nếu index đã tồn tại.
+    """
+    collection.create_index(EVENT_ORDER_INDEX, name="occurredAt_1__id_1")
+
+
+def flatten_batches(batches: Iterable[List[Dict]]) -> Iterable[Dict]:
+    for batch in batches:
+        yield from batch
+
+
+class IngestMeter:
+    """Đếm số sự kiện đi qua bước đọc dữ liệu để báo cáo throughput và peak RSS."""
+
+    def __init__(self, mode: str, batch_size: Optional[int] = None):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.events = 0
+        self.batches = 0
+        self._started = time.perf_counter()
+
+    def count_events(self, events: Iterable[Dict]) -> Iterable[Dict]:
+        for event in events:
+            self.events += 1
+            yield event
+
+    def count_batches(self, batches: Iterable[List[Dict]]) -> Iterable[List[Dict]]:
+        for batch in batches:
+            self.batches += 1
+            self.events += len(batch)
+            yield batch
+
+    def count_profile_rows(self, rows: Iterable[Dict]) -> Iterable[Dict]:
+        """Engine mongo: mỗi document (profile, sách) được tính bằng số sự kiện gốc của nó."""
+        for row in rows:
+            self.events += sum(int(item["n"]) for item in row.get("eventTypes") or [])
+            yield row
+
+    def stats(self) -> Dict[str, Any]:
+        seconds = time.perf_counter() - self._started
+        return {
+            "mode": self.mode,
+            "batchSize": self.batch_size,
+            "batches": self.batches or None,
+            "events": self.events,
+            "seconds": round(seconds, 3),
+            "eventsPerSecond": round(self.events / seconds, 1) if seconds > 0 else None,
+            "peakRssMb": peak_rss_mb(),
+        }
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Bộ nhớ thường trú lớn nhất của tiến trình (MB); None nếu nền tảng không hỗ trợ."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(peak / divisor, 1)
+
+
+def parse_event(event: Dict, decay: Optional[TimeDecay] = None) -> Optional[Tuple[str, str, float]]:
+    """
+    Trích (profile_key, book_id, score) từ một sự kiện thô.
+    Trả về None nếu sự kiện không gắn được với profile hoặc sách hợp lệ.
+    Với `decay`, điểm được nhân hệ số suy giảm của sự kiện (hệ quy chiếu decay.anchor).
+    """
+    profile_key = normalize_key(event)
+    if not profile_key:
+        return None
+
+    book_id = event.get("bookId")
+    if book_id is None:
+        return None
+
+    try:
+        book_id_str = str(int(book_id))
+    except (TypeError, ValueError):
+        return None
+
+    score = event_score(event)
+    if decay is not None and decay.applies_to(event):
+        score *= decay.weight(event.get("occurredAt"))
+    return profile_key, book_id_str, score
 
 
-def aggregate_profiles(events: Iterable[Dict]) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
+def aggregate_profiles(
+    events: Iterable[Dict],
+    key_filter: Optional[Callable[[str], bool]] = None,
+    decay: Optional[TimeDecay] = None,
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
     """
     Gom điểm theo profile.
     Trả về:
       - raw_scores: map {profile_key: {book_id: score}}
       - metadata: lưu thông tin bổ sung (số sự kiện, breakdown...) để ghi báo cáo
+    `key_filter` (tuỳ chọn) chỉ giữ các profile thoả điều kiện, ví dụ profile thuộc một shard.
+    `decay` (tuỳ chọn) áp suất giảm theo thời gian cho điểm từng sự kiện (xem TimeDecay).
     """
     raw_scores: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
     metadata: Dict[str, Dict] = {}
 
     for event in events:
-        profile_key = normalize_key(event)
-        if not profile_key:
-            continue
-
-        book_id = event.get("bookId")
-        if book_id is None:
+        parsed = parse_event(event, decay)
+        if parsed is None:
             continue
 
-        try:
-            book_id_str = str(int(book_id))
-        except (TypeError, ValueError):
+        profile_key, book_id_str, score = parsed
+        if key_filter is not None and not key_filter(profile_key):
             continue
-
-        score = event_score(event)
         raw_scores[profile_key][book_id_str] += score
 
         meta = metadata.setdefault(
@@ -220,9 +700,297 @@ def aggregate_profiles(events: Iterable[Dict]) -> Tuple[Dict[str, Dict[str, floa
     return raw_scores, metadata
 
 
+def aggregate_profile_store(
+    events: Iterable[Dict],
+    key_filter: Optional[Callable[[str], bool]] = None,
+    decay: Optional[TimeDecay] = None,
+) -> ProfileStore:
+    """
+    Giống aggregate_profiles nhưng gom điểm vào ProfileStore (khoá intern + mảng NumPy)
+    thay cho dict lồng nhau, giảm mạnh bộ nhớ khi cửa sổ history_days lớn.
+    """
+    store = ProfileStore()
+    for event in events:
+        parsed = parse_event(event, decay)
+        if parsed is None:
+            continue
+
+        profile_key, book_id_str, score = parsed
+        if key_filter is not None and not key_filter(profile_key):
+            continue
+        store.add_score(profile_key, int(book_id_str), score)
+        store.add_events(
+            profile_key,
+            event.get("eventType") or "unknown",
+            1,
+            event.get("occurredAt"),
+        )
+    store.compact()
+    return store
+
+
+def aggregate_profile_store_batches(
+    batches: Iterable[List[Dict]],
+    key_filter: Optional[Callable[[str], bool]] = None,
+    decay: Optional[TimeDecay] = None,
+) -> ProfileStore:
+    """
+    Bản theo lô của aggregate_profile_store: mỗi lô sự kiện chỉ được đọc các trường cần
+    thiết rồi gộp một lần vào ProfileStore (bộ đệm kích thước cố định + metadata dạng mảng),
+    nên bộ nhớ chỉ tăng theo số cặp (profile, sách) chứ không theo số sự kiện.
+    Hệ số suy giảm (nếu có) được tính vector hoá cho cả lô.
+    """
+    store = ProfileStore()
+    for batch in batches:
+        keys: List[str] = []
+        books: List[int] = []
+        scores: List[float] = []
+        types: List[str] = []
+        occurred: List[Any] = []
+        decayable: List[bool] = []
+        for event in batch:
+            parsed = parse_event(event)
+            if parsed is None:
+                continue
+            profile_key, book_id_str, score = parsed
+            if key_filter is not None and not key_filter(profile_key):
+                continue
+            keys.append(profile_key)
+            books.append(int(book_id_str))
+            scores.append(score)
+            types.append(event.get("eventType") or "unknown")
+            occurred.append(event.get("occurredAt"))
+            if decay is not None:
+                decayable.append(decay.applies_to(event))
+        if decay is not None and keys:
+            factors = np.where(decayable, decay.weights(occurred), 1.0)
+            scores = np.asarray(scores, dtype=np.float64) * factors
+        store.add_batch(keys, books, scores, types, occurred)
+    store.compact()
+    return store
+
+
+def _python_str_expr(value: str) -> Dict:
+    """
+    Biểu thức chuyển `value` thành chuỗi giống str() của Python: $toString cho double
+    nguyên ra '12' và bool ra 'true', còn Python cho '12.0' và 'True'.
+    """
+    return {
+        "$switch": {
+            "branches": [
+                {
+                    "case": {"$eq": [{"$type": value}, "bool"]},
+                    "then": {"$cond": [value, "True", "False"]},
+                },
+                {
+                    # $and dừng ở điều kiện sai đầu tiên nên $trunc chỉ chạy trên double
+                    "case": {
+                        "$and": [
+                            {"$eq": [{"$type": value}, "double"]},
+                            {"$eq": [value, {"$trunc": value}]},
+                            {"$lt": [{"$abs": value}, 1e16]},
+                        ]
+                    },
+                    "then": {"$concat": [{"$toString": value}, ".0"]},
+                },
+            ],
+            "default": {"$toString": value},
+        }
+    }
+
+
+def build_profile_pipeline(history_days: int, decay: Optional[TimeDecay] = None) -> List[Dict]:
+    """
+    Pipeline MongoDB tái hiện parse_event ngay trên server:
+      - profileKey: 'user:<userId>' hoặc sessionId, chuỗi hoá như str() (giống normalize_key)
+      - bookId: chuỗi được bỏ khoảng trắng hai đầu trước khi đổi sang long (giống int())
+      - eventType rỗng/0/False => 'unknown' (giống `or "unknown"`)
+      - score: finalScore -> value -> EVENT_WEIGHTS -> 1.0 (giống event_score)
+      - với `decay`: điểm không đến từ finalScore được nhân 2^((occurredAt - anchor)/half_life)
+    Kết quả: mỗi cặp (profile, sách) một document kèm breakdown theo eventType.
+    training_checks.py pipeline-parity đối chiếu pipeline này với aggregate_profiles.
+    """
+    weight_branches = [
+        {"case": {"$eq": ["$eventType", etype]}, "then": float(weight)}
+        for etype, weight in EVENT_WEIGHTS.items()
+    ]
+    user_id = {"$ifNull": ["$userId", None]}
+    session_id = {"$ifNull": ["$sessionId", None]}
+    event_type = {"$ifNull": ["$eventType", None]}
+    score = {
+        "$toDouble": {
+            "$ifNull": [
+                "$finalScore",
+                {
+                    "$ifNull": [
+                        "$value",
+                        {"$switch": {"branches": weight_branches, "default": 1.0}},
+                    ]
+                },
+            ]
+        }
+    }
+    if decay is not None:
+        half_life_ms = decay.half_life_days * 86_400_000.0
+        factor = {
+            "$cond": [
+                {
+                    "$and": [
+                        {"$eq": [{"$ifNull": ["$finalScore", None]}, None]},
+                        {"$eq": [{"$type": "$occurredAt"}, "date"]},
+                    ]
+                },
+                {"$pow": [2.0, {"$divide": [{"$subtract": ["$occurredAt", decay.anchor]}, half_life_ms]}]},
+                1.0,
+            ]
+        }
+        score = {"$multiply": [score, factor]}
+
+    return [
+        {"$match": build_events_query(history_days)},
+        {
+            "$project": {
+                "_id": 0,
+                "profileKey": {
+                    "$cond": [
+                        {"$in": [user_id, [None, "", "null"]]},
+                        {
+                            "$cond": [
+                                {"$in": [session_id, [None, "", 0, False]]},
+                                None,
+                                _python_str_expr("$sessionId"),
+                            ]
+                        },
+                        {"$concat": ["user:", _python_str_expr("$userId")]},
+                    ]
+                },
+                "bookId": {
+                    "$convert": {
+                        "input": {
+                            "$cond": [
+                                {"$eq": [{"$type": "$bookId"}, "string"]},
+                                {"$trim": {"input": "$bookId"}},
+                                "$bookId",
+                            ]
+                        },
+                        "to": "long",
+                        "onError": None,
+                        "onNull": None,
+                    }
+                },
+                "eventType": {
+                    "$cond": [{"$in": [event_type, [None, "", 0, False]]}, "unknown", "$eventType"]
+                },
+                "score": score,
+                "occurredAt": {
+                    "$cond": [{"$eq": [{"$type": "$occurredAt"}, "date"]}, "$occurredAt", None]
+                },
+            }
+        },
+        {"$match": {"profileKey": {"$ne": None}, "bookId": {"$ne": None}}},
+        {
+            "$group": {
+                "_id": {"p": "$profileKey", "b": "$bookId", "t": "$eventType"},
+                "score": {"$sum": "$score"},
+                "count": {"$sum": 1},
+                "lastEventAt": {"$max": "$occurredAt"},
+            }
+        },
+        {
+            "$group": {
+                "_id": {"p": "$_id.p", "b": "$_id.b"},
+                "score": {"$sum": "$score"},
+                "eventTypes": {"$push": {"t": "$_id.t", "n": "$count"}},
+                "lastEventAt": {"$max": "$lastEventAt"},
+            }
+        },
+    ]
+
+
+def iter_profile_rows(collection, history_days: int, decay: Optional[TimeDecay] = None) -> Iterable[Dict]:
+    """Các document (profile, sách) của pipeline $group; khoá profile nằm ở row["_id"]["p"]."""
+    return collection.aggregate(build_profile_pipeline(history_days, decay), allowDiskUse=True)
+
+
+def aggregate_profiles_mongo(
+    collection,
+    history_days: int,
+    key_filter: Optional[Callable[[str], bool]] = None,
+    decay: Optional[TimeDecay] = None,
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
+    """
+    Phiên bản aggregate_profiles chạy trên MongoDB ($group): Python chỉ nhận một
+    document cho mỗi cặp (profile, sách) thay vì từng sự kiện thô.
+    Trả về cùng định dạng (raw_scores, metadata) với aggregate_profiles.
+    """
+    return aggregate_profile_rows(iter_profile_rows(collection, history_days, decay), key_filter)
+
+
+def aggregate_profile_rows(
+    rows: Iterable[Dict],
+    key_filter: Optional[Callable[[str], bool]] = None,
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
+    """Gom các document của iter_profile_rows thành (raw_scores, metadata)."""
+    raw_scores: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    metadata: Dict[str, Dict] = {}
+
+    for row in rows:
+        profile_key = row["_id"]["p"]
+        if key_filter is not None and not key_filter(profile_key):
+            continue
+        book_id_str = str(int(row["_id"]["b"]))
+        raw_scores[profile_key][book_id_str] += float(row["score"])
+
+        meta = metadata.setdefault(
+            profile_key,
+            {
+                "eventCount": 0,
+                "eventTypes": Counter(),
+                "lastEventAt": None,
+            },
+        )
+        for item in row.get("eventTypes") or []:
+            meta["eventCount"] += int(item["n"])
+            meta["eventTypes"][item["t"]] += int(item["n"])
+        occurred_at = row.get("lastEventAt")
+        if isinstance(occurred_at, datetime):
+            if meta["lastEventAt"] is None or occurred_at > meta["lastEventAt"]:
+                meta["lastEventAt"] = occurred_at
+
+    return raw_scores, metadata
+
+
+def aggregate_profile_store_mongo(
+    collection,
+    history_days: int,
+    key_filter: Optional[Callable[[str], bool]] = None,
+    decay: Optional[TimeDecay] = None,
+) -> ProfileStore:
+    """Kết hợp pipeline $group trên MongoDB với ProfileStore dạng cột."""
+    return aggregate_profile_store_rows(iter_profile_rows(collection, history_days, decay), key_filter)
+
+
+def aggregate_profile_store_rows(
+    rows: Iterable[Dict],
+    key_filter: Optional[Callable[[str], bool]] = None,
+) -> ProfileStore:
+    """Gom các document của iter_profile_rows vào ProfileStore."""
+    store = ProfileStore()
+    for row in rows:
+        profile_key = row["_id"]["p"]
+        if key_filter is not None and not key_filter(profile_key):
+            continue
+        store.add_score(profile_key, int(row["_id"]["b"]), float(row["score"]))
+        occurred_at = row.get("lastEventAt")
+        for item in row.get("eventTypes") or []:
+            store.add_events(profile_key, item["t"], int(item["n"]), occurred_at)
+    store.compact()
+    return store
+
+
 def prune_profiles(
-    raw_scores: Dict[str, Dict[str, float]],
-    metadata: Dict[str, Dict],
+    raw_scores: Dict[str, Dict[str, float]] | ProfileStore,
+    metadata: Optional[Dict[str, Dict]],
     min_score: float,
     top_k: int,
     max_profiles: int,
@@ -232,7 +1000,11 @@ def prune_profiles(
       - Bỏ sách có tổng điểm < min_score
       - Giữ tối đa top_k sách theo profile
       - Giới hạn số profile xử lý nếu max_profiles > 0
+    Nếu raw_scores là ProfileStore thì metadata đã nằm sẵn trong store (truyền None).
     """
+    if isinstance(raw_scores, ProfileStore):
+        return raw_scores.prune(min_score=min_score, top_k=top_k, max_profiles=max_profiles)
+
     ordered_keys = sorted(
         raw_scores.keys(),
         key=lambda key: metadata[key]["eventCount"],
@@ -263,6 +1035,258 @@ def prune_profiles(
     return filtered_scores, filtered_meta
 
 
+def _event_day(occurred_at: Any) -> str:
+    """Khoá bucket theo ngày (UTC) của sự kiện; sự kiện không có thời gian dùng bucket 'undated'."""
+    if not isinstance(occurred_at, datetime):
+        return "undated"
+    if occurred_at.tzinfo is not None:
+        occurred_at = occurred_at.astimezone(timezone.utc)
+    return occurred_at.date().isoformat()
+
+
+class IncrementalTrainingState:
+    """
+    Trạng thái huấn luyện tăng dần lưu trong MongoDB:
+      - Watermark (occurredAt, _id) của sự kiện cuối cùng đã xử lý.
+      - Điểm tích luỹ theo ngày cho từng profile (`buckets`), nhờ đó có thể
+        cộng thêm sự kiện mới và loại bỏ các ngày đã rơi khỏi cửa sổ history_days
+        mà không cần đọc lại toàn bộ sự kiện thô.
+    Lưu ý: việc hết hạn tính theo ngày UTC nên biên cửa sổ có thể trễ tối đa một ngày
+    so với chế độ chạy đầy đủ.
+    Khi bật suy giảm theo thời gian, điểm suy giảm được của mỗi profile nằm riêng trong
+    `decayedScores` của bucket, lưu theo mốc `anchors[key]` (xem TimeDecay); mốc chỉ được dời (rebase) khi đã cách hiện tại quá
+    DECAY_REBASE_HALF_LIVES chu kỳ, nên phần lớn profile không phải ghi lại chỉ vì thời gian trôi.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: Dict[str, Dict[str, Dict]] = {}
+        self.last_event_at: Dict[str, datetime] = {}
+        self.anchors: Dict[str, datetime] = {}
+        self.decay_half_life_days = 0.0
+        self.watermark: Optional[Tuple[datetime, Any]] = None
+        self.changed: Set[str] = set()
+
+    @classmethod
+    def load(cls, collection) -> "IncrementalTrainingState":
+        """Đọc toàn bộ state (watermark + bucket của từng profile) từ collection."""
+        state = cls()
+        for doc in collection.find({}, {"_id": 0}):
+            key = doc.get("key")
+            if key == WATERMARK_STATE_KEY:
+                if doc.get("occurredAt") is not None:
+                    state.watermark = (doc["occurredAt"], doc.get("lastId"))
+                state.decay_half_life_days = float(doc.get("decayHalfLifeDays") or 0.0)
+                continue
+            if not key:
+                continue
+            state.buckets[key] = doc.get("buckets") or {}
+            if isinstance(doc.get("lastEventAt"), datetime):
+                state.last_event_at[key] = doc["lastEventAt"]
+            if isinstance(doc.get("decayAnchor"), datetime):
+                state.anchors[key] = doc["decayAnchor"]
+        return state
+
+    def configure_decay(self, half_life_days: float) -> None:
+        """
+        Gắn chu kỳ bán rã cho state. Điểm đã lưu phụ thuộc chu kỳ nên không thể đổi chu kỳ
+        trên state có sẵn: cần xoá state collection và chạy lại từ đầu.
+        """
+        half_life_days = float(half_life_days or 0.0)
+        if half_life_days != self.decay_half_life_days and (self.buckets or self.watermark is not None):
+            raise ValueError(
+                f"State tăng dần được tạo với --decay-half-life-days={self.decay_half_life_days:g}, "
+                f"không khớp {half_life_days:g}; hãy xoá state collection để tính lại."
+            )
+        self.decay_half_life_days = half_life_days
+
+    def _decay_of(self, key: str, now: datetime) -> Optional[TimeDecay]:
+        if self.decay_half_life_days <= 0:
+            return None
+        return TimeDecay(self.decay_half_life_days, self.anchors.setdefault(key, now))
+
+    def decaying_keys(self) -> Set[str]:
+        """
+        Các profile có điểm suy giảm theo thời gian: giá trị của chúng đổi sau mỗi lượt chạy dù
+        không có sự kiện mới, nên phải prune/ghi lại cùng các profile trong `changed`.
+        """
+        return {
+            key
+            for key, days in self.buckets.items()
+            if any(day.get("decayedScores") for day in days.values())
+        }
+
+    def rebase(self, now: datetime) -> int:
+        """
+        Dời mốc của các profile đã cách `now` quá DECAY_REBASE_HALF_LIVES chu kỳ: nhân điểm
+        đã lưu với hệ số suy giảm rồi đặt mốc = now (giữ hệ số của sự kiện mới trong khoảng an toàn).
+        Trả về số profile được dời mốc.
+        """
+        if self.decay_half_life_days <= 0:
+            return 0
+        rebased = 0
+        for key, anchor in list(self.anchors.items()):
+            decay = TimeDecay(self.decay_half_life_days, anchor)
+            if decay.half_lives_since_anchor(now) <= DECAY_REBASE_HALF_LIVES:
+                continue
+            factor = decay.scale_to(now)
+            for day in self.buckets.get(key, {}).values():
+                if "decayedScores" in day:
+                    day["decayedScores"] = {
+                        book_id: score * factor for book_id, score in day["decayedScores"].items()
+                    }
+            self.anchors[key] = now
+            self.changed.add(key)
+            rebased += 1
+        return rebased
+
+    def fold_events(self, events: Iterable[Dict], now: Optional[datetime] = None) -> int:
+        """
+        Cộng các sự kiện mới vào bucket ngày tương ứng và dời watermark. Trả về số sự kiện đã gộp.
+        Khi bật suy giảm, profile mới nhận mốc `now`; điểm được quy về mốc của profile.
+        """
+        now = now or now_utc()
+        folded = 0
+        for event in events:
+            occurred_at = event.get("occurredAt")
+            if isinstance(occurred_at, datetime) and event.get("_id") is not None:
+                self.watermark = (occurred_at, event["_id"])
+
+            parsed = parse_event(event)
+            if parsed is None:
+                continue
+            profile_key, book_id_str, score = parsed
+            day = self.buckets.setdefault(profile_key, {}).setdefault(
+                _event_day(occurred_at),
+                {"scores": {}, "eventTypes": {}, "eventCount": 0},
+            )
+            target = day["scores"]
+            decay = self._decay_of(profile_key, now)
+            if decay is not None and decay.applies_to(event):
+                score *= decay.weight(occurred_at)
+                target = day.setdefault("decayedScores", {})
+            target[book_id_str] = target.get(book_id_str, 0.0) + score
+            etype = event.get("eventType") or "unknown"
+            day["eventTypes"][etype] = day["eventTypes"].get(etype, 0) + 1
+            day["eventCount"] += 1
+
+            if isinstance(occurred_at, datetime):
+                previous = self.last_event_at.get(profile_key)
+                if previous is None or occurred_at > previous:
+                    self.last_event_at[profile_key] = occurred_at
+
+            self.changed.add(profile_key)
+            folded += 1
+        return folded
+
+    def expire(self, history_days: int) -> int:
+        """Loại bỏ các bucket ngày nằm ngoài cửa sổ history_days. Trả về số profile bị ảnh hưởng."""
+        if history_days <= 0:
+            return 0
+        cutoff_day = (now_utc() - timedelta(days=history_days)).date().isoformat()
+        affected = 0
+        for key, days in self.buckets.items():
+            stale = [day for day in days if day != "undated" and day < cutoff_day]
+            if not stale:
+                continue
+            for day in stale:
+                del days[day]
+            self.changed.add(key)
+            affected += 1
+        return affected
+
+    def materialize(self, now: Optional[datetime] = None) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]:
+        """
+        Dựng lại raw_scores/metadata (cùng định dạng với aggregate_profiles) từ các bucket.
+        Khi bật suy giảm, điểm được quy từ mốc của từng profile về thời điểm `now`.
+        """
+        now = now or now_utc()
+        raw_scores: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        metadata: Dict[str, Dict] = {}
+        for key, days in self.buckets.items():
+            if not days:
+                continue
+            decay = self._decay_of(key, now)
+            scale = decay.scale_to(now) if decay is not None else 1.0
+            event_types: Counter = Counter()
+            event_count = 0
+            for day in days.values():
+                for book_id_str, score in day["scores"].items():
+                    raw_scores[key][book_id_str] += float(score)
+                for book_id_str, score in day.get("decayedScores", {}).items():
+                    raw_scores[key][book_id_str] += float(score) * scale
+                event_types.update(day["eventTypes"])
+                event_count += int(day["eventCount"])
+            metadata[key] = {
+                "eventCount": event_count,
+                "eventTypes": event_types,
+                "lastEventAt": self.last_event_at.get(key),
+            }
+        return raw_scores, metadata
+
+    def save(
+        self,
+        collection,
+        *,
+        batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+        max_retries: int = DEFAULT_WRITE_RETRIES,
+    ) -> Dict[str, Any]:
+        """
+        Ghi lại state của các profile đã thay đổi, sau đó mới dời watermark.
+        Nếu có lô ghi lỗi thì giữ nguyên watermark cũ để lần chạy sau đọc lại các sự kiện.
+        """
+        now = now_utc()
+        operations: List[Any] = []
+        for key in self.changed:
+            days = self.buckets.get(key)
+            if not days:
+                operations.append(DeleteOne({"key": key}))
+                self.buckets.pop(key, None)
+                self.last_event_at.pop(key, None)
+                self.anchors.pop(key, None)
+                continue
+            operations.append(
+                UpdateOne(
+                    {"key": key},
+                    {
+                        "$set": {
+                            "key": key,
+                            "buckets": days,
+                            "lastEventAt": self.last_event_at.get(key),
+                            "decayAnchor": self.anchors.get(key),
+                            "updatedAt": now,
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+
+        stats = bulk_write_batches(
+            collection, operations, batch_size=batch_size, max_retries=max_retries
+        )
+        if stats["failedBatches"]:
+            raise RuntimeError(
+                f"Không ghi được state của {len(stats['failedBatches'])} lô, giữ nguyên watermark."
+            )
+
+        if self.watermark is not None:
+            last_at, last_id = self.watermark
+            collection.update_one(
+                {"key": WATERMARK_STATE_KEY},
+                {
+                    "$set": {
+                        "key": WATERMARK_STATE_KEY,
+                        "occurredAt": last_at,
+                        "lastId": last_id,
+                        "decayHalfLifeDays": self.decay_half_life_days,
+                        "updatedAt": now,
+                    }
+                },
+                upsert=True,
+            )
+        self.changed = set()
+        return stats
+
+
 def load_book_metadata(path: str | None) -> Dict[int, Dict]:
     """
     Đọc metadata sách do backend truyền xuống (JSON).
@@ -295,6 +1319,8 @@ def load_book_metadata(path: str | None) -> Dict[int, Dict]:
 class _HybridLLMClient:
     """
     Lightweight LLM wrapper that prefers OpenAI but can fall back to Gemini.
+    LLM_BASE_URL points it at any OpenAI-compatible /chat/completions endpoint over plain
+    HTTP instead (self-hosted model, or a local fake server in tests).
     """
 
     def __init__(self):
@@ -302,6 +1328,11 @@ class _HybridLLMClient:
         self.model_name: Optional[str] = None
         self.client: Any = None
 
+        base_url = os.getenv("LLM_BASE_URL")
+        if base_url:
+            self._init_http(base_url)
+            return
+
         openai_key = os.getenv("OPENAI_API_KEY") or os.getenv("LLM_API_KEY")
         if openai_key:
             self._init_openai()
@@ -339,6 +1370,11 @@ class _HybridLLMClient:
         self.client = genai.GenerativeModel(self.model_name)
         self.provider = "gemini"
 
+    def _init_http(self, base_url: str) -> None:
+        self.client = base_url.rstrip("/")
+        self.model_name = os.getenv("LLM_MODEL") or "default"
+        self.provider = "http"
+
     def is_available(self) -> bool:
         return self.client is not None and self.provider is not None
 
@@ -347,16 +1383,43 @@ class _HybridLLMClient:
             return "offline"
         return f"{self.provider}:{self.model_name}"
 
-    def generate(self, prompt: str, temperature: float = 0.1, max_tokens: int = 400) -> str:
+    def generate(
+        self,
+        prompt: str,
+        temperature: float = 0.1,
+        max_tokens: int = 400,
+        timeout: Optional[float] = None,
+    ) -> str:
         if not self.is_available():
             raise RuntimeError("LLM backend not initialized.")
 
+        if self.provider == "http":
+            body = json.dumps(
+                {
+                    "model": self.model_name,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "max_tokens": max_tokens,
+                    "temperature": temperature,
+                }
+            ).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            api_key = os.getenv("LLM_API_KEY")
+            if api_key:
+                headers["Authorization"] = f"Bearer {api_key}"
+            request = urllib.request.Request(
+                f"{self.client}/chat/completions", data=body, headers=headers, method="POST"
+            )
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                data = json.loads(response.read().decode("utf-8"))
+            return data["choices"][0]["message"]["content"].strip()
+
         if self.provider == "openai":
             response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=[{"role": "user", "content": prompt}],
                 max_tokens=max_tokens,
                 temperature=temperature,
+                timeout=timeout,
             )
             return response.choices[0].message.content.strip()
 
@@ -365,7 +1428,10 @@ class _HybridLLMClient:
                 "temperature": temperature,
                 "max_output_tokens": max_tokens,
             }
-            response = self.client.generate_content(prompt, generation_config=generation_config)
+            request_options = {"timeout": timeout} if timeout else None
+            response = self.client.generate_content(
+                prompt, generation_config=generation_config, request_options=request_options
+            )
             text = getattr(response, "text", None)
             if text:
                 return text.strip()
@@ -386,17 +1452,67 @@ class _HybridLLMClient:
         raise ValueError(f"Unsupported LLM provider: {self.provider}")
 
 
+class TokenBucket:
+    """
+    Giới hạn tốc độ gọi LLM kiểu token bucket, dùng chung giữa các luồng:
+    mỗi giây nạp `rate` token, tối đa `burst` token; acquire() chờ đến khi có token.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait_seconds = (1.0 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
 class HybridLLMReranker:
     """
     Hybrid reranker: deterministic heuristics with optional LLM ranking.
+    Khi dùng LLM: `cache` tránh hỏi lại cùng một tập ứng viên, `rate_limiter` giới hạn số
+    request mỗi giây và `request_timeout` (giây) áp cho từng lần gọi. An toàn khi gọi
+    rerank() từ nhiều luồng.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        *,
+        cache: Optional[LLMResponseCache] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        request_timeout: Optional[float] = None,
+    ):
         self.llm = _HybridLLMClient()
         self.mode = "llm" if self.llm.is_available() else "heuristic"
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.request_timeout = request_timeout
+        self.requests = 0
+        self.failures = 0
+        self._stats_lock = threading.Lock()
         if self.mode == "llm":
             print(f"[LLMReranker] Đang dùng LLM {self.llm.describe()} để rerank.")
 
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "backend": self.llm.describe(),
+            "requests": self.requests,
+            "failures": self.failures,
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
     @staticmethod
     def _heuristic_score(candidate: Dict) -> float:
         base = float(candidate.get("base_score", 0))
@@ -425,6 +1541,12 @@ class HybridLLMReranker:
         return cleaned
 
     def _prompt_llm(self, profile_key: str, candidates: List[Dict]) -> List[int]:
+        cache_key = candidate_key(self.llm.describe(), candidates) if self.cache is not None else None
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached:
+                return cached
+
         candidate_lines = []
         for item in candidates:
             reasons = []
@@ -451,8 +1573,14 @@ class HybridLLMReranker:
             + "\n".join(candidate_lines)
         )
 
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        with self._stats_lock:
+            self.requests += 1
         try:
-            raw = self.llm.generate(prompt, temperature=0.15, max_tokens=600)
+            raw = self.llm.generate(
+                prompt, temperature=0.15, max_tokens=600, timeout=self.request_timeout
+            )
             payload = self._extract_json_block(raw)
             data = json.loads(payload)
             ranking = data.get("ranking")
@@ -464,11 +1592,33 @@ class HybridLLMReranker:
                     except (TypeError, ValueError):
                         continue
                 if cleaned:
+                    if cache_key is not None:
+                        self.cache.put(cache_key, cleaned)
                     return cleaned
         except Exception as exc:
             print(f"[LLMReranker] LLM lỗi ({exc}), fallback heuristic.")
+        with self._stats_lock:
+            self.failures += 1
         return []
 
+    @staticmethod
+    def heuristic_top_k(base_scores: np.ndarray, flags: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        Bản vector hoá của sắp xếp theo _heuristic_score: trả về vị trí top_k ứng viên.
+        Điểm được cộng theo đúng thứ tự như _heuristic_score nên giá trị float trùng khớp;
+        hoà điểm thì giữ thứ tự đầu vào như sorted(..., reverse=True).
+        """
+        scores = base_scores.astype(np.float64, copy=True)
+        scores += np.where(flags & SAME_CATEGORY, 1.0, 0.0)
+        scores += np.where(flags & SAME_AUTHOR, 0.6, 0.0)
+        scores += np.where(flags & SAME_PUBLISHER, 0.4, 0.0)
+        if top_k < len(scores):
+            threshold = -np.partition(-scores, top_k - 1)[top_k - 1]
+            positions = np.flatnonzero(scores >= threshold)
+        else:
+            positions = np.arange(len(scores))
+        return positions[np.argsort(-scores[positions], kind="stable")][:top_k]
+
     def rerank(self, profile_key: str, candidates: List[Dict]) -> List[int]:
         if self.mode == "llm":
             ranking = self._prompt_llm(profile_key, candidates)
@@ -501,92 +1651,256 @@ def build_similarity_index(book_meta: Dict[int, Dict]) -> Dict[str, Dict[int, Li
     return index
 
 
-def apply_llm_rerank(
-    profiles: Dict[str, OrderedDict],
+def build_rerank_candidates(
+    score_map: Dict[str, float],
     book_meta: Dict[int, Dict],
-    top_k: int,
-) -> Dict[str, OrderedDict]:
+    index: Optional[Dict[str, Dict[int, List[int]]]] = None,
+    related: Optional[RelatedBooksTable] = None,
+) -> Dict[int, Dict]:
     """
-    Áp dụng LLM/heuristic để tái xếp hạng:
-      - Giữ ưu tiên các sách có điểm cao.
-      - Bổ sung các sách chung danh mục/tác giả/NXB với sách anchor.
+    Dựng danh sách ứng viên cho một profile: các sách đã có điểm cộng với sách cùng
+    danh mục/tác giả/NXB với 3 sách anchor đầu tiên.
+    Có `related` thì mỗi anchor chỉ mở rộng bằng top-N sách liên quan đã tính sẵn;
+    không thì lấy toàn bộ posting list trong `index` (build_similarity_index).
     """
-    if not book_meta:
-        return profiles
-
-    index = build_similarity_index(book_meta)
-    reranker = HybridLLMReranker()
-    result: Dict[str, OrderedDict] = {}
-
-    for profile_key, score_map in profiles.items():
-        anchors = list(score_map.items())[:3]
-        candidate_details: Dict[int, Dict] = {}
-
-        # Bản thân các sách đã có điểm -> mặc định same_category=True để giữ nguyên thứ hạng
-        for product_id_str, base_score in score_map.items():
-            pid = int(product_id_str)
-            meta = book_meta.get(pid, {})
-            candidate_details[pid] = {
-                "product_id": pid,
-                "title": meta.get("title"),
-                "base_score": base_score,
-                "same_category": True,
-                "same_author": False,
-                "same_publisher": False,
-            }
+    anchors = list(score_map.items())[:3]
+    candidate_details: Dict[int, Dict] = {}
+
+    # Bản thân các sách đã có điểm -> mặc định same_category=True để giữ nguyên thứ hạng
+    for product_id_str, base_score in score_map.items():
+        pid = int(product_id_str)
+        meta = book_meta.get(pid, {})
+        candidate_details[pid] = {
+            "product_id": pid,
+            "title": meta.get("title"),
+            "base_score": base_score,
+            "same_category": True,
+            "same_author": False,
+            "same_publisher": False,
+        }
 
+    if related is not None:
         for anchor_product_id, anchor_score in anchors:
-            anchor_pid = int(anchor_product_id)
-            anchor_meta = book_meta.get(anchor_pid, {})
-            related_ids = set()
-            if anchor_meta.get("category_id") is not None:
-                related_ids.update(index["category"][anchor_meta["category_id"]])
-            if anchor_meta.get("author_id") is not None:
-                related_ids.update(index["author"][anchor_meta["author_id"]])
-            if anchor_meta.get("publisher_id") is not None:
-                related_ids.update(index["publisher"][anchor_meta["publisher_id"]])
-
-            for related_pid in related_ids:
-                if related_pid == anchor_pid:
-                    continue
-                meta = book_meta.get(related_pid, {})
-                entry = candidate_details.setdefault(
-                    related_pid,
-                    {
+            related_ids, related_flags = related.lookup(int(anchor_product_id))
+            for related_pid, mask in zip(related_ids.tolist(), related_flags.tolist()):
+                entry = candidate_details.get(related_pid)
+                if entry is None:
+                    entry = candidate_details[related_pid] = {
                         "product_id": related_pid,
-                        "title": meta.get("title"),
+                        "title": book_meta.get(related_pid, {}).get("title"),
                         "base_score": 0.0,
                         "same_category": False,
                         "same_author": False,
                         "same_publisher": False,
-                    },
-                )
-
-                if meta.get("category_id") == anchor_meta.get("category_id"):
+                    }
+                if mask & SAME_CATEGORY:
                     entry["same_category"] = True
-                if meta.get("author_id") == anchor_meta.get("author_id"):
+                if mask & SAME_AUTHOR:
                     entry["same_author"] = True
-                if meta.get("publisher_id") == anchor_meta.get("publisher_id"):
+                if mask & SAME_PUBLISHER:
                     entry["same_publisher"] = True
-
-                # Điểm cộng nhẹ để các sách liên quan có cơ hội lọt top (tỷ lệ 0.6 so với anchor)
                 entry["base_score"] = max(entry["base_score"], anchor_score * 0.6)
+        return candidate_details
+
+    for anchor_product_id, anchor_score in anchors:
+        anchor_pid = int(anchor_product_id)
+        anchor_meta = book_meta.get(anchor_pid, {})
+        related_ids = set()
+        if anchor_meta.get("category_id") is not None:
+            related_ids.update(index["category"][anchor_meta["category_id"]])
+        if anchor_meta.get("author_id") is not None:
+            related_ids.update(index["author"][anchor_meta["author_id"]])
+        if anchor_meta.get("publisher_id") is not None:
+            related_ids.update(index["publisher"][anchor_meta["publisher_id"]])
+
+        for related_pid in related_ids:
+            if related_pid == anchor_pid:
+                continue
+            meta = book_meta.get(related_pid, {})
+            entry = candidate_details.setdefault(
+                related_pid,
+                {
+                    "product_id": related_pid,
+                    "title": meta.get("title"),
+                    "base_score": 0.0,
+                    "same_category": False,
+                    "same_author": False,
+                    "same_publisher": False,
+                },
+            )
 
-        candidate_list = list(candidate_details.values())
-        ranked_ids = reranker.rerank(profile_key, candidate_list)
+            if meta.get("category_id") == anchor_meta.get("category_id"):
+                entry["same_category"] = True
+            if meta.get("author_id") == anchor_meta.get("author_id"):
+                entry["same_author"] = True
+            if meta.get("publisher_id") == anchor_meta.get("publisher_id"):
+                entry["same_publisher"] = True
 
-        ordered = OrderedDict()
-        for pid in ranked_ids:
-            if len(ordered) >= top_k:
-                break
-            entry = candidate_details.get(pid)
-            if not entry:
-                continue
-            ordered[str(pid)] = float(entry.get("base_score", 0.0))
+            # Điểm cộng nhẹ để các sách liên quan có cơ hội lọt top (tỷ lệ 0.6 so với anchor)
+            entry["base_score"] = max(entry["base_score"], anchor_score * 0.6)
+
+    return candidate_details
 
-        result[profile_key] = ordered
 
-    return result
+def build_rerank_candidate_arrays(
+    score_map: Dict[str, float],
+    related: RelatedBooksTable,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cùng tập ứng viên như build_rerank_candidates(related=...) nhưng dạng mảng song song
+    (product_id, base_score, bitmask trùng) theo đúng thứ tự chèn, không tạo dict cho từng sách.
+    """
+    own_pids = np.array([int(pid) for pid in score_map], dtype=np.int64)
+    own_scores = np.array([float(score) for score in score_map.values()], dtype=np.float64)
+    parts_pids = [own_pids]
+    parts_flags = [np.full(len(own_pids), SAME_CATEGORY, dtype=np.uint8)]
+    parts_scores = [own_scores]
+    for anchor_product_id, anchor_score in list(score_map.items())[:3]:
+        related_ids, related_flags = related.lookup(int(anchor_product_id))
+        parts_pids.append(np.asarray(related_ids, dtype=np.int64))
+        parts_flags.append(np.asarray(related_flags, dtype=np.uint8))
+        parts_scores.append(np.full(len(related_ids), float(anchor_score) * 0.6))
+
+    all_pids = np.concatenate(parts_pids)
+    unique_pids, first_seen, inverse = np.unique(all_pids, return_index=True, return_inverse=True)
+    # Thứ tự ứng viên = thứ tự xuất hiện đầu tiên (giống thứ tự chèn dict)
+    order = np.argsort(first_seen, kind="stable")
+    slot_of = np.empty(len(order), dtype=np.int64)
+    slot_of[order] = np.arange(len(order))
+    slots = slot_of[inverse.reshape(-1)]
+
+    n_own = len(own_pids)
+    base = np.zeros(len(order), dtype=np.float64)
+    base[slots[:n_own]] = own_scores
+    np.maximum.at(base, slots[n_own:], np.concatenate(parts_scores)[n_own:])
+    flags = np.zeros(len(order), dtype=np.uint8)
+    np.bitwise_or.at(flags, slots, np.concatenate(parts_flags))
+    return unique_pids[order], base, flags
+
+
+def _select_ranked(candidate_details: Dict[int, Dict], ranked_ids: List[int], top_k: int) -> OrderedDict:
+    ordered = OrderedDict()
+    for pid in ranked_ids:
+        if len(ordered) >= top_k:
+            break
+        entry = candidate_details.get(pid)
+        if not entry:
+            continue
+        ordered[str(pid)] = float(entry.get("base_score", 0.0))
+    return ordered
+
+
+def apply_llm_rerank(
+    profiles: Dict[str, OrderedDict],
+    book_meta: Dict[int, Dict],
+    top_k: int,
+    *,
+    reranker: Optional[HybridLLMReranker] = None,
+    max_in_flight: int = 1,
+    related: Optional[RelatedBooksTable] = None,
+) -> Dict[str, OrderedDict]:
+    """
+    Áp dụng LLM/heuristic để tái xếp hạng:
+      - Giữ ưu tiên các sách có điểm cao.
+      - Bổ sung các sách chung danh mục/tác giả/NXB với sách anchor.
+    Ở chế độ LLM với max_in_flight > 1, các profile được gửi song song qua thread pool,
+    tối đa max_in_flight request cùng lúc (giới hạn tốc độ/timeout nằm trong `reranker`).
+    Kết quả giữ nguyên thứ tự profile đầu vào.
+    Truyền `related` (RelatedBooksTable) để giới hạn số ứng viên mở rộng từ mỗi anchor.
+    """
+    if not book_meta:
+        return profiles
+
+    index = build_similarity_index(book_meta) if related is None else None
+    reranker = reranker or HybridLLMReranker()
+
+    def rerank_one(profile_key: str, score_map: Dict[str, float]) -> OrderedDict:
+        if reranker.mode != "llm" and related is not None:
+            # Heuristic thuần: chấm điểm và chọn top-k trên mảng, không dựng dict ứng viên
+            pids, base, flags = build_rerank_candidate_arrays(score_map, related)
+            best = reranker.heuristic_top_k(base, flags, top_k)
+            return OrderedDict((str(pid), score) for pid, score in zip(pids[best].tolist(), base[best].tolist()))
+        candidate_details = build_rerank_candidates(score_map, book_meta, index, related)
+        ranked_ids = reranker.rerank(profile_key, list(candidate_details.values()))
+        return _select_ranked(candidate_details, ranked_ids, top_k)
+
+    if reranker.mode != "llm" or max_in_flight <= 1:
+        return {
+            profile_key: rerank_one(profile_key, score_map)
+            for profile_key, score_map in profiles.items()
+        }
+
+    ranked: Dict[str, OrderedDict] = {}
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending: Dict[Any, str] = {}
+        for profile_key, score_map in profiles.items():
+            # Chỉ giữ tối đa max_in_flight profile đang chờ để ứng viên không dồn hết vào bộ nhớ
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ranked[pending.pop(future)] = future.result()
+            pending[executor.submit(rerank_one, profile_key, score_map)] = profile_key
+        for future, profile_key in pending.items():
+            ranked[profile_key] = future.result()
+
+    return {profile_key: ranked[profile_key] for profile_key in profiles}
+
+
+def _chunked(items: Iterable[Any], size: int) -> Iterable[List[Any]]:
+    """Chia một iterable thành các lô có tối đa `size` phần tử."""
+    batch: List[Any] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_write_batches(
+    collection,
+    operations: Iterable[Any],
+    *,
+    batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+    max_retries: int = DEFAULT_WRITE_RETRIES,
+) -> Dict[str, Any]:
+    """
+    Ghi các thao tác (UpdateOne/DeleteOne...) theo lô bằng `bulk_write(ordered=False)`.
+    Lô lỗi được thử lại tối đa `max_retries` lần (các thao tác đều là upsert/delete theo key
+    nên ghi lại cả lô là an toàn). Trả về thống kê thời gian từng lô để đưa vào báo cáo.
+    """
+    stats: Dict[str, Any] = {
+        "collection": collection.name,
+        "batches": 0,
+        "operations": 0,
+        "written": 0,
+        "retries": 0,
+        "failedBatches": [],
+        "batchSeconds": [],
+    }
+    for batch_no, batch in enumerate(_chunked(operations, max(1, batch_size))):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                collection.bulk_write(batch, ordered=False)
+                stats["written"] += len(batch)
+                break
+            except PyMongoError as exc:
+                if attempt >= max_retries:
+                    print(f"[Recommender] Lô {batch_no} của `{collection.name}` lỗi sau {attempt + 1} lần: {exc}")
+                    stats["failedBatches"].append(
+                        {"batch": batch_no, "size": len(batch), "error": str(exc)[:200]}
+                    )
+                    break
+                attempt += 1
+                stats["retries"] += 1
+                time.sleep(0.5 * attempt)
+        stats["batches"] += 1
+        stats["operations"] += len(batch)
+        stats["batchSeconds"].append(round(time.perf_counter() - started, 4))
+    return stats
 
 
 def persist_results(
@@ -598,70 +1912,95 @@ def persist_results(
     history_days: int,
     min_score: float,
     top_k: int,
-) -> Tuple[int, int]:
+    batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+    max_retries: int = DEFAULT_WRITE_RETRIES,
+    parallel: bool = False,
+) -> Tuple[int, int, Dict[str, Dict[str, Any]]]:
     """
     Lưu kết quả vào MongoDB:
       - Collection `profiles`: lưu lại điểm, breakdown để phục vụ phân tích.
       - Collection `recommendations`: lưu danh sách gợi ý cuối cùng.
+    Upsert được gom thành các lô bulk_write; `parallel=True` ghi hai collection đồng thời.
+    Trả về (số profile đã ghi, số recommendation đã ghi, thống kê theo collection).
     """
-    updated_profiles = 0
-    updated_recommendations = 0
     now = now_utc()
 
-    for key, score_map in profiles.items():
+    def _breakdown(key: str) -> Tuple[Dict, Dict[str, int], float]:
         meta = metadata.get(key, {})
         event_breakdown = {etype: int(count) for etype, count in meta.get("eventTypes", {}).items()}
-        total_score = float(sum(score_map.values()))
-
-        profiles_coll.update_one(
-            {"key": key},
-            {
-                "$set": {
-                    "key": key,
-                    "scores": score_map,
-                    "totalScore": total_score,
-                    "eventBreakdown": event_breakdown,
-                    "eventCount": int(meta.get("eventCount", 0)),
-                    "lastEventAt": meta.get("lastEventAt"),
-                    "historyDays": history_days,
-                    "minScore": min_score,
-                    "topK": top_k,
-                    "updatedAt": now,
-                },
-                "$setOnInsert": {"createdAt": now},
-            },
-            upsert=True,
-        )
-        updated_profiles += 1
-
-        product_ids = [int(book_id) for book_id in score_map.keys()]
-        recommendations_coll.update_one(
-            {"key": key},
-            {
-                "$set": {
-                    "key": key,
-                    "recommendations": {
-                        "product_ids": product_ids,
-                        "generatedAt": now,
-                        "topK": top_k,
-                        "totalCandidates": len(product_ids),
-                        "modelVersion": "profile_score_v1",
-                    },
-                    "metadata": {
-                        "historyDays": history_days,
+        total_score = float(sum(profiles[key].values()))
+        return meta, event_breakdown, total_score
+
+    def profile_ops() -> Iterable[Any]:
+        for key, score_map in profiles.items():
+            meta, event_breakdown, total_score = _breakdown(key)
+            yield UpdateOne(
+                {"key": key},
+                {
+                    "$set": {
+                        "key": key,
+                        "scores": score_map,
+                        "totalScore": total_score,
                         "eventBreakdown": event_breakdown,
-                        "scoreSum": total_score,
+                        "eventCount": int(meta.get("eventCount", 0)),
+                        "lastEventAt": meta.get("lastEventAt"),
+                        "historyDays": history_days,
                         "minScore": min_score,
+                        "topK": top_k,
+                        "updatedAt": now,
                     },
-                    "updatedAt": now,
+                    "$setOnInsert": {"createdAt": now},
                 },
-                "$setOnInsert": {"createdAt": now},
-            },
-            upsert=True,
-        )
-        updated_recommendations += 1
+                upsert=True,
+            )
 
-    return updated_profiles, updated_recommendations
+    def recommendation_ops() -> Iterable[Any]:
+        for key, score_map in profiles.items():
+            _meta, event_breakdown, total_score = _breakdown(key)
+            product_ids = [int(book_id) for book_id in score_map.keys()]
+            yield UpdateOne(
+                {"key": key},
+                {
+                    "$set": {
+                        "key": key,
+                        "recommendations": {
+                            "product_ids": product_ids,
+                            "generatedAt": now,
+                            "topK": top_k,
+                            "totalCandidates": len(product_ids),
+                            "modelVersion": "profile_score_v1",
+                        },
+                        "metadata": {
+                            "historyDays": history_days,
+                            "eventBreakdown": event_breakdown,
+                            "scoreSum": total_score,
+                            "minScore": min_score,
+                        },
+                        "updatedAt": now,
+                    },
+                    "$setOnInsert": {"createdAt": now},
+                },
+                upsert=True,
+            )
+
+    jobs = [(profiles_coll, profile_ops), (recommendations_coll, recommendation_ops)]
+    if parallel:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [
+                executor.submit(
+                    bulk_write_batches, coll, ops(), batch_size=batch_size, max_retries=max_retries
+                )
+                for coll, ops in jobs
+            ]
+            profile_stats, recommendation_stats = [future.result() for future in futures]
+    else:
+        profile_stats, recommendation_stats = [
+            bulk_write_batches(coll, ops(), batch_size=batch_size, max_retries=max_retries)
+            for coll, ops in jobs
+        ]
+
+    write_stats = {"profiles": profile_stats, "recommendations": recommendation_stats}
+    return profile_stats["written"], recommendation_stats["written"], write_stats
 
 
 def serialize_datetime(value):
@@ -673,13 +2012,64 @@ def serialize_datetime(value):
     return value
 
 
-def main():
-    args = parse_args()
+class ShardContext:
+    """
+    Thông tin một worker trong chế độ --workers N: shard nào, mốc thời gian chung, queue
+    nhận các lô sự kiện của shard và các queue trao đổi tổng độ phổ biến với tiến trình điều phối.
+    """
 
-    if MongoClient is None:
-        raise ImportError(
-            "pymongo is required to run train_recommendations.py. Please install pymongo."
-        ) from _PYMONGO_IMPORT_ERROR
+    def __init__(
+        self,
+        index: int,
+        count: int,
+        now: datetime,
+        events_queue: Any,
+        totals_queue: Any,
+        popularity_queue: Any,
+    ):
+        self.index = index
+        self.count = count
+        self.now = now
+        self.events_queue = events_queue
+        self.totals_queue = totals_queue
+        self.popularity_queue = popularity_queue
+
+    def routed_batches(self) -> Iterable[List[Dict]]:
+        """
+        Các lô tiến trình điều phối đã chia cho shard này (route_shard_inputs): sự kiện thô,
+        hoặc document của pipeline $group với engine mongo. Kết thúc khi nhận None.
+        """
+        while True:
+            batch = self.events_queue.get()
+            if batch is None:
+                return
+            yield batch
+
+    def exchange_popularity(self, total_ids: np.ndarray, totals: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Gửi tổng điểm theo sách của shard, nhận lại tổng toàn cục của mọi shard."""
+        self.totals_queue.put((self.index, total_ids, totals))
+        return self.popularity_queue.get()
+
+
+def shard_of(profile_key: str, count: int) -> int:
+    """Shard của một profile: crc32 ổn định giữa các tiến trình (khác với hash() của Python)."""
+    return zlib.crc32(profile_key.encode("utf-8")) % count
+
+
+def run_training(args: argparse.Namespace, shard: Optional[ShardContext] = None) -> Dict[str, Any]:
+    """
+    Một lượt huấn luyện: gom sự kiện -> prune -> rerank -> ghi kết quả, trả về summary.
+    Với `shard`, sự kiện không đọc từ MongoDB/snapshot mà nhận từ tiến trình điều phối, chỉ
+    gồm các profile thuộc shard đó (độ phổ biến vẫn tính trên toàn bộ).
+    """
+    stage_seconds: Dict[str, float] = {}
+    stage_started = time.perf_counter()
+
+    def finish_stage(name: str) -> None:
+        nonlocal stage_started
+        finished = time.perf_counter()
+        stage_seconds[name] = round(finished - stage_started, 3)
+        stage_started = finished
 
     client = MongoClient(args.mongo_uri)
     db = client[args.mongo_db]
@@ -687,40 +2077,232 @@ def main():
     profiles_coll = db[args.profiles_collection]
     recs_coll = db[args.recommendations_collection]
 
-    events_cursor = iter_events(events_coll, args.history_days)
-    raw_scores, metadata = aggregate_profiles(events_cursor)
-    # Tính tổng điểm để dùng làm thước đo độ phổ biến toàn cục cho từng sách
-    book_popularity_totals = aggregate_book_popularity(raw_scores)
+    if args.incremental and args.aggregation_engine != "python":
+        raise ValueError("--incremental hiện chỉ hỗ trợ --aggregation-engine python.")
+    if args.incremental and args.profile_store != "dict":
+        raise ValueError("--incremental hiện chỉ hỗ trợ --profile-store dict.")
+
+    snapshot_now: Optional[datetime] = None
+    if args.events_snapshot:
+        if args.aggregation_engine != "python" or args.incremental:
+            raise ValueError("--events-snapshot chỉ hỗ trợ --aggregation-engine python, không incremental.")
+        # Mọi mốc thời gian tính theo thời điểm xuất snapshot để các lần chạy lại cho cùng kết quả
+        snapshot_now = snapshot_reference_time(read_manifest(args.events_snapshot))
+        ingest_mode = "snapshot"
+    elif args.aggregation_engine == "mongo":
+        ingest_mode = "mongo"
+    else:
+        ingest_mode = args.ingest
+    meter = IngestMeter(ingest_mode, args.ingest_batch_size)
+
+    def read_batches(**options: Any) -> Iterable[List[Dict]]:
+        if shard is not None:
+            return meter.count_batches(shard.routed_batches())
+        if args.events_snapshot:
+            return meter.count_batches(iter_snapshot_batches(args.events_snapshot, args.history_days))
+        return meter.count_batches(
+            iter_event_batches(
+                events_coll, args.history_days, batch_size=args.ingest_batch_size, **options
+            )
+        )
+
+    def read_events(**options: Any) -> Iterable[Dict]:
+        if shard is not None or args.ingest == "raw-batches" or args.events_snapshot:
+            return flatten_batches(read_batches(**options))
+        return meter.count_events(iter_events(events_coll, args.history_days, **options))
+
+    def read_profile_rows(decay: Optional[TimeDecay]) -> Iterable[Dict]:
+        if shard is not None:
+            return flatten_batches(shard.routed_batches())
+        return iter_profile_rows(events_coll, args.history_days, decay)
+
+    # Mốc suy giảm của lượt chạy đầy đủ trùng với "hiện tại" của lượt chạy nên hệ số ở đây
+    # đã là hệ số cuối cùng (mọi shard dùng chung mốc của tiến trình cha)
+    run_now = shard.now if shard is not None else snapshot_now or now_utc()
+    decay = TimeDecay(args.decay_half_life_days, run_now) if args.decay_half_life_days > 0 else None
+
+    state: Optional[IncrementalTrainingState] = None
+    incremental_stats: Optional[Dict[str, Any]] = None
+    if args.incremental:
+        # Chế độ tăng dần: chỉ gộp sự kiện mới vào state rồi dựng lại điểm từ các bucket ngày
+        state_coll = db[args.state_collection]
+        ensure_event_indexes(events_coll)
+        state = IncrementalTrainingState.load(state_coll)
+        state.configure_decay(args.decay_half_life_days)
+        profiles_rebased = state.rebase(run_now)
+        events_folded = state.fold_events(read_events(after=state.watermark, ordered=True), run_now)
+        profiles_expired = state.expire(args.history_days)
+        raw_scores, metadata = state.materialize(run_now)
+        # Chỉ prune/rerank/ghi lại những profile vừa thay đổi, cộng các profile có điểm suy giảm
+        # (điểm đã lưu của chúng cũ đi theo thời gian dù không có sự kiện mới)
+        refreshed = state.changed | state.decaying_keys()
+        incremental_stats = {
+            "eventsFolded": events_folded,
+            "profilesExpired": profiles_expired,
+            "profilesRebased": profiles_rebased,
+            "profilesChanged": len(state.changed),
+            "profilesDecayRefreshed": len(refreshed - state.changed),
+        }
+        changed_scores = {key: raw_scores[key] for key in refreshed if key in metadata}
+    elif args.profile_store == "columnar":
+        # Metadata nằm sẵn trong ProfileStore nên không cần dict metadata riêng
+        if args.aggregation_engine == "mongo":
+            raw_scores = aggregate_profile_store_rows(read_profile_rows(decay))
+            meter.events = int(raw_scores.event_counts.sum())
+        elif shard is not None or args.ingest == "raw-batches" or args.events_snapshot:
+            raw_scores = aggregate_profile_store_batches(read_batches(), decay=decay)
+        else:
+            raw_scores = aggregate_profile_store(read_events(), decay=decay)
+        metadata = None
+        changed_scores = raw_scores
+    elif args.aggregation_engine == "mongo":
+        raw_scores, metadata = aggregate_profile_rows(read_profile_rows(decay))
+        meter.events = sum(meta["eventCount"] for meta in metadata.values())
+        changed_scores = raw_scores
+    else:
+        raw_scores, metadata = aggregate_profiles(read_events(), decay=decay)
+        changed_scores = raw_scores
+    ingest_stats = meter.stats()
+    finish_stage("aggregate")
+
+    cooccurrence_model: Optional[CooccurrenceModel] = None
+    cooccurrence_stats: Optional[Dict[str, Any]] = None
+    if args.cooccurrence_top_n > 0:
+        # Dùng lại mô hình lần trước và chỉ tính lại các profile đổi tập sách
+        cooccurrence_model = (
+            CooccurrenceModel.load(args.cooccurrence_dir, args.cooccurrence_top_n)
+            if args.cooccurrence_dir
+            else None
+        )
+        if cooccurrence_model is None:
+            cooccurrence_model = CooccurrenceModel.build(raw_scores, args.cooccurrence_top_n)
+            cooccurrence_stats = {"mode": "build"}
+        elif state is not None:
+            changed_profiles = {key: raw_scores.get(key, {}) for key in state.changed}
+            cooccurrence_stats = {"mode": "update", **cooccurrence_model.update(changed_profiles)}
+        else:
+            cooccurrence_stats = {"mode": "update", **cooccurrence_model.update(raw_scores, complete=True)}
+        if args.cooccurrence_dir and not args.dry_run:
+            cooccurrence_model.save(args.cooccurrence_dir)
+        cooccurrence_stats.update(
+            topN=args.cooccurrence_top_n,
+            items=len(cooccurrence_model.item_ids),
+            profiles=len(cooccurrence_model.profile_keys),
+        )
+        finish_stage("cooccurrence")
+
+    book_meta = load_book_metadata(args.book_meta_json)
+    serving_popularity: Optional[str] = None
+    if book_meta:
+        # Tổng điểm theo sách làm thước đo độ phổ biến toàn cục; khi chạy theo shard thì
+        # cộng dồn tổng của mọi shard trước khi chuẩn hoá
+        popularity_ids, popularity_sums = popularity_totals(
+            raw_scores,
+            metadata=metadata,
+            half_life_days=args.popularity_half_life_days,
+            now=shard.now if shard is not None else snapshot_now,
+        )
+        if shard is not None:
+            popularity_ids, popularity_sums = shard.exchange_popularity(popularity_ids, popularity_sums)
+        # Tổng đã gộp giống nhau ở mọi shard nên chỉ shard 0 ghi ra cho tiến trình phục vụ
+        if args.serving_dir and not args.dry_run and (shard is None or shard.index == 0):
+            serving_popularity = str(Path(args.serving_dir) / POPULARITY_TOTALS_FILE)
+            save_popularity_totals(serving_popularity, popularity_ids, popularity_sums, generated_at=run_now)
+        finish_stage("popularity")
 
     pruned_scores, pruned_meta = prune_profiles(
-        raw_scores,
+        changed_scores,
         metadata,
         min_score=args.min_score,
         top_k=args.top_k,
         max_profiles=args.max_profiles,
     )
+    finish_stage("prune")
 
-    book_meta = load_book_metadata(args.book_meta_json)
     embedding_rerank_applied = False
-    if book_meta:
+    block_size: Optional[int] = None
+    rerank_weights = dict(EMBEDDING_RERANK_WEIGHTS)
+    if cooccurrence_model is not None:
+        rerank_weights["cooccurrence"] = args.cooccurrence_weight
+    embedding_cache_stats: Optional[Dict[str, Any]] = None
+    embedding_model_loaded = False
+    llm_rerank_stats: Optional[Dict[str, Any]] = None
+    if book_meta and pruned_scores:
         # Bước 1: rerank bằng embedding + độ phổ biến nhằm mở rộng và sắp xếp lại ứng viên
+        embedding_cache = (
+            EmbeddingCache(args.embedding_cache_dir, EMBEDDING_MODEL_NAME)
+            if args.embedding_cache_dir
+            else None
+        )
+        embedding_index = EmbeddingIndex(
+            model_name=EMBEDDING_MODEL_NAME,
+            cache=embedding_cache,
+            ann_backend=args.ann_backend,
+            ann_nprobe=args.ann_nprobe,
+        )
+        embedding_index.build(book_meta)
+        if embedding_cache is not None:
+            embedding_cache_stats = embedding_cache.stats()
+        embedding_model_loaded = embedding_index.model_loaded
+        # Độ phổ biến dạng mảng căn theo thứ tự sách của index
+        book_popularity = popularity_from_totals(
+            popularity_ids,
+            popularity_sums,
+            embedding_index.book_ids,
+            scale=args.popularity_scale,
+        )
+        block_size = (
+            args.rerank_block_size
+            if args.rerank_block_size is not None
+            else rerank_block_size(len(embedding_index.book_ids), args.rerank_memory_mb)
+        )
         pruned_scores = rerank_profiles_with_embeddings(
             pruned_scores,
             book_meta=book_meta,
-            book_popularity=book_popularity_totals,
+            book_popularity=book_popularity,
             top_k=args.top_k,
-            weights=EMBEDDING_RERANK_WEIGHTS,
+            weights=rerank_weights,
             model_name=EMBEDDING_MODEL_NAME,
+            block_size=block_size,
+            index=embedding_index,
+            cooccurrence=(
+                cooccurrence_model.aligned(embedding_index.book_ids)
+                if cooccurrence_model is not None
+                else None
+            ),
         )
         embedding_rerank_applied = True
         # Bước 2: vẫn cho phép LLM/heuristic nâng cao danh sách cuối cùng nếu được cấu hình
-        pruned_scores = apply_llm_rerank(pruned_scores, book_meta, top_k=args.top_k)
+        reranker = HybridLLMReranker(
+            rate_limiter=TokenBucket(args.llm_rate_limit) if args.llm_rate_limit > 0 else None,
+            request_timeout=args.llm_timeout or None,
+        )
+        if reranker.mode == "llm" and args.llm_cache_dir:
+            reranker.cache = LLMResponseCache(args.llm_cache_dir)
+        related_table = (
+            RelatedBooksTable.load_or_build(
+                book_meta, top_n=args.related_top_n, cache_dir=args.related_cache_dir
+            )
+            if args.related_top_n > 0
+            else None
+        )
+        pruned_scores = apply_llm_rerank(
+            pruned_scores,
+            book_meta,
+            top_k=args.top_k,
+            reranker=reranker,
+            max_in_flight=args.llm_max_in_flight,
+            related=related_table,
+        )
+        llm_rerank_stats = reranker.stats()
+        finish_stage("rerank")
 
+    write_stats: Optional[Dict[str, Dict[str, Any]]] = None
     if args.dry_run:
         updated_profiles = len(pruned_scores)
         updated_recommendations = len(pruned_scores)
     else:
-        updated_profiles, updated_recommendations = persist_results(
+        updated_profiles, updated_recommendations, write_stats = persist_results(
             profiles_coll=profiles_coll,
             recommendations_coll=recs_coll,
             profiles=pruned_scores,
@@ -728,7 +2310,21 @@ def main():
             history_days=args.history_days,
             min_score=args.min_score,
             top_k=args.top_k,
+            batch_size=args.write_batch_size,
+            max_retries=args.write_retries,
+            parallel=args.parallel_writes,
         )
+        if state is not None:
+            write_stats["state"] = state.save(
+                state_coll,
+                batch_size=args.write_batch_size,
+                max_retries=args.write_retries,
+            )
+
+    finish_stage("persist")
+
+    if state is not None and state.watermark is not None:
+        incremental_stats["watermark"] = serialize_datetime(state.watermark[0])
 
     summary = {
         "generatedAt": serialize_datetime(now_utc()),
@@ -739,11 +2335,336 @@ def main():
         "profilesUpdated": updated_profiles,
         "recommendationsUpdated": updated_recommendations,
         "dryRun": args.dry_run,
+        "writeStats": write_stats,
+        "aggregationEngine": args.aggregation_engine,
+        "profileStore": args.profile_store,
+        "incremental": incremental_stats,
         "bookMetaIncluded": bool(book_meta),
         "embeddingRerankEnabled": embedding_rerank_applied,
         "embeddingModel": EMBEDDING_MODEL_NAME if embedding_rerank_applied else None,
-        "embeddingWeights": EMBEDDING_RERANK_WEIGHTS if embedding_rerank_applied else None,
+        "embeddingWeights": rerank_weights if embedding_rerank_applied else None,
+        "rerankBlockSize": block_size,
+        "embeddingCache": embedding_cache_stats,
+        "llmRerank": llm_rerank_stats,
+        "cooccurrence": cooccurrence_stats,
+        "relatedTopN": args.related_top_n,
+        "embeddingModelLoaded": embedding_model_loaded,
+        "annBackend": args.ann_backend,
+        "popularityScale": args.popularity_scale,
+        "popularityHalfLifeDays": args.popularity_half_life_days,
+        "decayHalfLifeDays": args.decay_half_life_days,
+        "servingPopularity": serving_popularity,
+        "eventsSnapshot": args.events_snapshot,
+        "ingest": ingest_stats,
+        "peakRssMb": peak_rss_mb(),
+        "stageSeconds": stage_seconds,
     }
+    return summary
+
+
+def _prepare_shared_catalog(args: argparse.Namespace, book_meta: Dict[int, Dict]) -> None:
+    """
+    Dựng trước embedding cache, ANN index và bảng sách liên quan ra đĩa để các worker
+    chỉ việc memory-map, thay vì mỗi tiến trình tự encode/tính lại một bản.
+    """
+    if not book_meta:
+        return
+    if not args.embedding_cache_dir:
+        raise ValueError("--workers > 1 cần --embedding-cache-dir để chia sẻ embedding giữa các worker.")
+    if args.related_top_n > 0 and not args.related_cache_dir:
+        raise ValueError("--workers > 1 cần --related-cache-dir để chia sẻ bảng sách liên quan.")
+    EmbeddingIndex(
+        model_name=EMBEDDING_MODEL_NAME,
+        cache=EmbeddingCache(args.embedding_cache_dir, EMBEDDING_MODEL_NAME),
+        ann_backend=args.ann_backend,
+        ann_nprobe=args.ann_nprobe,
+    ).build(book_meta)
+    if args.related_top_n > 0:
+        RelatedBooksTable.load_or_build(
+            book_meta, top_n=args.related_top_n, cache_dir=args.related_cache_dir
+        )
+
+
+def _shard_worker(
+    args: argparse.Namespace,
+    index: int,
+    count: int,
+    now: datetime,
+    events_queue: Any,
+    totals_queue: Any,
+    popularity_queue: Any,
+    result_queue: Any,
+) -> None:
+    shard = ShardContext(index, count, now, events_queue, totals_queue, popularity_queue)
+    result_queue.put((index, run_training(args, shard)))
+
+
+def _check_workers(processes: List[Any]) -> None:
+    """Dừng mọi worker và báo lỗi nếu có worker chết giữa chừng."""
+    failed = [proc for proc in processes if proc.exitcode not in (None, 0)]
+    if failed:
+        for proc in processes:
+            proc.terminate()
+        raise RuntimeError(
+            f"Worker {failed[0].name} dừng với mã {failed[0].exitcode}, huỷ lượt huấn luyện."
+        )
+
+
+def _collect(queue: Any, expected: int, processes: List[Any]) -> List[Any]:
+    """Nhận đủ `expected` phần tử từ queue; dừng mọi worker nếu có worker chết giữa chừng."""
+    items: List[Any] = []
+    while len(items) < expected:
+        try:
+            items.append(queue.get(timeout=1.0))
+        except Empty:
+            _check_workers(processes)
+    return items
+
+
+def _send(queue: Any, item: Any, processes: List[Any]) -> None:
+    """Đưa `item` vào queue có giới hạn; không chờ mãi nếu worker nhận đã chết."""
+    while True:
+        try:
+            queue.put(item, timeout=1.0)
+            return
+        except Full:
+            _check_workers(processes)
+
+
+def route_shard_inputs(
+    args: argparse.Namespace,
+    now: datetime,
+    queues: List[Any],
+    processes: List[Any],
+) -> Dict[str, Any]:
+    """
+    Đọc nguồn sự kiện đúng một lần và chuyển từng sự kiện tới shard sở hữu profile của nó
+    (crc32(key) % N), thay vì để mỗi worker tự quét toàn bộ collection rồi bỏ phần không
+    thuộc shard mình. Với engine mongo, pipeline $group chạy một lần và các document
+    (profile, sách) được chia theo cùng cách. Sự kiện không gắn được profile bị bỏ ngay.
+    Trả về thống kê đọc dữ liệu (IngestMeter) của lần quét này.
+    """
+    count = len(queues)
+    key_of: Callable[[Dict], Optional[str]] = normalize_key
+    if args.events_snapshot:
+        meter = IngestMeter("snapshot", args.ingest_batch_size)
+        batches = meter.count_batches(iter_snapshot_batches(args.events_snapshot, args.history_days))
+    else:
+        events_coll = MongoClient(args.mongo_uri)[args.mongo_db][args.events_collection]
+        if args.aggregation_engine == "mongo":
+            meter = IngestMeter("mongo", args.ingest_batch_size)
+            decay = TimeDecay(args.decay_half_life_days, now) if args.decay_half_life_days > 0 else None
+            batches = _chunked(
+                meter.count_profile_rows(iter_profile_rows(events_coll, args.history_days, decay)),
+                args.ingest_batch_size,
+            )
+            key_of = lambda row: row["_id"]["p"]  # noqa: E731
+        elif args.ingest == "raw-batches":
+            meter = IngestMeter(args.ingest, args.ingest_batch_size)
+            batches = meter.count_batches(
+                iter_event_batches(events_coll, args.history_days, batch_size=args.ingest_batch_size)
+            )
+        else:
+            meter = IngestMeter(args.ingest, args.ingest_batch_size)
+            batches = _chunked(
+                meter.count_events(iter_events(events_coll, args.history_days)), args.ingest_batch_size
+            )
+
+    for batch in batches:
+        buckets: List[List[Dict]] = [[] for _ in range(count)]
+        for item in batch:
+            profile_key = key_of(item)
+            if profile_key:
+                buckets[shard_of(profile_key, count)].append(item)
+        for queue, bucket in zip(queues, buckets):
+            if bucket:
+                _send(queue, bucket, processes)
+    for queue in queues:
+        _send(queue, None, processes)
+    return meter.stats()
+
+
+def merge_shard_summaries(
+    summaries: List[Dict[str, Any]], workers: int, ingest: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Gộp summary của các shard thành một báo cáo cùng định dạng với chế độ một tiến trình.
+    `ingest` là thống kê lần quét sự kiện duy nhất của tiến trình điều phối (route_shard_inputs);
+    số sự kiện mỗi shard nhận được nằm trong `shards`.
+    """
+    merged = dict(summaries[0])
+    merged["generatedAt"] = serialize_datetime(now_utc())
+    for field in ("profilesProcessed", "profilesUpdated", "recommendationsUpdated"):
+        merged[field] = sum(int(item[field] or 0) for item in summaries)
+    for field in ("bookMetaIncluded", "embeddingRerankEnabled", "embeddingModelLoaded"):
+        merged[field] = any(item[field] for item in summaries)
+    for field in ("embeddingModel", "embeddingWeights", "rerankBlockSize"):
+        merged[field] = next((item[field] for item in summaries if item[field] is not None), None)
+
+    write_stats = [item["writeStats"] for item in summaries if item["writeStats"]]
+    if write_stats:
+        merged["writeStats"] = {}
+        for name in write_stats[0]:
+            parts = [stats[name] for stats in write_stats if name in stats]
+            merged["writeStats"][name] = {
+                "collection": parts[0]["collection"],
+                **{
+                    key: sum(part[key] for part in parts)
+                    for key in ("batches", "operations", "written", "retries")
+                },
+                "failedBatches": [batch for part in parts for batch in part["failedBatches"]],
+                "batchSeconds": [seconds for part in parts for seconds in part["batchSeconds"]],
+            }
+
+    caches = [item["embeddingCache"] for item in summaries if item["embeddingCache"]]
+    if caches:
+        merged["embeddingCache"] = {
+            "path": caches[0]["path"],
+            "hits": sum(cache["hits"] for cache in caches),
+            "misses": sum(cache["misses"] for cache in caches),
+        }
+    llm_stats = [item["llmRerank"] for item in summaries if item["llmRerank"]]
+    if llm_stats:
+        llm_caches = [stats["cache"] for stats in llm_stats if stats["cache"]]
+        merged["llmRerank"] = {
+            **llm_stats[0],
+            "requests": sum(stats["requests"] for stats in llm_stats),
+            "failures": sum(stats["failures"] for stats in llm_stats),
+            "cache": {
+                "path": llm_caches[0]["path"],
+                "hits": sum(cache["hits"] for cache in llm_caches),
+                "misses": sum(cache["misses"] for cache in llm_caches),
+            }
+            if llm_caches
+            else None,
+        }
+
+    merged["ingest"] = ingest
+    merged["peakRssMb"] = max(
+        [ingest["peakRssMb"] or 0.0, *((item["peakRssMb"] or 0.0) for item in summaries)]
+    ) or None
+
+    # Thời gian mỗi bước của lượt chạy = shard chậm nhất ở bước đó
+    stages: Dict[str, float] = {}
+    for item in summaries:
+        for stage, seconds in item["stageSeconds"].items():
+            stages[stage] = max(stages.get(stage, 0.0), seconds)
+    merged["stageSeconds"] = stages
+    merged["workers"] = workers
+    merged["shards"] = [
+        {
+            "shard": shard_index,
+            "profilesProcessed": item["profilesProcessed"],
+            "events": item["ingest"]["events"],
+            "stageSeconds": item["stageSeconds"],
+        }
+        for shard_index, item in enumerate(summaries)
+    ]
+    return merged
+
+
+def run_sharded(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Chạy `args.workers` tiến trình, mỗi tiến trình sở hữu một shard profile (crc32(key) % N)
+    và tự gom, prune, rerank, ghi kết quả của shard mình. Tiến trình điều phối dựng trước
+    catalog dùng chung, đọc sự kiện một lần và chia cho các shard (route_shard_inputs), cộng
+    tổng độ phổ biến giữa các shard và gộp summary.
+    """
+    if args.incremental:
+        raise ValueError("--workers > 1 chưa hỗ trợ --incremental (watermark dùng chung).")
+    if args.cooccurrence_top_n > 0:
+        raise ValueError("--workers > 1 chưa hỗ trợ --cooccurrence-top-n (cần ma trận của mọi shard).")
+
+    book_meta = load_book_metadata(args.book_meta_json)
+    _prepare_shared_catalog(args, book_meta)
+
+    context = multiprocessing.get_context(SHARD_START_METHOD)
+    events_queues = [context.Queue(maxsize=SHARD_QUEUE_BATCHES) for _ in range(args.workers)]
+    totals_queue = context.Queue()
+    result_queue = context.Queue()
+    popularity_queues = [context.Queue() for _ in range(args.workers)]
+    started_at = (
+        snapshot_reference_time(read_manifest(args.events_snapshot))
+        if args.events_snapshot
+        else now_utc()
+    )
+    processes = [
+        context.Process(
+            target=_shard_worker,
+            args=(
+                args,
+                index,
+                args.workers,
+                started_at,
+                events_queues[index],
+                totals_queue,
+                popularity_queues[index],
+                result_queue,
+            ),
+            name=f"shard-{index}",
+        )
+        for index in range(args.workers)
+    ]
+    for proc in processes:
+        proc.start()
+    try:
+        ingest_stats = route_shard_inputs(args, started_at, events_queues, processes)
+        if book_meta:
+            parts = _collect(totals_queue, args.workers, processes)
+            all_ids = np.concatenate([ids for _, ids, _ in parts])
+            all_totals = np.concatenate([totals for _, _, totals in parts])
+            merged_ids, inverse = np.unique(all_ids, return_inverse=True)
+            merged_totals = np.bincount(inverse.reshape(-1), weights=all_totals, minlength=len(merged_ids))
+            for popularity_queue in popularity_queues:
+                popularity_queue.put((merged_ids, merged_totals))
+        results = dict(_collect(result_queue, args.workers, processes))
+    except BaseException:
+        # Worker còn sống sẽ chờ mãi trên queue nếu tiến trình điều phối dừng giữa chừng
+        for proc in processes:
+            proc.terminate()
+        raise
+    finally:
+        for proc in processes:
+            proc.join()
+
+    return merge_shard_summaries(
+        [results[index] for index in range(args.workers)], args.workers, ingest_stats
+    )
+
+
+def main():
+    args = parse_args()
+
+    if MongoClient is None:
+        raise ImportError(
+            "pymongo is required to run train_recommendations.py. Please install pymongo."
+        ) from _PYMONGO_IMPORT_ERROR
+
+    if args.export_snapshot:
+        client = MongoClient(args.mongo_uri)
+        events_coll = client[args.mongo_db][args.events_collection]
+        exported_at = now_utc()
+        meter = IngestMeter("export", args.ingest_batch_size)
+        batches = meter.count_batches(
+            iter_event_batches(events_coll, args.history_days, batch_size=args.ingest_batch_size)
+        )
+        manifest = export_snapshot(
+            flatten_batches(batches),
+            args.export_snapshot,
+            history_days=args.history_days,
+            exported_at=exported_at,
+        )
+        summary = {
+            "snapshot": args.export_snapshot,
+            "exportedAt": manifest["exportedAt"],
+            "historyDays": args.history_days,
+            "days": len(manifest["partitions"]),
+            "ingest": meter.stats(),
+        }
+    elif args.workers > 1:
+        summary = run_sharded(args)
+    else:
+        summary = run_training(args)
 
     print(json.dumps(summary, ensure_ascii=False))
 
@@ -0,0 +1,874 @@
+"""
+Tự kiểm tra + benchmark các đường gom điểm của train_recommendations.py.
+
+    python ai/training_checks.py pipeline-parity --mongo-uri ... --events 2000000
+        Ghi các sự kiện biên (eventType 0, userId kiểu double, bookId có khoảng trắng...) cùng
+        N sự kiện tổng hợp vào một collection tạm, đối chiếu aggregate_profiles (Python) với
+        aggregate_profiles_mongo (pipeline $group) có và không có decay, đo thời gian từng
+        đường rồi xoá collection tạm. Cần mongod thật: mongomock chưa hỗ trợ $convert/$trim.
+
+    python ai/training_checks.py shard-scaling --events 2000000 --workers 1,2,4,8
+        Chạy cùng một lượt huấn luyện (--dry-run) với từng số worker trên N sự kiện tổng hợp,
+        từ snapshot tạm (mặc định, không cần MongoDB) hoặc collection tạm (--source mongo),
+        và báo thời gian từng bước, throughput đọc dữ liệu và speedup so với cấu hình đầu tiên.
+
+    python ai/training_checks.py prune-parity --profiles 20000 --benchmark-profiles 100000
+        Đối chiếu ProfileStore.prune (kể cả _select_top_rows) với prune_profiles trên dict
+        cho nhiều tổ hợp min_score / top_k / max_profiles, trên dữ liệu cố ý có nhiều hoà điểm
+        và hoà eventCount, rồi đo thời gian prune toàn bộ (max_profiles=0) của hai đường trên
+        --benchmark-profiles profile. Không cần MongoDB.
+
+    python ai/training_checks.py store-memory --events 500000
+        Bộ nhớ còn giữ (tracemalloc) sau khi gom N sự kiện tổng hợp bằng dict lồng nhau và bằng
+        ProfileStore, kèm số byte mỗi cặp (profile, sách) và đối chiếu điểm của hai đường.
+
+    python ai/training_checks.py rerank-parity --books 2000 --profiles 1500 --distinct-texts 400
+        Đối chiếu rerank theo khối (rerank_profile_block) với vòng lặp từng profile trên catalog
+        có nhiều sách trùng văn bản (embedding trùng hệt) và điểm hoà nhau, có và không có ma
+        trận đồng xuất hiện. Dùng encoder tổng hợp nên không cần SentenceTransformer.
+
+    python ai/training_checks.py llm-concurrency --profiles 40 --latency-ms 50 --llm-max-in-flight 4
+        Chạy apply_llm_rerank với LLM_BASE_URL trỏ vào server HTTP giả lập (có độ trễ) trong
+        cùng tiến trình: kiểm tra giới hạn --llm-max-in-flight, --llm-rate-limit, fallback
+        heuristic khi quá --llm-timeout, kết quả song song trùng chạy tuần tự và cache ấm
+        không gửi request nào. Không cần khoá API hay mạng ngoài.
+
+    python ai/training_checks.py startup --books 20000 --events 200000
+        Thời gian khởi động + chạy `train_recommendations.py --dry-run` trong tiến trình mới,
+        lần đầu với cache embedding/sách liên quan rỗng và các lần sau với cache đã ấm
+        (model SentenceTransformer chỉ được nạp khi còn sách chưa có embedding).
+
+Mỗi lệnh in một báo cáo JSON; mã thoát 1 nếu phát hiện sai lệch.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import gc
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from train_recommendations import (
+    DEFAULT_DB_NAME,
+    DEFAULT_EVENTS_COLLECTION,
+    DEFAULT_INGEST_BATCH_SIZE,
+    DEFAULT_MONGO_URI,
+    EVENT_WEIGHTS,
+    HybridLLMReranker,
+    MongoClient,
+    TimeDecay,
+    TokenBucket,
+    apply_llm_rerank,
+    aggregate_profile_store,
+    aggregate_profiles,
+    aggregate_profiles_mongo,
+    flatten_batches,
+    iter_event_batches,
+    now_utc,
+    parse_args as parse_training_args,
+    prune_profiles,
+    run_sharded,
+    run_training,
+)
+from ann_index import synthetic_embeddings
+from embedding_rerank import EmbeddingIndex, rerank_profiles_with_embeddings
+from event_snapshot import export_snapshot
+from llm_response_cache import LLMResponseCache
+from profile_store import _select_top_rows
+
+# Số document mỗi lần insert_many khi ghi dữ liệu tổng hợp
+_INSERT_CHUNK = 50_000
+# Số sai lệch tối đa liệt kê trong báo cáo
+_MAX_REPORTED = 20
+
+Profiles = Tuple[Dict[str, Dict[str, float]], Dict[str, Dict]]
+
+
+def edge_case_events(now: datetime) -> List[Dict]:
+    """Các sự kiện mà $toString/$convert mặc định của MongoDB hiểu khác parse_event."""
+    at = now - timedelta(days=1)
+    cases: List[Dict] = [
+        # Khoá profile: str() của Python, không phải $toString
+        {"userId": 12.0, "bookId": 1},
+        {"userId": 12, "bookId": 1},
+        {"userId": 7.5, "bookId": 1},
+        {"userId": 0, "bookId": 1},
+        {"userId": True, "bookId": 1},
+        {"userId": False, "bookId": 1},
+        {"userId": "null", "sessionId": "s-1", "bookId": 1},
+        {"userId": "", "sessionId": 3.0, "bookId": 1},
+        {"sessionId": 0, "bookId": 1},
+        {"sessionId": False, "bookId": 1},
+        {"sessionId": "", "bookId": 1},
+        # bookId: int() bỏ khoảng trắng hai đầu, cắt phần thập phân của số thực
+        {"userId": "u-1", "bookId": " 42 "},
+        {"userId": "u-1", "bookId": "\t43\n"},
+        {"userId": "u-1", "bookId": "4 4"},
+        {"userId": "u-1", "bookId": "12.5"},
+        {"userId": "u-1", "bookId": "abc"},
+        {"userId": "u-1", "bookId": 7.9},
+        {"userId": "u-1", "bookId": "-3"},
+        {"userId": "u-1", "bookId": None},
+        # eventType rỗng/0/False => "unknown"
+        {"userId": "u-2", "bookId": 5, "eventType": 0},
+        {"userId": "u-2", "bookId": 5, "eventType": ""},
+        {"userId": "u-2", "bookId": 5, "eventType": False},
+        {"userId": "u-2", "bookId": 5, "eventType": None},
+        {"userId": "u-2", "bookId": 5},
+        # Điểm: finalScore -> value (kể cả dạng chuỗi) -> EVENT_WEIGHTS
+        {"userId": "u-3", "bookId": 6, "eventType": "purchasetracks", "value": "3"},
+        {"userId": "u-3", "bookId": 6, "eventType": "purchasetracks", "finalScore": 0},
+        {"userId": "u-3", "bookId": 6, "eventType": "searchtracks"},
+    ]
+    for position, event in enumerate(cases):
+        event["occurredAt"] = at - timedelta(minutes=position)
+    # Sự kiện không có occurredAt: không suy giảm và không tính vào lastEventAt
+    cases.append({"userId": "u-3", "bookId": 6, "eventType": "carttracks"})
+    return cases
+
+
+def synthetic_events(count: int, now: datetime, seed: int = 13) -> Iterable[List[Dict]]:
+    """Sự kiện tổng hợp theo lô: ~1/4 ẩn danh, sách theo phân phối Zipf, rải đều trong 90 ngày."""
+    rng = np.random.default_rng(seed)
+    event_types = list(EVENT_WEIGHTS) + ["wishlist"]
+    n_profiles = max(1, count // 20)
+    n_books = max(1, count // 50)
+    weights = 1.0 / np.arange(1, n_books + 1) ** 0.8
+    weights /= weights.sum()
+    for start in range(0, count, _INSERT_CHUNK):
+        size = min(_INSERT_CHUNK, count - start)
+        profiles = rng.integers(0, n_profiles, size=size).tolist()
+        books = (rng.choice(n_books, size=size, p=weights) + 1).tolist()
+        types = rng.integers(0, len(event_types), size=size).tolist()
+        ages = rng.uniform(0, 90 * 86_400, size=size).tolist()
+        kinds = rng.random(size=size).tolist()
+        batch: List[Dict] = []
+        for profile, book, etype, age, kind in zip(profiles, books, types, ages, kinds):
+            event: Dict[str, Any] = {
+                "bookId": book if kind < 0.9 else str(book),
+                "eventType": event_types[etype],
+                "occurredAt": now - timedelta(seconds=age),
+            }
+            if profile % 4 == 0:
+                event["sessionId"] = f"session-{profile}"
+            else:
+                event["userId"] = profile
+            if kind < 0.05:
+                event["finalScore"] = round(kind * 40, 3)
+            elif kind < 0.15:
+                event["value"] = round(kind * 10, 3)
+            batch.append(event)
+        yield batch
+
+
+def compare_profiles(expected: Profiles, actual: Profiles) -> List[str]:
+    """Sai lệch giữa hai kết quả (raw_scores, metadata); điểm so với sai số tương đối 1e-9."""
+    problems: List[str] = []
+    expected_scores, expected_meta = expected
+    actual_scores, actual_meta = actual
+    for key in sorted(set(expected_scores) | set(actual_scores)):
+        want = expected_scores.get(key)
+        got = actual_scores.get(key)
+        if want is None or got is None:
+            problems.append(f"{key!r}: chỉ có ở {'mongo' if want is None else 'python'}")
+            continue
+        for book_id in sorted(set(want) | set(got)):
+            if book_id not in want or book_id not in got:
+                problems.append(f"{key!r}/{book_id}: python={want.get(book_id)} mongo={got.get(book_id)}")
+            elif not math.isclose(want[book_id], got[book_id], rel_tol=1e-9, abs_tol=1e-9):
+                problems.append(f"{key!r}/{book_id}: python={want[book_id]!r} mongo={got[book_id]!r}")
+        meta_want = expected_meta.get(key) or {}
+        meta_got = actual_meta.get(key) or {}
+        for field in ("eventCount", "eventTypes", "lastEventAt"):
+            if meta_want.get(field) != meta_got.get(field):
+                problems.append(
+                    f"{key!r}.{field}: python={meta_want.get(field)!r} mongo={meta_got.get(field)!r}"
+                )
+    return problems
+
+
+def _timed(fn, *args: Any, **kwargs: Any) -> Tuple[Any, float]:
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, round(time.perf_counter() - started, 3)
+
+
+def run_pipeline_parity(
+    collection, n_events: int, half_life_days: float, batch_size: int = DEFAULT_INGEST_BATCH_SIZE
+) -> Dict[str, Any]:
+    """Đối chiếu aggregate_profiles với aggregate_profiles_mongo trên `collection` (phải rỗng)."""
+    now = now_utc()
+    collection.insert_many(edge_case_events(now), ordered=False)
+    for batch in synthetic_events(n_events, now):
+        collection.insert_many(batch, ordered=False)
+
+    report: Dict[str, Any] = {"events": collection.estimated_document_count(), "runs": {}}
+    for name, decay in (("plain", None), ("decay", TimeDecay(half_life_days, now))):
+        python_result, python_seconds = _timed(
+            aggregate_profiles,
+            flatten_batches(iter_event_batches(collection, 0, batch_size=batch_size)),
+            decay=decay,
+        )
+        mongo_result, mongo_seconds = _timed(aggregate_profiles_mongo, collection, 0, decay=decay)
+        problems = compare_profiles(python_result, mongo_result)
+        report["runs"][name] = {
+            "profiles": len(python_result[0]),
+            "pythonSeconds": python_seconds,
+            "mongoSeconds": mongo_seconds,
+            "mismatches": len(problems),
+            "examples": problems[:_MAX_REPORTED],
+        }
+    report["ok"] = all(run["mismatches"] == 0 for run in report["runs"].values())
+    return report
+
+
+# Mốc thời gian của một nửa sự kiện tie_heavy_events (kiểm tra lastEventAt trong metadata)
+_TIE_EPOCH = datetime(2024, 1, 1)
+
+
+def tie_heavy_events(n_profiles: int, seed: int = 13) -> List[Dict]:
+    """
+    Sự kiện cho prune-parity: điểm chỉ lấy từ vài giá trị rời rạc (EVENT_WEIGHTS, value nhỏ hơn
+    min_score) và số sự kiện mỗi profile trong khoảng hẹp, nên hoà điểm / hoà eventCount rất nhiều.
+    """
+    rng = np.random.default_rng(seed)
+    event_types = list(EVENT_WEIGHTS)
+    events: List[Dict] = []
+    for profile in range(n_profiles):
+        size = int(rng.integers(1, 12))
+        books = rng.integers(1, 60, size=size).tolist()
+        types = rng.integers(0, len(event_types), size=size).tolist()
+        kinds = rng.random(size=size).tolist()
+        for book, etype, kind in zip(books, types, kinds):
+            event: Dict[str, Any] = {"userId": profile, "bookId": book, "eventType": event_types[etype]}
+            if kind < 0.1:
+                event["value"] = 0.1
+            if kind < 0.5:
+                event["occurredAt"] = _TIE_EPOCH + timedelta(seconds=int(kind * 1e7))
+            events.append(event)
+    return events
+
+
+def run_prune_benchmark(n_profiles: int, seed: int = 13, repeats: int = 3) -> Dict[str, Any]:
+    """Thời gian tốt nhất của prune toàn bộ (min_score=0, top_k=25, max_profiles=0) trên mỗi đường."""
+    events = tie_heavy_events(n_profiles, seed)
+    raw_scores, metadata = aggregate_profiles(events)
+    store = aggregate_profile_store(events)
+    del events
+    dict_seconds = min(_timed(prune_profiles, raw_scores, metadata, 0.0, 25, 0)[1] for _ in range(repeats))
+    store_seconds = min(_timed(prune_profiles, store, None, 0.0, 25, 0)[1] for _ in range(repeats))
+    return {
+        "profiles": n_profiles,
+        "dictSeconds": dict_seconds,
+        "storeSeconds": store_seconds,
+        "speedup": round(dict_seconds / store_seconds, 2) if store_seconds > 0 else None,
+    }
+
+
+def run_prune_parity(n_profiles: int, seed: int = 13, benchmark_profiles: int = 0) -> Dict[str, Any]:
+    """ProfileStore.prune và prune_profiles phải cho cùng profile, cùng thứ tự và cùng điểm."""
+    events = tie_heavy_events(n_profiles, seed)
+    raw_scores, metadata = aggregate_profiles(events)
+    store = aggregate_profile_store(events)
+    problems: List[str] = []
+
+    # _select_top_rows phải trùng với sorted ổn định theo eventCount giảm dần
+    rng = np.random.default_rng(seed)
+    for trial in range(200):
+        counts = rng.integers(0, int(rng.integers(1, 6)), size=int(rng.integers(1, 300)))
+        limit = int(rng.integers(0, len(counts) + 3))
+        expected = sorted(range(len(counts)), key=lambda row: -counts[row])
+        if limit > 0:
+            expected = expected[:limit]
+        got = _select_top_rows(counts, limit).tolist()
+        if got != expected:
+            problems.append(f"_select_top_rows trial {trial} (max_profiles={limit}): {got[:10]} != {expected[:10]}")
+
+    cases = 0
+    dict_seconds = store_seconds = 0.0
+    for min_score in (0.0, 0.2, 2.0, 4.5):
+        for top_k in (0, 1, 3, 25):
+            for max_profiles in (0, 1, 7, n_profiles // 3, n_profiles, n_profiles + 5):
+                cases += 1
+                (want_scores, want_meta), seconds = _timed(
+                    prune_profiles, raw_scores, metadata, min_score, top_k, max_profiles
+                )
+                dict_seconds += seconds
+                (got_scores, got_meta), seconds = _timed(
+                    prune_profiles, store, None, min_score, top_k, max_profiles
+                )
+                store_seconds += seconds
+                case = f"min_score={min_score} top_k={top_k} max_profiles={max_profiles}"
+                if list(want_scores) != list(got_scores):
+                    problems.append(f"{case}: thứ tự/tập profile khác nhau")
+                    continue
+                for key, want in want_scores.items():
+                    if list(want.items()) != list(got_scores[key].items()):
+                        problems.append(f"{case}: {key} {list(want.items())[:5]} != {list(got_scores[key].items())[:5]}")
+                    elif want_meta[key] != got_meta[key]:
+                        problems.append(f"{case}: metadata của {key} khác nhau")
+    return {
+        "profiles": n_profiles,
+        "events": len(events),
+        "cases": cases,
+        "dictSeconds": round(dict_seconds, 3),
+        "storeSeconds": round(store_seconds, 3),
+        "fullPrune": run_prune_benchmark(benchmark_profiles, seed) if benchmark_profiles > 0 else None,
+        "mismatches": len(problems),
+        "examples": problems[:_MAX_REPORTED],
+        "ok": not problems,
+    }
+
+
+class _TextEncoder:
+    """Thay SentenceTransformer: mỗi văn bản một vector tổng hợp cố định, văn bản trùng -> vector trùng."""
+
+    def __init__(self, dim: int, seed: int):
+        self.dim = dim
+        self.seed = seed
+
+    def encode(self, texts: List[str], **_: Any) -> np.ndarray:
+        distinct = {text: row for row, text in enumerate(dict.fromkeys(texts))}
+        vectors = synthetic_embeddings(len(distinct), self.dim, n_topics=20, seed=self.seed)
+        return vectors[[distinct[text] for text in texts]]
+
+
+def run_rerank_parity(
+    n_books: int, n_profiles: int, distinct_texts: int, seed: int = 13, block_sizes: Iterable[int] = (1, 7, 256)
+) -> Dict[str, Any]:
+    """
+    rerank_profile_block (block_size > 0) phải cho đúng kết quả của vòng lặp từng profile
+    (block_size = 0): cùng sách, cùng thứ tự, cùng điểm. Catalog chỉ có `distinct_texts`
+    văn bản khác nhau nên nhiều sách có embedding trùng hệt, điểm hành vi và độ phổ biến
+    cũng cố ý hoà nhau; chạy cả có và không có ma trận đồng xuất hiện.
+    """
+    rng = np.random.default_rng(seed)
+    book_meta = {
+        pid: {
+            "title": f"Title {pid % distinct_texts}",
+            "category_id": pid % distinct_texts % 7,
+            "author_id": None,
+            "publisher_id": None,
+        }
+        for pid in range(1, n_books + 1)
+    }
+    index = EmbeddingIndex()
+    index._model = _TextEncoder(64, seed)
+    index.build(book_meta)
+
+    profiles: Dict[str, Dict[str, float]] = {}
+    for row in range(n_profiles):
+        # Có cả sách ngoài catalog và điểm <= 0 (không góp vào vector người dùng)
+        pids = rng.choice(n_books + 20, size=int(rng.integers(0, 12)), replace=False) + 1
+        profiles[f"user:{row}"] = {str(pid): float(rng.choice([0.0, 0.5, 1.0, 1.0, 2.0, 3.0])) for pid in pids.tolist()}
+    popularity = rng.integers(0, 5, size=n_books) / 4.0
+    cooccurrence = sparse.random(
+        n_books, n_books, density=min(1.0, 8 / n_books), format="csr", random_state=seed
+    )
+    cooccurrence.data = np.ceil(cooccurrence.data * 4) / 4
+
+    problems: List[str] = []
+    timings: List[Dict[str, Any]] = []
+    for co_matrix, weights in (
+        (None, {"behavior": 0.6, "embedding": 0.3, "popularity": 0.1}),
+        (cooccurrence, {"behavior": 0.5, "embedding": 0.25, "popularity": 0.1, "cooccurrence": 0.15}),
+    ):
+        label = "cooccurrence" if co_matrix is not None else "embedding"
+        options = dict(
+            book_meta=book_meta, book_popularity=popularity, top_k=10, weights=weights,
+            index=index, cooccurrence=co_matrix,
+        )
+        want, seconds = _timed(rerank_profiles_with_embeddings, profiles, **options)
+        timings.append({"case": label, "blockSize": 0, "seconds": seconds})
+        for block_size in block_sizes:
+            got, seconds = _timed(rerank_profiles_with_embeddings, profiles, block_size=block_size, **options)
+            timings.append({"case": label, "blockSize": block_size, "seconds": seconds})
+            for key, expected in want.items():
+                if list(expected.items()) != list(got[key].items()):
+                    problems.append(
+                        f"{label} block_size={block_size} {key}: {list(got[key])} != {list(expected)}"
+                    )
+    return {
+        "books": n_books,
+        "profiles": n_profiles,
+        "distinctTexts": distinct_texts,
+        "timings": timings,
+        "mismatches": len(problems),
+        "examples": problems[:_MAX_REPORTED],
+        "ok": not problems,
+    }
+
+
+def run_store_memory(n_events: int, seed: int = 13) -> Dict[str, Any]:
+    """
+    Bộ nhớ còn giữ (tracemalloc) sau khi gom `n_events` sự kiện tổng hợp bằng dict lồng nhau
+    (aggregate_profiles) và bằng ProfileStore; hai kết quả phải cùng điểm, cùng thứ tự.
+    """
+    events = list(flatten_batches(synthetic_events(n_events, now_utc(), seed)))
+
+    def retained(fn):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = fn(events)
+            gc.collect()
+            return result, tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    (raw_scores, _metadata), dict_bytes = retained(aggregate_profiles)
+    store, store_bytes = retained(aggregate_profile_store)
+    entries = len(store.entries()[0])
+    store_scores, _ = store.to_dicts()
+    problems = [
+        f"{key}: {list(store_scores.get(key, {}).items())[:5]} != {list(score_map.items())[:5]}"
+        for key, score_map in raw_scores.items()
+        if list(store_scores.get(key, {}).items()) != list(score_map.items())
+    ]
+    return {
+        "events": len(events),
+        "profiles": len(store),
+        "entries": entries,
+        "dictMb": round(dict_bytes / 2**20, 1),
+        "storeMb": round(store_bytes / 2**20, 1),
+        "dictBytesPerEntry": round(dict_bytes / max(1, entries), 1),
+        "storeBytesPerEntry": round(store_bytes / max(1, entries), 1),
+        "reduction": round(dict_bytes / store_bytes, 2) if store_bytes else None,
+        "mismatches": len(problems),
+        "examples": problems[:_MAX_REPORTED],
+        "ok": not problems and len(store_scores) == len(raw_scores),
+    }
+
+
+def run_shard_scaling(worker_counts: List[int], training_argv: List[str]) -> Dict[str, Any]:
+    """Một lượt huấn luyện --dry-run cho mỗi số worker, cùng nguồn sự kiện `training_argv`."""
+    runs: List[Dict[str, Any]] = []
+    for workers in worker_counts:
+        args = parse_training_args([*training_argv, "--dry-run", "--workers", str(workers)])
+        started = time.perf_counter()
+        summary = run_sharded(args) if workers > 1 else run_training(args)
+        runs.append(
+            {
+                "workers": workers,
+                "seconds": round(time.perf_counter() - started, 3),
+                "profilesProcessed": summary["profilesProcessed"],
+                "stageSeconds": summary["stageSeconds"],
+                "ingest": summary["ingest"],
+                "peakRssMb": summary["peakRssMb"],
+            }
+        )
+    baseline = runs[0]["seconds"]
+    for run in runs:
+        run["speedup"] = round(baseline / run["seconds"], 2) if run["seconds"] > 0 else None
+    # Mọi cấu hình phải xử lý cùng số profile
+    ok = len({run["profilesProcessed"] for run in runs}) == 1
+    return {"runs": runs, "ok": ok}
+
+
+# Biến môi trường bật LLM rerank: bỏ đi để benchmark khởi động không gọi mạng
+_LLM_ENV = ("LLM_BASE_URL", "OPENAI_API_KEY", "LLM_API_KEY", "GEMINI_API_KEY", "GOOGLE_API_KEY")
+
+
+def synthetic_book_meta(n_books: int, seed: int = 13) -> List[Dict]:
+    """Catalog tổng hợp cùng định dạng --book-meta-json."""
+    rng = np.random.default_rng(seed)
+    categories = rng.integers(1, 60, size=n_books).tolist()
+    authors = rng.integers(1, max(2, n_books // 8), size=n_books).tolist()
+    publishers = rng.integers(1, 40, size=n_books).tolist()
+    return [
+        {
+            "product_id": pid,
+            "title": f"Book {pid}",
+            "category_id": category,
+            "author_id": author,
+            "publisher_id": publisher,
+            "price": 100.0,
+            "stock": 10,
+        }
+        for pid, category, author, publisher in zip(range(1, n_books + 1), categories, authors, publishers)
+    ]
+
+
+def run_startup_benchmark(training_argv: List[str], repeats: int) -> Dict[str, Any]:
+    """
+    Chạy train_recommendations.py --dry-run trong tiến trình Python mới (tính cả thời gian
+    import), lần đầu với cache rỗng rồi `repeats` lần với cache đã ấm.
+    """
+    script = Path(__file__).with_name("train_recommendations.py")
+    env = {name: value for name, value in os.environ.items() if name not in _LLM_ENV}
+
+    def launch(*argv: str) -> Tuple[float, Dict[str, Any]]:
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, *argv], capture_output=True, text=True, env=env, check=True
+        )
+        seconds = round(time.perf_counter() - started, 3)
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+        return seconds, json.loads(lines[-1]) if lines else {}
+
+    import_seconds, _ = launch(
+        "-c", f"import sys; sys.path.insert(0, {str(script.parent)!r}); import train_recommendations"
+    )
+    runs: List[Dict[str, Any]] = []
+    for attempt in range(1 + repeats):
+        seconds, summary = launch(str(script), *training_argv, "--dry-run")
+        runs.append(
+            {
+                "cache": "cold" if attempt == 0 else "warm",
+                "seconds": seconds,
+                "embeddingModelLoaded": summary.get("embeddingModelLoaded"),
+                "embeddingCache": summary.get("embeddingCache"),
+                "stageSeconds": summary.get("stageSeconds"),
+            }
+        )
+    warm = [run for run in runs if run["cache"] == "warm"]
+    return {
+        "importSeconds": import_seconds,
+        "runs": runs,
+        "coldSeconds": runs[0]["seconds"],
+        "warmSeconds": min(run["seconds"] for run in warm) if warm else None,
+        # Cache ấm thì không được nạp model
+        "ok": all(not run["embeddingModelLoaded"] for run in warm),
+    }
+
+
+class _FakeLLMHandler(BaseHTTPRequestHandler):
+    """
+    /chat/completions giả lập kiểu OpenAI: chờ `latency` giây (`slow_latency` cho profile
+    "slow:*" khi bật) rồi trả thứ hạng đảo ngược danh sách ID trong prompt. Ghi lại số request,
+    số request đồng thời lớn nhất và thời điểm đến của từng request.
+    """
+
+    def do_POST(self) -> None:
+        state = self.server.state
+        prompt = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["messages"][0]["content"]
+        with state["lock"]:
+            state["requests"] += 1
+            state["arrivals"].append(time.monotonic())
+            state["inFlight"] += 1
+            state["maxInFlight"] = max(state["maxInFlight"], state["inFlight"])
+        try:
+            slow = state["slowLatency"] is not None and "Hồ sơ: slow:" in prompt
+            time.sleep(state["slowLatency"] if slow else state["latency"])
+            ranking = [int(pid) for pid in re.findall(r"- ID (\d+) \|", prompt)][::-1]
+            content = json.dumps({"ranking": ranking})
+            body = json.dumps({"choices": [{"message": {"content": content}}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client đã bỏ cuộc vì timeout
+            pass
+        finally:
+            with state["lock"]:
+                state["inFlight"] -= 1
+
+    def log_message(self, *_: Any) -> None:
+        pass
+
+
+def run_llm_concurrency(
+    n_profiles: int,
+    latency: float,
+    max_in_flight: int,
+    rate_limit: float,
+    timeout: float,
+    seed: int = 13,
+) -> Dict[str, Any]:
+    """
+    Chạy apply_llm_rerank với LLM_BASE_URL trỏ vào server giả lập cục bộ có độ trễ:
+      - max_in_flight > 1 phải cho đúng kết quả chạy tuần tự và không vượt quá max_in_flight
+        request đồng thời;
+      - --llm-rate-limit: các request phải trải ra ít nhất (n - burst) / rate giây;
+      - request quá --llm-timeout fallback heuristic (đúng thứ hạng heuristic), các profile khác
+        vẫn dùng thứ hạng LLM;
+      - cache ấm: lượt thứ hai không gửi request nào và cho cùng kết quả.
+    """
+    rng = np.random.default_rng(seed)
+    book_meta = {meta["product_id"]: meta for meta in synthetic_book_meta(400, seed)}
+    profiles: Dict[str, Dict[str, float]] = {}
+    for row in range(n_profiles):
+        # Mỗi profile "slow:*" chỉ chậm khi bật slowLatency (ca timeout)
+        key = f"slow:{row}" if row % 5 == 0 else f"user:{row}"
+        pids = rng.choice(len(book_meta), size=8, replace=False) + 1
+        profiles[key] = {str(pid): float(rng.integers(1, 8)) for pid in pids.tolist()}
+    top_k = 10
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeLLMHandler)
+    server.daemon_threads = True
+    server.state = {"lock": threading.Lock()}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    saved_env = {name: os.environ.pop(name) for name in _LLM_ENV if name in os.environ}
+    problems: List[str] = []
+    cases: List[Dict[str, Any]] = []
+
+    def run(label: str, in_flight: int, slow_latency: Optional[float] = None, **options: Any):
+        server.state.update(requests=0, inFlight=0, maxInFlight=0, arrivals=[], latency=latency, slowLatency=slow_latency)
+        reranker = HybridLLMReranker(**options)
+        started = time.perf_counter()
+        ranked = apply_llm_rerank(profiles, book_meta, top_k, reranker=reranker, max_in_flight=in_flight)
+        arrivals = server.state["arrivals"]
+        cases.append(
+            {
+                "case": label,
+                "maxInFlight": in_flight,
+                "seconds": round(time.perf_counter() - started, 3),
+                "requests": server.state["requests"],
+                "observedMaxInFlight": server.state["maxInFlight"],
+                "arrivalSpan": round(max(arrivals) - min(arrivals), 3) if arrivals else 0.0,
+                "failures": reranker.failures,
+                "mode": reranker.mode,
+            }
+        )
+        return {key: list(score_map.items()) for key, score_map in ranked.items()}, cases[-1]
+
+    cache_dir = tempfile.mkdtemp(prefix="llm-concurrency-")
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            heuristic, _ = run("heuristic", 1)
+            os.environ["LLM_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+            sequential, case = run("sequential", 1)
+            if case["requests"] != n_profiles or case["mode"] != "llm":
+                problems.append(f"sequential: {case['requests']} request, mode {case['mode']}")
+            if sequential == heuristic:
+                problems.append("server giả lập cho cùng thứ hạng với heuristic, không phân biệt được hai đường")
+
+            concurrent, case = run("concurrent", max_in_flight)
+            if concurrent != sequential:
+                problems.append("concurrent: kết quả khác chạy tuần tự")
+            if not 1 < case["observedMaxInFlight"] <= max_in_flight:
+                problems.append(f"concurrent: {case['observedMaxInFlight']} request đồng thời (giới hạn {max_in_flight})")
+
+            bucket = TokenBucket(rate_limit)
+            limited, case = run("rate-limit", max_in_flight, rate_limiter=bucket)
+            min_span = (n_profiles - bucket.capacity) / rate_limit
+            if limited != sequential:
+                problems.append("rate-limit: kết quả khác chạy tuần tự")
+            if case["arrivalSpan"] < 0.9 * min_span:
+                problems.append(f"rate-limit: request trải trong {case['arrivalSpan']}s, cần >= {min_span:.2f}s")
+
+            slow_latency = timeout + max(1.0, 4 * latency)
+            timed_out, case = run("timeout", max_in_flight, slow_latency, request_timeout=timeout)
+            slow_keys = [key for key in profiles if key.startswith("slow:")]
+            for key in profiles:
+                expected = heuristic[key] if key in slow_keys else sequential[key]
+                if timed_out[key] != expected:
+                    problems.append(f"timeout: {key} không khớp {'heuristic' if key in slow_keys else 'LLM'}")
+            if case["failures"] != len(slow_keys):
+                problems.append(f"timeout: {case['failures']} lần fallback, cần {len(slow_keys)}")
+
+            cold, case = run("cache-cold", max_in_flight, cache=LLMResponseCache(cache_dir))
+            warm, warm_case = run("cache-warm", max_in_flight, cache=LLMResponseCache(cache_dir))
+            if cold != sequential or warm != sequential:
+                problems.append("cache: kết quả khác chạy tuần tự")
+            if warm_case["requests"] != 0:
+                problems.append(f"cache-warm: {warm_case['requests']} request, cần 0")
+    finally:
+        os.environ.pop("LLM_BASE_URL", None)
+        os.environ.update(saved_env)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return {
+        "profiles": n_profiles,
+        "latencySeconds": latency,
+        "cases": cases,
+        "problems": problems,
+        "ok": not problems,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Tự kiểm tra + benchmark các đường gom điểm huấn luyện.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parity = commands.add_parser(
+        "pipeline-parity", help="So sánh pipeline $group của MongoDB với parse_event trên collection tạm."
+    )
+    parity.add_argument("--mongo-uri", default=DEFAULT_MONGO_URI)
+    parity.add_argument("--mongo-db", default=DEFAULT_DB_NAME)
+    parity.add_argument("--events", type=int, default=1_000_000, help="Số sự kiện tổng hợp thêm vào các ca biên.")
+    parity.add_argument("--decay-half-life-days", type=float, default=14.0)
+    parity.add_argument("--ingest-batch-size", type=int, default=DEFAULT_INGEST_BATCH_SIZE)
+
+    scaling = commands.add_parser(
+        "shard-scaling", help="Thời gian huấn luyện theo số worker (--workers) trên dữ liệu tổng hợp."
+    )
+    scaling.add_argument("--source", choices=("snapshot", "mongo"), default="snapshot")
+    scaling.add_argument("--mongo-uri", default=DEFAULT_MONGO_URI)
+    scaling.add_argument("--mongo-db", default=DEFAULT_DB_NAME)
+    scaling.add_argument("--events", type=int, default=1_000_000)
+    scaling.add_argument("--workers", default="1,2,4,8", help="Danh sách số worker, phân tách bằng dấu phẩy.")
+    scaling.add_argument(
+        "--training-args",
+        default="",
+        help="Tham số thêm cho train_recommendations.py, ví dụ \"--book-meta-json books.json --aggregation-engine mongo\".",
+    )
+
+    prune = commands.add_parser(
+        "prune-parity", help="So sánh ProfileStore.prune với prune_profiles trên dữ liệu nhiều hoà điểm."
+    )
+    prune.add_argument("--profiles", type=int, default=20_000)
+    prune.add_argument("--seed", type=int, default=13)
+    prune.add_argument(
+        "--benchmark-profiles",
+        type=int,
+        default=100_000,
+        help="Số profile cho phép đo prune toàn bộ dict vs ProfileStore (0 = bỏ qua).",
+    )
+
+    memory = commands.add_parser(
+        "store-memory", help="Bộ nhớ còn giữ sau khi gom điểm: dict lồng nhau vs ProfileStore."
+    )
+    memory.add_argument("--events", type=int, default=500_000)
+    memory.add_argument("--seed", type=int, default=13)
+
+    rerank = commands.add_parser(
+        "rerank-parity", help="So sánh rerank theo khối với vòng lặp từng profile khi có embedding trùng."
+    )
+    rerank.add_argument("--books", type=int, default=2000)
+    rerank.add_argument("--profiles", type=int, default=1500)
+    rerank.add_argument("--distinct-texts", type=int, default=400, help="Số văn bản sách khác nhau (< --books).")
+    rerank.add_argument("--block-sizes", default="1,7,256", help="Danh sách block_size, phân tách bằng dấu phẩy.")
+    rerank.add_argument("--seed", type=int, default=13)
+
+    llm = commands.add_parser(
+        "llm-concurrency", help="LLM rerank song song/giới hạn tốc độ/timeout/cache với server giả lập."
+    )
+    llm.add_argument("--profiles", type=int, default=40)
+    llm.add_argument("--latency-ms", type=float, default=50.0, help="Độ trễ của server giả lập mỗi request.")
+    llm.add_argument("--llm-max-in-flight", type=int, default=4)
+    llm.add_argument("--llm-rate-limit", type=float, default=20.0)
+    llm.add_argument("--llm-timeout", type=float, default=0.3)
+    llm.add_argument("--seed", type=int, default=13)
+
+    startup = commands.add_parser(
+        "startup", help="Thời gian khởi động train_recommendations.py --dry-run với cache rỗng/ấm."
+    )
+    startup.add_argument("--books", type=int, default=20_000)
+    startup.add_argument("--events", type=int, default=200_000)
+    startup.add_argument("--repeats", type=int, default=2, help="Số lần chạy lại với cache ấm.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.command == "pipeline-parity":
+        if MongoClient is None:
+            raise ImportError("pymongo is required for pipeline-parity. Please install pymongo.")
+        client = MongoClient(args.mongo_uri)
+        scratch = client[args.mongo_db][f"{DEFAULT_EVENTS_COLLECTION}_parity_{os.getpid()}"]
+        try:
+            report = run_pipeline_parity(
+                scratch, args.events, args.decay_half_life_days, args.ingest_batch_size
+            )
+        finally:
+            scratch.drop()
+            client.close()
+    elif args.command == "shard-scaling":
+        worker_counts = [int(count) for count in args.workers.split(",") if count.strip()]
+        training_argv = ["--history-days", "0", "--serving-dir", "", *args.training_args.split()]
+        now = now_utc()
+        events = flatten_batches(synthetic_events(args.events, now))
+        if args.source == "snapshot":
+            workdir = tempfile.mkdtemp(prefix="shard-scaling-")
+            try:
+                export_snapshot(events, workdir, history_days=0, exported_at=now)
+                report = run_shard_scaling(worker_counts, [*training_argv, "--events-snapshot", workdir])
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            if MongoClient is None:
+                raise ImportError("pymongo is required for --source mongo. Please install pymongo.")
+            client = MongoClient(args.mongo_uri)
+            scratch_name = f"{DEFAULT_EVENTS_COLLECTION}_scaling_{os.getpid()}"
+            scratch = client[args.mongo_db][scratch_name]
+            try:
+                for batch in synthetic_events(args.events, now):
+                    scratch.insert_many(batch, ordered=False)
+                report = run_shard_scaling(
+                    worker_counts,
+                    [
+                        *training_argv,
+                        "--mongo-uri",
+                        args.mongo_uri,
+                        "--mongo-db",
+                        args.mongo_db,
+                        "--events-collection",
+                        scratch_name,
+                    ],
+                )
+            finally:
+                scratch.drop()
+                client.close()
+        report["events"] = args.events
+        report["source"] = args.source
+        report["cpus"] = os.cpu_count()
+    elif args.command == "prune-parity":
+        report = run_prune_parity(args.profiles, args.seed, args.benchmark_profiles)
+    elif args.command == "store-memory":
+        report = run_store_memory(args.events, args.seed)
+    elif args.command == "llm-concurrency":
+        report = run_llm_concurrency(
+            args.profiles,
+            args.latency_ms / 1000.0,
+            args.llm_max_in_flight,
+            args.llm_rate_limit,
+            args.llm_timeout,
+            args.seed,
+        )
+    elif args.command == "rerank-parity":
+        block_sizes = [int(size) for size in args.block_sizes.split(",") if size.strip()]
+        report = run_rerank_parity(args.books, args.profiles, args.distinct_texts, args.seed, block_sizes)
+    elif args.command == "startup":
+        workdir = Path(tempfile.mkdtemp(prefix="startup-"))
+        try:
+            now = now_utc()
+            export_snapshot(
+                flatten_batches(synthetic_events(args.events, now)),
+                workdir / "events",
+                history_days=0,
+                exported_at=now,
+            )
+            (workdir / "books.json").write_text(json.dumps(synthetic_book_meta(args.books)), encoding="utf-8")
+            training_argv = [
+                "--history-days", "0",
+                "--events-snapshot", str(workdir / "events"),
+                "--book-meta-json", str(workdir / "books.json"),
+                "--embedding-cache-dir", str(workdir / "embedding_cache"),
+                "--related-cache-dir", str(workdir / "related_books"),
+                "--llm-cache-dir", "",
+                "--serving-dir", "",
+            ]
+            report = run_startup_benchmark(training_argv, args.repeats)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        report.update(books=args.books, events=args.events)
+
+    print(json.dumps(report, ensure_ascii=False, default=str))
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
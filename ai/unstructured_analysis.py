@@ -6,24 +6,58 @@ modeling uses BERTopic with modern sentence transformers.
 
 from __future__ import annotations
 
+import json
+import shutil
+import time
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable, List, Optional, Sequence, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
+import numpy as np
 import pandas as pd
 from bertopic import BERTopic
 from sentence_transformers import SentenceTransformer
 from transformers import pipeline
 
+from review_embeddings import DEFAULT_MODEL_NAME as DEFAULT_TOPIC_EMBEDDING_MODEL, ReviewEmbeddingStore
+from sentiment_cache import SentimentCache, text_key
+from sentiment_onnx import DEFAULT_ONNX_CACHE_DIR, export_quantized_onnx, load_onnx_sentiment_pipeline
+
+DEFAULT_SENTIMENT_FALLBACK_MODEL = "distilbert-base-uncased-finetuned-sst-2-english"
+DEFAULT_SENTIMENT_BATCH_SIZE = 32
+# Number of batches whose texts are sorted by length together. Larger windows pad
+# less but hold more results in memory before a chunk is yielded.
+DEFAULT_SORT_WINDOW_BATCHES = 16
+SENTIMENT_COLUMNS = ["text", "label", "score"]
+
+# Ids of the reviews already folded into the topic model, stored next to it
+TOPIC_STATE_FILE = "incorporated_reviews.json"
+# Topics of a new batch at least this similar to an existing topic are merged into it
+DEFAULT_TOPIC_MERGE_SIMILARITY = 0.7
+
 
 def load_sentiment_model(
     model_path: str = "ai/models/sentiment_finetuned_model",
-    fallback_model: str = "distilbert-base-uncased-finetuned-sst-2-english",
+    fallback_model: str = DEFAULT_SENTIMENT_FALLBACK_MODEL,
+    backend: str = "torch",
+    onnx_cache_dir: str = DEFAULT_ONNX_CACHE_DIR,
 ):
     """Load a fine-tuned Hugging Face sentiment-analysis pipeline.
 
     If the project-specific model is missing, gracefully fall back to a widely
-    available public checkpoint so the pipeline can still run.
+    available public checkpoint so the pipeline can still run. With
+    ``backend="onnx"`` the same model runs as a cached int8 ONNX export on ONNX
+    Runtime; if that is unavailable the PyTorch pipeline is used instead.
     """
+    if backend == "onnx":
+        export_dir = export_quantized_onnx(model_path, fallback_model, cache_dir=onnx_cache_dir)
+        if export_dir is not None:
+            try:
+                print(f"Loading quantized ONNX sentiment model from: {export_dir}")
+                return load_onnx_sentiment_pipeline(export_dir)
+            except Exception as exc:  # noqa: BLE001 - fall back to torch on any runtime error
+                print(f"[Sentiment] Could not load ONNX model ({exc}); using the PyTorch backend.")
+
     resolved_path = Path(model_path)
     if resolved_path.exists():
         print(f"Loading fine-tuned sentiment model from: {resolved_path}")
@@ -36,63 +70,302 @@ def load_sentiment_model(
     return pipeline("sentiment-analysis", model=fallback_model, tokenizer=fallback_model)
 
 
+def _resolve_sentiment_pipeline(sentiment_pipeline, model_path: str, fallback_model: str, backend: str):
+    if sentiment_pipeline is not None:
+        return sentiment_pipeline
+    try:
+        return load_sentiment_model(model_path=model_path, fallback_model=fallback_model, backend=backend)
+    except FileNotFoundError:
+        return load_sentiment_model(
+            model_path="ai/models/sentiment_finetuned_model", fallback_model=fallback_model, backend=backend
+        )
+
+
+def iter_sentiment_batches(
+    texts: Sequence[str],
+    sentiment_pipeline=None,
+    model_path: str = "ai/models/sentiment_finetuned_model",
+    fallback_model: str = DEFAULT_SENTIMENT_FALLBACK_MODEL,
+    batch_size: int = DEFAULT_SENTIMENT_BATCH_SIZE,
+    sort_window_batches: int = DEFAULT_SORT_WINDOW_BATCHES,
+    cache: Optional[SentimentCache] = None,
+    backend: str = "torch",
+) -> Iterator[pd.DataFrame]:
+    """Stream sentiment predictions as DataFrame chunks in input order.
+
+    Texts are consumed one window (``batch_size * sort_window_batches`` texts) at a
+    time. Inside a window they are sorted by length, so each batch sent to the model
+    holds texts of similar length and pads little. Each yielded chunk covers one
+    window, has the ``text``/``label``/``score`` columns and is indexed by the
+    position of the text in ``texts``. Memory is bounded by the window, not the corpus.
+
+    With a ``cache``, texts already scored by the same model are read from it, only
+    the misses (one per distinct normalized text) go through the model, and their
+    predictions are stored back. The model (``backend`` "torch" or "onnx") is only
+    loaded when some text needs inference.
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive.")
+    if not texts:
+        return
+
+    window = batch_size * max(sort_window_batches, 1)
+
+    for start in range(0, len(texts), window):
+        chunk = [str(text) for text in texts[start : start + window]]
+        labels: List[Optional[str]] = [None] * len(chunk)
+        scores = np.empty(len(chunk), dtype=np.float64)
+
+        # Positions still needing inference, grouped so each distinct text runs once
+        pending: Dict[object, List[int]] = {}
+        if cache is None:
+            pending = {pos: [pos] for pos in range(len(chunk))}
+        else:
+            keys = [text_key(text) for text in chunk]
+            cached = cache.get_many(keys)
+            for pos, key in enumerate(keys):
+                if key in cached:
+                    labels[pos], scores[pos] = cached[key]
+                else:
+                    pending.setdefault(key, []).append(pos)
+
+        if pending:
+            if sentiment_pipeline is None:
+                sentiment_pipeline = _resolve_sentiment_pipeline(None, model_path, fallback_model, backend)
+            groups = list(pending.values())
+            # Character length is a cheap proxy for token length; stable sort keeps ties in order
+            order = np.argsort([len(chunk[group[0]]) for group in groups], kind="stable")
+            started = time.perf_counter()
+            for offset in range(0, len(order), batch_size):
+                batch = [groups[index] for index in order[offset : offset + batch_size]]
+                results = sentiment_pipeline(
+                    [chunk[group[0]] for group in batch], truncation=True, batch_size=batch_size
+                )
+                for group, result in zip(batch, results):
+                    for pos in group:
+                        labels[pos] = result["label"]
+                        scores[pos] = result["score"]
+
+            if cache is not None:
+                elapsed = time.perf_counter() - started
+                cache.inference_seconds += elapsed
+                cache.put_many(
+                    ((key, labels[group[0]], scores[group[0]]) for key, group in pending.items()),
+                    seconds_per_text=elapsed / len(pending),
+                )
+
+        yield pd.DataFrame(
+            {"text": chunk, "label": labels, "score": scores},
+            index=pd.RangeIndex(start, start + len(chunk)),
+        )
+
+
 def analyze_sentiment_batch(
     texts: Sequence[str],
     sentiment_pipeline=None,
     model_path: str = "ai/models/sentiment_finetuned_model",
-    fallback_model: str = "distilbert-base-uncased-finetuned-sst-2-english",
+    fallback_model: str = DEFAULT_SENTIMENT_FALLBACK_MODEL,
+    batch_size: int = DEFAULT_SENTIMENT_BATCH_SIZE,
+    cache: Optional[SentimentCache] = None,
+    backend: str = "torch",
 ) -> pd.DataFrame:
     """Run batched sentiment analysis over a list of texts."""
-    if not texts:
-        return pd.DataFrame(columns=["text", "label", "score"])
+    chunks = list(
+        iter_sentiment_batches(
+            texts,
+            sentiment_pipeline=sentiment_pipeline,
+            model_path=model_path,
+            fallback_model=fallback_model,
+            batch_size=batch_size,
+            cache=cache,
+            backend=backend,
+        )
+    )
+    if not chunks:
+        return pd.DataFrame(columns=SENTIMENT_COLUMNS)
+    return pd.concat(chunks)
 
-    if sentiment_pipeline is None:
-        try:
-            sentiment_pipeline = load_sentiment_model(
-                model_path=model_path, fallback_model=fallback_model
-            )
-        except FileNotFoundError:
-            sentiment_pipeline = load_sentiment_model(
-                model_path="ai/models/sentiment_finetuned_model", fallback_model=fallback_model
-            )
 
-    results = sentiment_pipeline(list(texts), truncation=True)
-    output = pd.DataFrame(results)
-    output.insert(0, "text", texts)
-    return output
+def benchmark_sentiment_throughput(
+    texts: Sequence[str],
+    sentiment_pipeline,
+    batch_sizes: Sequence[int] = (1, 8, 16, 32, 64),
+    sort_by_length: bool = True,
+) -> List[Dict[str, float]]:
+    """Measure reviews/sec of ``iter_sentiment_batches`` for each batch size.
+
+    ``sort_by_length=False`` disables bucketing (one batch per window) to show how
+    much the length sorting saves on padding.
+    """
+    report: List[Dict[str, float]] = []
+    for batch_size in batch_sizes:
+        started = time.perf_counter()
+        processed = sum(
+            len(chunk)
+            for chunk in iter_sentiment_batches(
+                texts,
+                sentiment_pipeline=sentiment_pipeline,
+                batch_size=batch_size,
+                sort_window_batches=DEFAULT_SORT_WINDOW_BATCHES if sort_by_length else 1,
+            )
+        )
+        elapsed = time.perf_counter() - started
+        report.append(
+            {
+                "batch_size": int(batch_size),
+                "reviews": int(processed),
+                "seconds": round(elapsed, 3),
+                "reviews_per_second": round(processed / elapsed, 1) if elapsed > 0 else 0.0,
+            }
+        )
+    return report
 
 
 def train_topic_model(
     documents: Iterable[str],
-    embedding_model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
-    save_dir: str = "ai/models/topic_model",
+    embedding_model_name: Optional[str] = None,
+    save_dir: Optional[str] = "ai/models/topic_model",
     min_topic_size: int = 10,
     verbose: bool = True,
+    embedding_store: Optional[ReviewEmbeddingStore] = None,
+    incorporated_reviews: Optional[Iterable[str]] = None,
 ) -> BERTopic:
-    """Train a BERTopic model on the provided documents and persist it."""
+    """Train a BERTopic model on the provided documents and persist it.
+
+    With an ``embedding_store`` the documents are embedded through it (and its model
+    is used) instead of BERTopic encoding them again; an explicit
+    ``embedding_model_name`` must then name the store's model. ``save_dir=None``
+    skips saving; ``incorporated_reviews`` are saved with the model as its
+    training-set ids.
+    """
+    embedding_model_name = _topic_embedding_model(embedding_model_name, embedding_store)
     documents = [doc for doc in documents if isinstance(doc, str) and doc.strip()]
     if not documents:
         raise ValueError("No valid documents provided for topic modeling.")
 
-    embedding_model = SentenceTransformer(embedding_model_name)
+    embeddings = None
+    if embedding_store is not None:
+        embeddings = embedding_store.embed(documents)
+        embedding_model = embedding_store.model
+    else:
+        embedding_model = SentenceTransformer(embedding_model_name)
     topic_model = BERTopic(
         embedding_model=embedding_model,
         min_topic_size=min_topic_size,
         verbose=verbose,
     )
 
-    topic_model.fit(documents)
-    save_path = Path(save_dir)
-    save_path.mkdir(parents=True, exist_ok=True)
-    topic_model.save(str(save_path), serialization="safetensors", save_ctfidf=True)
+    topic_model.fit(documents, embeddings=embeddings)
+    if save_dir is not None:
+        _save_topic_model(topic_model, save_dir, incorporated_reviews)
 
     return topic_model
 
 
+def _topic_embedding_model(
+    embedding_model_name: Optional[str], embedding_store: Optional[ReviewEmbeddingStore]
+) -> str:
+    if embedding_store is None:
+        return embedding_model_name or DEFAULT_TOPIC_EMBEDDING_MODEL
+    if embedding_model_name is not None and embedding_model_name != embedding_store.model_name:
+        raise ValueError(
+            f"embedding_model_name `{embedding_model_name}` does not match the embedding store "
+            f"model `{embedding_store.model_name}`."
+        )
+    return embedding_store.model_name
+
+
+def _save_topic_model(
+    topic_model: BERTopic,
+    save_dir: str,
+    incorporated_reviews: Optional[Iterable[str]] = None,
+) -> None:
+    """Write the model and its review ids to a staging directory, then swap it in.
+
+    The model and its state are replaced together: a crash leaves either the previous
+    pair or no model at all (next run trains from scratch), never a merged model with
+    the old ids, which would merge the same batch again.
+    """
+    save_path = Path(save_dir)
+    staging = save_path.with_name(save_path.name + ".tmp")
+    previous = save_path.with_name(save_path.name + ".old")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    topic_model.save(str(staging), serialization="safetensors", save_ctfidf=True)
+    if incorporated_reviews is not None:
+        save_incorporated_reviews(str(staging), incorporated_reviews)
+
+    shutil.rmtree(previous, ignore_errors=True)
+    if save_path.exists():
+        save_path.rename(previous)
+    staging.rename(save_path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def update_topic_model(
+    topic_model: BERTopic,
+    documents: Iterable[str],
+    embedding_model_name: Optional[str] = None,
+    save_dir: str = "ai/models/topic_model",
+    min_topic_size: int = 10,
+    min_similarity: float = DEFAULT_TOPIC_MERGE_SIMILARITY,
+    verbose: bool = True,
+    embedding_store: Optional[ReviewEmbeddingStore] = None,
+    incorporated_reviews: Optional[Iterable[str]] = None,
+) -> BERTopic:
+    """Fold new documents into an existing topic model and persist the result.
+
+    A BERTopic model is trained on the new documents only, then merged with
+    ``BERTopic.merge_models``: its topics that match an existing topic are absorbed,
+    the others are appended as new topics. The cost grows with the new documents,
+    not the whole corpus. This works on safetensors-saved models, which keep no
+    UMAP/HDBSCAN state for ``partial_fit``. ``incorporated_reviews`` (the ids of the
+    old and new documents) are saved together with the merged model.
+    """
+    embedding_model_name = _topic_embedding_model(embedding_model_name, embedding_store)
+    batch_model = train_topic_model(
+        documents,
+        embedding_model_name=embedding_model_name,
+        save_dir=None,
+        min_topic_size=min_topic_size,
+        verbose=verbose,
+        embedding_store=embedding_store,
+    )
+    merged = BERTopic.merge_models(
+        [topic_model, batch_model],
+        min_similarity=min_similarity,
+        embedding_model=embedding_store.model if embedding_store is not None else embedding_model_name,
+    )
+    _save_topic_model(merged, save_dir, incorporated_reviews)
+    return merged
+
+
+def load_incorporated_reviews(save_dir: str) -> Set[str]:
+    """Ids of the reviews already in the topic model saved at ``save_dir`` (empty if unknown)."""
+    state_path = Path(save_dir) / TOPIC_STATE_FILE
+    if not state_path.exists():
+        return set()
+    payload = json.loads(state_path.read_text(encoding="utf-8"))
+    return set(payload.get("review_ids", []))
+
+
+def save_incorporated_reviews(save_dir: str, review_ids: Iterable[str]) -> None:
+    state_path = Path(save_dir) / TOPIC_STATE_FILE
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+        "review_ids": sorted(set(review_ids)),
+    }
+    tmp_path = state_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+    tmp_path.replace(state_path)
+
+
 def get_topics_for_book(
     topic_model: BERTopic,
     documents: Sequence[str],
     top_n: int = 3,
+    embedding_store: Optional[ReviewEmbeddingStore] = None,
 ) -> List[Tuple[int, float]]:
     """Derive the most representative topics for a collection of documents."""
     if topic_model is None:
@@ -102,7 +375,8 @@ def get_topics_for_book(
     if not docs:
         return []
 
-    topics, probs = topic_model.transform(docs)
+    embeddings = embedding_store.embed(docs) if embedding_store is not None else None
+    topics, probs = topic_model.transform(docs, embeddings=embeddings)
     topic_scores = {}
     for topic, prob in zip(topics, probs):
         if topic == -1:
@@ -116,7 +390,14 @@ def get_topics_for_book(
 __all__ = [
     "load_sentiment_model",
     "analyze_sentiment_batch",
+    "iter_sentiment_batches",
+    "benchmark_sentiment_throughput",
+    "DEFAULT_SENTIMENT_BATCH_SIZE",
+    "DEFAULT_SENTIMENT_FALLBACK_MODEL",
     "train_topic_model",
+    "update_topic_model",
+    "load_incorporated_reviews",
+    "save_incorporated_reviews",
     "get_topics_for_book",
 ]
 